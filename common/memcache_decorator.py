@@ -14,15 +14,79 @@
 
 """A decorator to quickly use memcache on any function."""
 
+import collections
 import functools
 import hashlib
 import pickle
+import sys
+import threading
+import time
+import weakref
 
 from google.appengine.api import memcache
 
 from common import context
 
 
+# Argument types which can be turned into a key with repr() rather than pickle.
+_SCALAR_TYPES = frozenset([
+    bool, float, int, long, str, unicode, type(None)])
+
+# Keys longer than this are hashed, to stay well within memcache's limit.
+_MAX_KEY_LENGTH = 200
+
+# Every LocalCache in this instance, so they can all be cleared at once.
+_local_caches = weakref.WeakSet()
+
+# Prepended to a key to name the lease taken out while recomputing its value.
+_LEASE_PREFIX = 'lease:'
+
+# How long, in seconds, callers wait for another caller holding a lease to
+# compute a value before giving up and computing it themselves.
+_MAX_LEASE_WAIT = 2
+_LEASE_POLL_INTERVAL = 0.05
+
+
+class _CachedNone(object):
+  """Stands in for a cached None result.
+
+  The class itself is cached rather than an instance, so that it unpickles to
+  the same object.
+  """
+
+
+def _IsScalar(arg):
+  return type(arg) in _SCALAR_TYPES
+
+
+def FastCreateKey(func, prefix, args, kwargs=None):
+  """Creates a key name like DefaultCreateKey, but without pickling.
+
+  Only suitable for calls whose arguments are all scalars (see _SCALAR_TYPES),
+  which are distinguished by their repr(). Any other call falls back to
+  DefaultCreateKey.
+
+  Args:
+    func: function - the function that is decorated.
+    prefix: str - the optional key prefix that was passed to the decorator.
+    args: list of * - the arguments that were used to call the function.
+    kwargs: dict - the keyword arguments that were used to call the function.
+  Returns:
+    str - the string to use as key in memcache.
+  """
+  if not (all(_IsScalar(arg) for arg in args) and
+          (not kwargs or all(_IsScalar(v) for v in kwargs.itervalues()))):
+    return DefaultCreateKey(func, prefix, args, kwargs)
+
+  key = prefix or (func.__module__ or 'None') + '.' + func.__name__
+  key = '%s(%s)' % (key, ','.join(repr(arg) for arg in args))
+  if kwargs:
+    key += repr(sorted(kwargs.iteritems()))
+  if len(key) > _MAX_KEY_LENGTH:
+    return hashlib.md5(key).hexdigest()
+  return key
+
+
 def DefaultCreateKey(func, prefix, args, kwargs=None):
   """Creates a key name from prefix, function name, args and kwargs.
 
@@ -47,18 +111,156 @@ def DefaultCreateKey(func, prefix, args, kwargs=None):
   return hashlib.md5(key).hexdigest()
 
 
+def _GetSize(value):
+  """Estimates the memory used by a cached value."""
+  try:
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+  except (pickle.PicklingError, TypeError):
+    return sys.getsizeof(value)
+
+
+class LocalCache(object):
+  """A thread-safe, in-instance LRU cache whose entries expire.
+
+  The cache is bounded both by the number of entries and by their approximate
+  total size, as measured by _GetSize().
+  """
+
+  def __init__(self, max_entries, max_bytes=None, expire_time=60):
+    """Constructor.
+
+    Args:
+      max_entries: int - the maximum number of entries to hold.
+      max_bytes: int - the maximum total size of the entries, if any.
+      expire_time: int - the number of seconds entries are held for.
+    """
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._expire_time = expire_time
+    self._entries = collections.OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+    _local_caches.add(self)
+
+  def __len__(self):
+    return len(self._entries)
+
+  @property
+  def size(self):
+    return self._size
+
+  def Get(self, key):
+    """Returns the value cached for key, or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return None
+      value, size, expiry = entry
+      if expiry < time.time():
+        self._size -= size
+        return None
+      # Move the entry to the most recently used end.
+      self._entries[key] = entry
+      return value
+
+  def Set(self, key, value, expire_time=None):
+    """Caches a value.
+
+    Args:
+      key: str - the key to cache the value under.
+      value: * - the value to cache.
+      expire_time: int - Optional number of seconds to hold this value for, if
+          shorter than that of the cache.
+    """
+    size = _GetSize(value) if self._max_bytes else 0
+    if self._max_bytes and size > self._max_bytes:
+      return
+    if expire_time is None or expire_time > self._expire_time:
+      expire_time = self._expire_time
+    with self._lock:
+      self._Remove(key)
+      self._entries[key] = (value, size, time.time() + expire_time)
+      self._size += size
+      while (len(self._entries) > self._max_entries or
+             (self._max_bytes and self._size > self._max_bytes)):
+        _, (_, evicted_size, _) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+
+  def Delete(self, key):
+    with self._lock:
+      self._Remove(key)
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+  def _Remove(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._size -= entry[1]
+
+
+def ClearLocalCaches():
+  """Clears every in-instance cache, e.g. between tests."""
+  for local_cache in list(_local_caches):
+    local_cache.Clear()
+
+
+class CacheStats(object):
+  """Counts the lookups made by a Cached function.
+
+  Attributes:
+    local_hits: int - lookups answered by the in-instance cache.
+    memcache_hits: int - lookups answered by memcache.
+    stale_hits: int - lookups answered with a stale result while another
+        caller recomputed it.
+    misses: int - lookups which called through to the function.
+  """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    self.local_hits = 0
+    self.memcache_hits = 0
+    self.stale_hits = 0
+    self.misses = 0
+
+  @property
+  def hit_rate(self):
+    hits = self.local_hits + self.memcache_hits + self.stale_hits
+    total = hits + self.misses
+    return float(hits) / total if total else 0.0
+
+
 def Cached(
-    key_name=None, expire_time=0, create_key_func=DefaultCreateKey,
-    namespace=context.APP_VERSION):
+    key_name=None, expire_time=0, create_key_func=FastCreateKey,
+    namespace=context.APP_VERSION, local_cache_size=0, local_cache_bytes=None,
+    local_expire_time=60, single_flight=False, lease_time=10,
+    stale_while_revalidate=None, negative_expire_time=None):
   """Decorator function to cache (using memcache API) a function's results.
 
   This decorator won't work in all cases and you should pay attention on how you
   use it:
    - it creates a key for each different call by converting arguments into
-     string, using pickle, and then taking the md5 of the key string.
+     string, using repr for scalars and pickle otherwise, and then taking the
+     md5 of the key string if it's long or pickled.
    - you can provide your own create_key_func. The keys can collide if
      create_key_func generates the same key for different arguments.
    - you can use it for classmethods, you can't use it for methods.
+   - if local_cache_size is set, results are also held in an in-instance LRU
+     cache which is consulted before memcache. The same object is returned
+     from every local hit, so don't mutate results. DeleteCache only clears the
+     local cache of the calling instance, so other instances may keep returning
+     the old result for up to local_expire_time.
+   - None results aren't cached unless negative_expire_time is set.
+   - if single_flight is set, only one caller at a time recomputes a missing
+     result, by taking out a lease with memcache.add(). Other callers wait
+     briefly for it, and compute the result themselves if it doesn't appear.
+   - if stale_while_revalidate is set, results are kept that many seconds past
+     expire_time. A caller which finds one is returned it, unless it's the
+     first to do so, in which case it recomputes it (as with single_flight).
 
   Use DeleteCache on the function using the same argument to delete the cache
   for this value. See DeleteCache documentation.
@@ -72,12 +274,32 @@ def Cached(
         to memory pressure. Float values will be rounded up to the nearest whole
         second.
     create_key_func: function - Functions used to generate the memcache key
-        where the result of each call will be cached. See _DefaultCreateKey for
-        the signature. _DefaultCreateKey is also the default parameter.
+        where the result of each call will be cached. See DefaultCreateKey for
+        the signature. FastCreateKey is the default parameter.
     namespace: str - the memcache namespace to use.
+    local_cache_size: int - the number of results to hold in the in-instance
+        cache. Disabled by default.
+    local_cache_bytes: int - Optional bound on the approximate total size of
+        the results held in the in-instance cache.
+    local_expire_time: int - the number of seconds results are held in the
+        in-instance cache.
+    single_flight: bool - whether to stop concurrent callers from recomputing
+        the same result.
+    lease_time: int - the number of seconds a caller has to recompute a result
+        before another may take over.
+    stale_while_revalidate: int - Optional number of seconds past expire_time
+        during which a result may be returned while it's recomputed. Requires
+        a relative expire_time.
+    negative_expire_time: int - Optional number of seconds to cache None
+        results for.
   Returns:
-    A decorator.
+    A decorator. The decorated function has a DeleteCache attribute (see below)
+    and a stats attribute holding its CacheStats.
+  Raises:
+    ValueError: if stale_while_revalidate is set without an expire_time.
   """
+  if stale_while_revalidate and not expire_time:
+    raise ValueError('stale_while_revalidate requires an expire_time')
 
   def Decorator(func):
     """Decorator to cache a function's results.
@@ -88,16 +310,111 @@ def Cached(
       function - the wrapped function.
     """
 
+    stats = CacheStats()
+    local_cache = None
+    if local_cache_size:
+      local_cache = LocalCache(
+          local_cache_size, max_bytes=local_cache_bytes,
+          expire_time=local_expire_time)
+
+    def _Lookup(key):
+      """Looks up a cached result.
+
+      Returns:
+        (value, fresh) - the cached value, which is None if there isn't one or
+            _CachedNone for a cached None result, and whether it's fresh.
+      """
+      if local_cache is not None:
+        value = local_cache.Get(key)
+        if value is not None:
+          stats.local_hits += 1
+          return value, True
+
+      value = memcache.get(key, namespace=namespace)
+      if value is None:
+        return None, False
+
+      ttl = None
+      if stale_while_revalidate:
+        value, fresh_until = value
+        ttl = fresh_until - time.time()
+        if ttl <= 0:
+          return value, False
+
+      stats.memcache_hits += 1
+      if local_cache is not None:
+        local_cache.Set(key, value, expire_time=ttl)
+      return value, True
+
+    def _Store(key, result):
+      if result is None:
+        if not negative_expire_time:
+          return
+        value, ttl = _CachedNone, negative_expire_time
+      else:
+        value, ttl = result, expire_time
+
+      # Cast ttl to int so lazy's are resolved and accepted in memcache.
+      if stale_while_revalidate:
+        memcache.set(
+            key, (value, time.time() + ttl),
+            time=int(ttl + stale_while_revalidate), namespace=namespace)
+      else:
+        memcache.set(key, value, time=int(ttl), namespace=namespace)
+
+      if local_cache is not None:
+        local_cache.Set(key, value, expire_time=ttl or None)
+
+    def _WaitForLeaseHolder(key, lease_key):
+      """Waits for the caller holding a lease to cache its result.
+
+      Returns:
+        The cached value, or None if it didn't appear in time.
+      """
+      deadline = time.time() + min(lease_time, _MAX_LEASE_WAIT)
+      while time.time() < deadline:
+        time.sleep(_LEASE_POLL_INTERVAL)
+        cached = memcache.get_multi([key, lease_key], namespace=namespace)
+        value = cached.get(key)
+        if value is not None:
+          if stale_while_revalidate:
+            value, _ = value
+          return value
+        # The lease holder finished without caching anything.
+        if lease_key not in cached:
+          return None
+      return None
+
+    def _Compute(key, args, kwargs):
+      stats.misses += 1
+      result = func(*args, **kwargs)
+      _Store(key, result)
+      return result
+
     @functools.wraps(func)
     def Wrapped(*args, **kwargs):
       key = create_key_func(func, key_name, args, kwargs)
-      result = memcache.get(key, namespace=namespace)
-      if result is not None:
-        return result
-      result = func(*args, **kwargs)
-      # Cast expire_time to int so lazy's are resolved and accepted in memcache.
-      memcache.set(key, result, time=int(expire_time), namespace=namespace)
-      return result
+
+      value, fresh = _Lookup(key)
+      if not fresh and (single_flight or value is not None):
+        lease_key = _LEASE_PREFIX + key
+        if memcache.add(lease_key, True, time=lease_time, namespace=namespace):
+          try:
+            return _Compute(key, args, kwargs)
+          finally:
+            memcache.delete(lease_key, namespace=namespace)
+
+        # Someone else is already recomputing the result.
+        if value is not None:
+          stats.stale_hits += 1
+        else:
+          value = _WaitForLeaseHolder(key, lease_key)
+          if value is not None:
+            stats.memcache_hits += 1
+
+      if value is None:
+        return _Compute(key, args, kwargs)
+      return None if value is _CachedNone else value
 
     def DeleteCache(*args, **kwargs):
       """Delete cache for *args.
@@ -114,10 +431,155 @@ def Cached(
         MyFunc('a')  // returns cached result
         MyFunc.DeleteCache('a')  // Delete the cache for 'a'.
       """
-      memcache.delete(create_key_func(func, key_name, args, kwargs),
-                      namespace=namespace)
+      key = create_key_func(func, key_name, args, kwargs)
+      if local_cache is not None:
+        local_cache.Delete(key)
+      memcache.delete(key, namespace=namespace)
+
+    Wrapped.DeleteCache = DeleteCache
+    Wrapped.stats = stats
+    Wrapped.local_cache = local_cache
+
+    return Wrapped
+
+  return Decorator
+
+
+def CachedMulti(
+    key_name=None, expire_time=0, create_key_func=FastCreateKey,
+    namespace=context.APP_VERSION, local_cache_size=0, local_cache_bytes=None,
+    local_expire_time=60, negative_expire_time=None):
+  """Decorator function to cache the results of a batch function.
+
+  The decorated function must take a list of ids as its first argument and
+  return a dict mapping some or all of them to their results. Each id's result
+  is cached separately, under the key create_key_func would create for a call
+  with the id in place of the list, so that a call only passes the ids without
+  a cached result through to the function. All cached results are fetched with
+  a single memcache.get_multi() call, and new ones stored with set_multi().
+
+  The same caveats as for Cached apply, and additionally:
+   - ids must be hashable, and any further arguments are the same for every id
+     in a call.
+   - ids missing from the returned dict, or mapped to None, are omitted from
+     the result, and aren't cached unless negative_expire_time is set.
+   - single_flight and stale_while_revalidate aren't supported.
+
+  Args:
+    key_name: str - the prefix of the memcache keys to use, default is to use
+        the functions's name.
+    expire_time: int - Optional expiration time. See Cached.
+    create_key_func: function - Functions used to generate the memcache key
+        where each id's result will be cached. It's called with the id in
+        place of the list of ids. See DefaultCreateKey for the signature.
+    namespace: str - the memcache namespace to use.
+    local_cache_size: int - the number of results to hold in the in-instance
+        cache. Disabled by default.
+    local_cache_bytes: int - Optional bound on the approximate total size of
+        the results held in the in-instance cache.
+    local_expire_time: int - the number of seconds results are held in the
+        in-instance cache.
+    negative_expire_time: int - Optional number of seconds to cache missing
+        results for.
+  Returns:
+    A decorator. The decorated function has DeleteCache, stats and local_cache
+    attributes, as with Cached.
+  """
+
+  def Decorator(func):
+    """Decorator to cache a batch function's results.
+
+    Args:
+      func: function - function to cache.
+    Returns:
+      function - the wrapped function.
+    """
+
+    stats = CacheStats()
+    local_cache = None
+    if local_cache_size:
+      local_cache = LocalCache(
+          local_cache_size, max_bytes=local_cache_bytes,
+          expire_time=local_expire_time)
+
+    def _CreateKeys(ids, args, kwargs):
+      return collections.OrderedDict(
+          (create_key_func(func, key_name, (id_,) + args, kwargs), id_)
+          for id_ in ids)
+
+    def _Store(keys, results):
+      to_set = {}
+      negatives = {}
+      for key, id_ in keys.iteritems():
+        result = results.get(id_)
+        if result is not None:
+          to_set[key] = result
+        elif negative_expire_time:
+          negatives[key] = _CachedNone
+
+      # Cast the expiry times to int so lazy's are resolved and accepted in
+      # memcache.
+      for values, ttl in ((to_set, expire_time),
+                          (negatives, negative_expire_time)):
+        if not values:
+          continue
+        memcache.set_multi(values, time=int(ttl), namespace=namespace)
+        if local_cache is not None:
+          for key, value in values.iteritems():
+            local_cache.Set(key, value, expire_time=ttl or None)
+
+    @functools.wraps(func)
+    def Wrapped(ids, *args, **kwargs):
+      keys = _CreateKeys(ids, args, kwargs)
+
+      cached = {}
+      if local_cache is not None:
+        for key in keys:
+          value = local_cache.Get(key)
+          if value is not None:
+            cached[key] = value
+        stats.local_hits += len(cached)
+
+      remaining = [key for key in keys if key not in cached]
+      if remaining:
+        from_memcache = memcache.get_multi(remaining, namespace=namespace)
+        stats.memcache_hits += len(from_memcache)
+        if local_cache is not None:
+          for key, value in from_memcache.iteritems():
+            local_cache.Set(key, value)
+        cached.update(from_memcache)
+
+      missing = collections.OrderedDict(
+          (key, id_) for key, id_ in keys.iteritems() if key not in cached)
+      if missing:
+        stats.misses += len(missing)
+        results = func(missing.values(), *args, **kwargs) or {}
+        _Store(missing, results)
+        cached.update(
+            (key, results.get(id_)) for key, id_ in missing.iteritems())
+
+      return {
+          keys[key]: value
+          for key, value in cached.iteritems()
+          if value is not None and value is not _CachedNone}
+
+    def DeleteCache(ids, *args, **kwargs):
+      """Delete cache for each of ids.
+
+      Args:
+        ids: list - Ids for which to clear the cache.
+        *args: Decorated function args for which to clear the cache.
+        **kwargs: Decorated function keyword args for which to clear the cache.
+      """
+      keys = list(_CreateKeys(ids, args, kwargs))
+      if local_cache is not None:
+        for key in keys:
+          local_cache.Delete(key)
+      memcache.delete_multi(keys, namespace=namespace)
 
     Wrapped.DeleteCache = DeleteCache
+    Wrapped.stats = stats
+    Wrapped.local_cache = local_cache
 
     return Wrapped
 
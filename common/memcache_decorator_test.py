@@ -0,0 +1,371 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for memcache_decorator."""
+
+import mock
+
+from google.appengine.api import memcache
+
+from common import memcache_decorator
+from common.testing import basetest
+
+
+class CreateKeyTest(basetest.AppEngineTestCase):
+
+  def _Func(self):
+    pass
+
+  def testFastCreateKey_Scalars(self):
+    key = memcache_decorator.FastCreateKey(
+        self._Func, None, ('a', u'a', 1, 1L, True, None), {'b': 2})
+    self.assertEqual(
+        "%s._Func('a',u'a',1,1L,True,None)[('b', 2)]" % __name__, key)
+
+  def testFastCreateKey_Distinct(self):
+    keys = {
+        memcache_decorator.FastCreateKey(self._Func, None, args)
+        for args in [(), ('1',), (1,), (1L,), (True,), ('a', 'b'), ('a,b',)]}
+    self.assertLen(keys, 7)
+
+  def testFastCreateKey_Long(self):
+    key = memcache_decorator.FastCreateKey(self._Func, None, ('a' * 500,))
+    self.assertLen(key, 32)
+
+  def testFastCreateKey_NonScalar(self):
+    args = (['a'],)
+    self.assertEqual(
+        memcache_decorator.DefaultCreateKey(self._Func, 'prefix', args),
+        memcache_decorator.FastCreateKey(self._Func, 'prefix', args))
+
+
+class LocalCacheTest(basetest.AppEngineTestCase):
+
+  def testEvictLeastRecentlyUsed(self):
+    cache = memcache_decorator.LocalCache(2)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    cache.Get('a')
+    cache.Set('c', 3)
+
+    self.assertEqual(1, cache.Get('a'))
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(3, cache.Get('c'))
+
+  def testEvictBySize(self):
+    cache = memcache_decorator.LocalCache(10, max_bytes=100)
+    cache.Set('a', 'a' * 60)
+    cache.Set('b', 'b' * 60)
+
+    self.assertIsNone(cache.Get('a'))
+    self.assertIsNotNone(cache.Get('b'))
+    self.assertLessEqual(cache.size, 100)
+
+    # Values which could never fit aren't cached at all.
+    cache.Set('c', 'c' * 200)
+    self.assertIsNone(cache.Get('c'))
+    self.assertIsNotNone(cache.Get('b'))
+
+  @mock.patch.object(memcache_decorator.time, 'time', return_value=1000)
+  def testExpire(self, mock_time):
+    cache = memcache_decorator.LocalCache(10, expire_time=60)
+    cache.Set('a', 1)
+
+    mock_time.return_value = 1059
+    self.assertEqual(1, cache.Get('a'))
+    mock_time.return_value = 1061
+    self.assertIsNone(cache.Get('a'))
+    self.assertLen(cache, 0)
+
+
+class CachedTest(basetest.AppEngineTestCase):
+
+  def setUp(self):
+    super(CachedTest, self).setUp()
+    self.call_mock = mock.Mock(return_value='result')
+
+  def testMemcacheOnly(self):
+
+    @memcache_decorator.Cached()
+    def Foo(a):
+      return self.call_mock(a)
+
+    self.assertEqual('result', Foo(1))
+    self.assertEqual('result', Foo(1))
+
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertIsNone(Foo.local_cache)
+    self.assertEqual(1, Foo.stats.memcache_hits)
+    self.assertEqual(1, Foo.stats.misses)
+
+  def testLocalCache(self):
+
+    @memcache_decorator.Cached(local_cache_size=10)
+    def Foo(a):
+      return self.call_mock(a)
+
+    Foo(1)
+    Foo(1)
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertEqual(1, Foo.stats.local_hits)
+
+    # Results should also have been written through to memcache.
+    Foo.local_cache.Clear()
+    Foo(1)
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertEqual(1, Foo.stats.memcache_hits)
+
+    # And memcache hits should fill the local cache.
+    with mock.patch.object(memcache, 'get') as mock_get:
+      Foo(1)
+      mock_get.assert_not_called()
+    self.assertEqual(2, Foo.stats.local_hits)
+    self.assertAlmostEqual(0.75, Foo.stats.hit_rate)
+
+  def testLocalCache_DeleteCache(self):
+
+    @memcache_decorator.Cached(local_cache_size=10)
+    def Foo(a):
+      return self.call_mock(a)
+
+    Foo(1)
+    Foo.DeleteCache(1)
+    Foo(1)
+
+    self.assertEqual(2, self.call_mock.call_count)
+
+  def testClearLocalCaches(self):
+
+    @memcache_decorator.Cached(local_cache_size=10)
+    def Foo(a):
+      return self.call_mock(a)
+
+    Foo(1)
+    memcache_decorator.ClearLocalCaches()
+
+    self.assertLen(Foo.local_cache, 0)
+
+  def testNoneNotCached(self):
+    self.call_mock.return_value = None
+
+    @memcache_decorator.Cached(local_cache_size=10)
+    def Foo(a):
+      return self.call_mock(a)
+
+    self.assertIsNone(Foo(1))
+    self.assertIsNone(Foo(1))
+    self.assertEqual(2, self.call_mock.call_count)
+
+  def testNegativeCaching(self):
+    self.call_mock.return_value = None
+
+    @memcache_decorator.Cached(negative_expire_time=60, local_cache_size=10)
+    def Foo(a):
+      return self.call_mock(a)
+
+    self.assertIsNone(Foo(1))
+    self.assertIsNone(Foo(1))
+    Foo.local_cache.Clear()
+    self.assertIsNone(Foo(1))
+    self.assertEqual(1, self.call_mock.call_count)
+
+
+class SingleFlightTest(basetest.AppEngineTestCase):
+
+  def setUp(self):
+    super(SingleFlightTest, self).setUp()
+    self.call_mock = mock.Mock(return_value='result')
+    patcher = mock.patch.object(memcache_decorator.time, 'sleep')
+    self.addCleanup(patcher.stop)
+    self.mock_sleep = patcher.start()
+
+    @memcache_decorator.Cached(
+        create_key_func=lambda *_: 'key', namespace=None, single_flight=True)
+    def Foo():
+      return self.call_mock()
+
+    self.foo = Foo
+
+  def testLeaseReleased(self):
+    self.assertEqual('result', self.foo())
+
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertIsNone(memcache.get('lease:key'))
+
+  def testLeaseReleased_Error(self):
+    self.call_mock.side_effect = ValueError
+
+    with self.assertRaises(ValueError):
+      self.foo()
+    self.assertIsNone(memcache.get('lease:key'))
+
+  def testLeaseHeld(self):
+    memcache.add('lease:key', True)
+
+    # The lease holder caches its result while this caller is waiting.
+    self.mock_sleep.side_effect = lambda _: memcache.set('key', 'other')
+
+    self.assertEqual('other', self.foo())
+    self.call_mock.assert_not_called()
+
+  def testLeaseHeld_NothingCached(self):
+    memcache.add('lease:key', True)
+
+    # The lease holder finishes without caching anything.
+    self.mock_sleep.side_effect = lambda _: memcache.delete('lease:key')
+
+    self.assertEqual('result', self.foo())
+    self.assertEqual(1, self.call_mock.call_count)
+
+
+class StaleWhileRevalidateTest(basetest.AppEngineTestCase):
+
+  def setUp(self):
+    super(StaleWhileRevalidateTest, self).setUp()
+    self.call_mock = mock.Mock(side_effect=['first', 'second', 'third'])
+    patcher = mock.patch.object(
+        memcache_decorator.time, 'time', return_value=1000)
+    self.addCleanup(patcher.stop)
+    self.mock_time = patcher.start()
+
+    @memcache_decorator.Cached(
+        create_key_func=lambda *_: 'key', namespace=None, expire_time=60,
+        stale_while_revalidate=60)
+    def Foo():
+      return self.call_mock()
+
+    self.foo = Foo
+
+  def testRevalidate(self):
+    self.assertEqual('first', self.foo())
+
+    # Once stale, the first caller recomputes the result.
+    self.mock_time.return_value = 1070
+    self.assertEqual('second', self.foo())
+    self.assertEqual('second', self.foo())
+    self.assertEqual(2, self.call_mock.call_count)
+
+  def testServeStale(self):
+    self.assertEqual('first', self.foo())
+
+    # While someone else is recomputing it, the stale result is returned.
+    self.mock_time.return_value = 1070
+    memcache.add('lease:key', True)
+    self.assertEqual('first', self.foo())
+
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertEqual(1, self.foo.stats.stale_hits)
+
+  def testRequiresExpireTime(self):
+    with self.assertRaises(ValueError):
+      memcache_decorator.Cached(stale_while_revalidate=60)
+
+
+class CachedMultiTest(basetest.AppEngineTestCase):
+
+  def setUp(self):
+    super(CachedMultiTest, self).setUp()
+    self.call_mock = mock.Mock(
+        side_effect=lambda ids: {id_: id_ * 2 for id_ in ids if id_ != 3})
+
+  def testOnlyMissesCalled(self):
+
+    @memcache_decorator.CachedMulti()
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    self.assertEqual({1: 2, 2: 4}, Foo([1, 2]))
+    self.assertEqual({1: 2, 2: 4, 4: 8}, Foo([1, 2, 4]))
+
+    self.call_mock.assert_has_calls([mock.call([1, 2]), mock.call([4])])
+    self.assertEqual(2, Foo.stats.memcache_hits)
+    self.assertEqual(3, Foo.stats.misses)
+
+  def testSingleRoundTrip(self):
+
+    @memcache_decorator.CachedMulti()
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    Foo([1, 2])
+    with mock.patch.object(
+        memcache, 'get_multi', wraps=memcache.get_multi) as mock_get_multi:
+      self.assertEqual({1: 2, 2: 4}, Foo([1, 2]))
+    mock_get_multi.assert_called_once()
+    self.assertEqual(1, self.call_mock.call_count)
+
+  def testSharesKeysWithCached(self):
+
+    @memcache_decorator.CachedMulti(key_name='foo')
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    @memcache_decorator.Cached(key_name='foo')
+    def Bar(unused_id):
+      return 'bar'
+
+    Foo([1])
+    self.assertEqual(2, Bar(1))
+
+  def testLocalCache(self):
+
+    @memcache_decorator.CachedMulti(local_cache_size=10)
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    Foo([1, 2])
+    Foo.local_cache.Clear()
+    Foo([1])
+
+    # The memcache hit should have filled the local cache.
+    self.assertEqual({1: 2, 2: 4}, Foo([1, 2]))
+    self.assertEqual(1, self.call_mock.call_count)
+    self.assertEqual(2, Foo.stats.local_hits)
+    self.assertEqual(2, Foo.stats.memcache_hits)
+
+  def testMissingNotCached(self):
+
+    @memcache_decorator.CachedMulti()
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    self.assertEqual({1: 2}, Foo([1, 3]))
+    self.assertEqual({1: 2}, Foo([1, 3]))
+    self.call_mock.assert_has_calls([mock.call([1, 3]), mock.call([3])])
+
+  def testNegativeCaching(self):
+
+    @memcache_decorator.CachedMulti(negative_expire_time=60)
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    self.assertEqual({1: 2}, Foo([1, 3]))
+    self.assertEqual({1: 2}, Foo([1, 3]))
+    self.assertEqual(1, self.call_mock.call_count)
+
+  def testDeleteCache(self):
+
+    @memcache_decorator.CachedMulti(local_cache_size=10)
+    def Foo(ids):
+      return self.call_mock(ids)
+
+    Foo([1, 2])
+    Foo.DeleteCache([2])
+    Foo([1, 2])
+
+    self.call_mock.assert_has_calls([mock.call([1, 2]), mock.call([2])])
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -45,6 +45,8 @@ from google.appengine.runtime import request_environment
 from google.appengine.runtime import runtime
 from absl.testing import absltest
 
+from common import memcache_decorator
+
 
 from google.appengine.api.search import simple_search_stub
 
@@ -95,6 +97,7 @@ class AppEngineTestCase(absltest.TestCase):
 
     # Each time setUp is called, treat it like a different request to a
     # different app instance.
+    memcache_decorator.ClearLocalCaches()
     request_id_hash = ''.join(random.sample(string.letters + string.digits, 26))
     instance_id = ''.join(random.sample(string.letters + string.digits, 26))
     # More like the production environment: "testbed-version.123123123", rather
@@ -0,0 +1,174 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Destinations that buffered BigQuery table rows can be written to."""
+
+import datetime
+import gzip
+import httplib
+import io
+import json
+import logging
+import os
+import urllib
+import uuid
+
+# pylint: disable=g-import-not-at-top
+try:
+  from google.appengine.api import app_identity
+except ImportError:
+  app_identity = None
+
+from google.appengine.api import urlfetch
+from upvote.gae.utils import env_utils
+
+
+_CLOUD_STORAGE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+_CLOUD_STORAGE_UPLOAD_URL = (
+    'https://www.googleapis.com/upload/storage/v1/b/%s/o?uploadType=media&'
+    'name=%s')
+
+
+class Error(Exception):
+  """Base Exception class."""
+
+
+class WriteError(Error):
+  """Raised when rows could not be written to a sink."""
+
+
+class Sink(object):
+  """The base class for destinations of BigQuery table rows.
+
+  Attributes:
+    NAME: str, A unique name for the sink, used to tag the rows buffered for it.
+    batch_size: int, The maximum number of rows to write at a time.
+  """
+  NAME = None
+  batch_size = None
+
+  def IsEnabled(self):
+    """Returns whether rows should currently be buffered for this sink."""
+    raise NotImplementedError
+
+  def Write(self, table, row_dicts):
+    """Writes a batch of rows.
+
+    Args:
+      table: The BigQueryTable the rows belong to.
+      row_dicts: A list of dicts representing the rows to be written.
+
+    Raises:
+      Error: if the rows could not be written, so they should be retried.
+    """
+    raise NotImplementedError
+
+
+def _JsonDefault(v):
+  if isinstance(v, datetime.datetime):
+    # A format which BigQuery load jobs accept for TIMESTAMP columns.
+    return v.strftime('%Y-%m-%d %H:%M:%S.%f')
+  raise TypeError('%r is not JSON serializable' % v)
+
+
+def _ToCompressedNdjson(row_dicts):
+  """Serializes rows as gzipped newline-delimited JSON."""
+  buf = io.BytesIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+    for row_dict in row_dicts:
+      gzip_file.write(json.dumps(row_dict, default=_JsonDefault, sort_keys=True))
+      gzip_file.write('\n')
+  return buf.getvalue()
+
+
+def _UploadToCloudStorage(bucket, object_name, content):
+  """Uploads a gzipped file to Cloud Storage.
+
+  Args:
+    bucket: str, The name of the bucket to upload to.
+    object_name: str, The name of the object to create.
+    content: str, The contents of the file.
+
+  Raises:
+    WriteError: if the upload failed.
+  """
+  access_token, _ = app_identity.get_access_token(_CLOUD_STORAGE_SCOPE)
+  url = _CLOUD_STORAGE_UPLOAD_URL % (bucket, urllib.quote(object_name, ''))
+  headers = {
+      'Content-Type': 'application/gzip',
+      'Authorization': 'Bearer ' + access_token
+  }
+
+  try:
+    result = urlfetch.fetch(
+        url=url,
+        payload=content,
+        method=urlfetch.POST,
+        deadline=60,
+        headers=headers)
+  except urlfetch.Error as e:
+    raise WriteError('Upload of %s failed: %s' % (object_name, e))
+
+  if result.status_code != httplib.OK:
+    raise WriteError('Upload of %s failed with status %d: %s' % (
+        object_name, result.status_code, result.content))
+
+
+def _WriteLocalFile(path, content):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with open(path, 'wb') as f:
+    f.write(content)
+
+
+class FileSink(Sink):
+  """Writes rows to compressed, time-partitioned NDJSON files.
+
+  Each batch is written to its own file, so files are never appended to. The
+  files are laid out so that a partition can be bulk loaded into BigQuery with
+  a wildcard, e.g. gs://bucket/upvote/Execution/dt=2018-01-01/*:
+
+    <ANALYTICS_FILE_PATH>/<table>/dt=<YYYY-MM-DD>/hour=<HH>/<time>-<id>.json.gz
+
+  ANALYTICS_FILE_PATH is either a gs://<bucket>/<prefix> Cloud Storage path, or
+  a local directory for use with the development server.
+  """
+  NAME = 'file'
+
+  # Loading is cheapest with a few large files, rather than many small ones.
+  batch_size = 10000
+
+  def IsEnabled(self):
+    return bool(env_utils.ENV.ANALYTICS_FILE_PATH)
+
+  def Write(self, table, row_dicts):
+    now = datetime.datetime.utcnow()
+    relative_path = '%s/dt=%s/hour=%02d/%s-%s.json.gz' % (
+        table.name, now.strftime('%Y-%m-%d'), now.hour,
+        now.strftime('%H%M%S'), uuid.uuid4().hex)
+    content = _ToCompressedNdjson(row_dicts)
+
+    root = env_utils.ENV.ANALYTICS_FILE_PATH.rstrip('/')
+    if root.startswith('gs://'):
+      bucket, _, prefix = root[len('gs://'):].partition('/')
+      object_name = '%s/%s' % (prefix, relative_path) if prefix else (
+          relative_path)
+      _UploadToCloudStorage(bucket, object_name, content)
+    else:
+      _WriteLocalFile(os.path.join(root, relative_path), content)
+
+    logging.info(
+        'Wrote %d row(s) for the %s table to %s', len(row_dicts), table.name,
+        relative_path)
@@ -0,0 +1,108 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for sinks.py."""
+
+import datetime
+import gzip
+import httplib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from upvote.gae import settings
+from upvote.gae.bigquery import sinks
+from upvote.gae.lib.testing import basetest
+
+
+_TABLE = mock.Mock()
+_TABLE.name = 'Vote'
+
+_ROWS = [
+    {'sha256': 'a' * 64, 'timestamp': datetime.datetime(2018, 1, 2, 3, 4, 5)},
+    {'sha256': 'b' * 64, 'timestamp': datetime.datetime(2018, 1, 2, 3, 4, 6)}]
+
+
+def _Decompress(content):
+  with gzip.GzipFile(fileobj=io.BytesIO(content), mode='rb') as gzip_file:
+    return [json.loads(line) for line in gzip_file.read().splitlines()]
+
+
+class FileSinkTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(FileSinkTest, self).setUp()
+    self.sink = sinks.FileSink()
+
+  def testIsEnabled(self):
+    self.assertFalse(self.sink.IsEnabled())
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH='gs://bucket')
+    self.assertTrue(self.sink.IsEnabled())
+
+  def testWrite_Local(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH=root)
+
+    self.sink.Write(_TABLE, _ROWS)
+
+    paths = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root) for filename in filenames]
+    self.assertLen(paths, 1)
+    relative_path = os.path.relpath(paths[0], root)
+    self.assertRegexpMatches(
+        relative_path, r'^Vote/dt=\d{4}-\d{2}-\d{2}/hour=\d{2}/.*\.json\.gz$')
+
+    with open(paths[0], 'rb') as f:
+      rows = _Decompress(f.read())
+    self.assertEqual(
+        [{'sha256': 'a' * 64, 'timestamp': '2018-01-02 03:04:05.000000'},
+         {'sha256': 'b' * 64, 'timestamp': '2018-01-02 03:04:06.000000'}],
+        rows)
+
+  def testWrite_CloudStorage(self):
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH='gs://bucket/prefix/')
+    self.Patch(
+        sinks.app_identity, 'get_access_token', return_value=('token', None))
+    mock_fetch = self.Patch(
+        sinks.urlfetch, 'fetch', return_value=mock.Mock(status_code=httplib.OK))
+
+    self.sink.Write(_TABLE, _ROWS)
+
+    mock_fetch.assert_called_once()
+    kwargs = mock_fetch.call_args[1]
+    self.assertIn('/b/bucket/o?', kwargs['url'])
+    self.assertIn('name=prefix%2FVote%2Fdt%3D', kwargs['url'])
+    self.assertEqual('Bearer token', kwargs['headers']['Authorization'])
+    self.assertLen(_Decompress(kwargs['payload']), 2)
+
+  def testWrite_CloudStorage_Error(self):
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH='gs://bucket')
+    self.Patch(
+        sinks.app_identity, 'get_access_token', return_value=('token', None))
+    self.Patch(
+        sinks.urlfetch, 'fetch',
+        return_value=mock.Mock(status_code=httplib.FORBIDDEN, content='Nope'))
+
+    with self.assertRaises(sinks.WriteError):
+      self.sink.Write(_TABLE, _ROWS)
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -12,12 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Representations of the BigQuery tables Upvote streams to."""
+"""Representations of the BigQuery tables Upvote streams to.
+
+Rows aren't streamed to BigQuery as they're inserted. Instead, each row is
+buffered as a task in the bigquery-rows pull queue, tagged with its table. A
+flush task, scheduled once per short window, then leases the buffered rows a
+table at a time and streams them in batches of up to _MAX_ROWS_PER_INSERT.
+Rows which fail to be streamed are left leased, and are retried once their
+lease expires. If a table turns out to be missing, it's provisioned by a
+separate task rather than by the flush task waiting on it.
+
+Rows can also be written to other sinks, such as the compressed files written
+by sinks.FileSink, which are far cheaper to bulk load than rows are to stream.
+A row is buffered separately for each sink that's enabled, so that a failure
+to write to one doesn't cause duplicate rows to be written to another.
+"""
 
 import collections
 import datetime
 import hashlib
 import logging
+import pickle
+import threading
 import time
 
 import upvote.gae.lib.cloud.google_cloud_lib_fixer  # pylint: disable=unused-import
@@ -25,12 +41,14 @@ import upvote.gae.lib.cloud.google_cloud_lib_fixer  # pylint: disable=unused-imp
 from google.cloud import bigquery
 from google.cloud import exceptions
 
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from upvote.gae.bigquery import monitoring
+from upvote.gae.bigquery import sinks
 from upvote.gae.utils import env_utils
+from upvote.gae.utils import time_utils
 from upvote.shared import constants
 
 
@@ -46,6 +64,36 @@ FIELD_TYPE_MAP = {
 
 MODE = constants.UppercaseNamespace(['NULLABLE', 'REPEATED', 'REQUIRED'])
 
+# The maximum number of rows streamed to BigQuery in a single request.
+_MAX_ROWS_PER_INSERT = 500
+
+# The maximum number of buffered rows which can be leased at a time.
+_MAX_ROWS_PER_LEASE = 1000
+
+# How long, in seconds, buffered rows are leased for while being streamed.
+_ROW_LEASE_SECONDS = 300
+
+# The window, in seconds, over which buffered rows are flushed by a single task.
+_FLUSH_INTERVAL = 10
+
+# The amount of time a flush task runs for before handing off to a new one.
+_FLUSH_DURATION = datetime.timedelta(minutes=9)
+
+# How long, in seconds, to hold off streaming to a table after finding it
+# missing, while it's provisioned.
+_TABLE_NOT_READY_SECONDS = 120
+
+# The last flush window for which this instance scheduled a flush task.
+_last_flush_window = None
+
+# The tables this instance has found to be missing, mapped to the time at which
+# streaming to them should be attempted again.
+_unready_tables = {}
+
+# Holds the BigQuery client of each instance thread, along with the rows waiting
+# on the transaction the thread is in, if any.
+_local = threading.local()
+
 
 Column = collections.namedtuple(
     'Column', ['name', 'field_type', 'mode', 'choices'])
@@ -84,13 +132,24 @@ class StreamingFailureError(Error):
   """Raised when the BigQuery client returns an error while streaming a row."""
 
 
-def _Sleep(mins):
-  """Calls time.sleep(). Exists solely for better unit testing.
+class TableNotReadyError(StreamingFailureError):
+  """Raised when streaming to a table which is still being provisioned."""
 
-  Args:
-    mins: The number of minutes to sleep().
+
+def _GetClient():
+  """Returns the BigQuery client for the current thread, creating it if needed.
+
+  Creating a client is relatively expensive, so each instance thread keeps its
+  own to reuse across requests.
+
+  Returns:
+    A bigquery.Client.
   """
-  time.sleep(mins * 60)
+  client = getattr(_local, 'client', None)
+  if client is None:
+    client = bigquery.Client()
+    _local.client = client
+  return client
 
 
 def _RowValueToStr(v):
@@ -110,8 +169,8 @@ def _RowValueToStr(v):
     return str(v)
 
 
-def _SendToBigQuery(table, row_dict):
-  """Sends a row to BigQuery.
+def _SendToBigQuery(table, row_dicts):
+  """Sends a batch of rows to BigQuery.
 
   For a reference of the possible errors that the BigQuery API can return, see:
   https://cloud.google.com/bigquery/troubleshooting-errors#errortable
@@ -121,73 +180,35 @@ def _SendToBigQuery(table, row_dict):
 
   Args:
     table: The BigQueryTable object doing the sending.
-    row_dict: A dict representing the row to be sent.
+    row_dicts: A list of dicts representing the rows to be sent.
 
   Raises:
-    StreamingFailureError: if the row could not be sent to BigQuery.
+    TableNotReadyError: if the table is still being provisioned.
+    StreamingFailureError: if the rows could not be sent to BigQuery.
   """
-  client = bigquery.Client()
-
-  # Attempt the initial row insertion.
+  # If the table was recently found to be missing, don't bother trying again
+  # until it's had a chance to be provisioned.
+  retry_time = _unready_tables.get(table.name)
+  if retry_time is not None and time.time() < retry_time:
+    raise TableNotReadyError('Table "%s" is not ready yet' % table.name)
+
+  client = _GetClient()
+  table_ref = client.dataset(constants.BIGQUERY_DATASET).table(table.name)
+  row_ids = [table.CreateUniqueId(**row_dict) for row_dict in row_dicts]
+
+  # If we get a 404, have the dataset and table created in the background
+  # rather than waiting around for them here. The rows will be retried once
+  # their lease expires.
   try:
-    dataset_ref = client.dataset(constants.BIGQUERY_DATASET)
-    table_ref = dataset_ref.table(table.name)
-    schema = table.schema
-    row_id = table.CreateUniqueId(**row_dict)
     errors = client.insert_rows(
-        table_ref, [row_dict], selected_fields=schema, row_ids=[row_id])
-
-  # If we get a 404, ensure the dataset and table exist, then try again.
+        table_ref, row_dicts, selected_fields=table.schema, row_ids=row_ids)
   except exceptions.NotFound:
+    logging.warning('Table "%s" was not found', table.name)
+    _unready_tables[table.name] = time.time() + _TABLE_NOT_READY_SECONDS
+    _ScheduleProvisioning(table.name)
+    raise TableNotReadyError('Table "%s" is not ready yet' % table.name)
 
-    # See if the destination dataset exists.
-    try:
-      client.get_dataset(dataset_ref)
-      logging.info('Dataset "%s" exists', constants.BIGQUERY_DATASET)
-
-    # If it doesn't, then try to create it. We're probably racing against other
-    # rows, so just ignore 409s.
-    except exceptions.NotFound:
-      logging.info('Creating dataset "%s"', constants.BIGQUERY_DATASET)
-      try:
-        client.create_dataset(bigquery.Dataset(dataset_ref))
-      except exceptions.Conflict:
-        logging.info(
-            'Dataset "%s" was already created', constants.BIGQUERY_DATASET)
-      else:
-        logging.info('Dataset "%s" created', constants.BIGQUERY_DATASET)
-
-    # See if the destination table exists.
-    try:
-      client.get_table(table_ref)
-      logging.info('Table "%s" exists', table.name)
-
-    # If it doesn't, then try to create it. We're probably racing against other
-    # rows, so just ignore 409s.
-    except exceptions.NotFound:
-      logging.info('Creating table "%s"', table.name)
-      try:
-        client.create_table(bigquery.Table(table_ref, schema=schema))
-      except exceptions.Conflict:
-        logging.info('Table "%s" has already been created', table.name)
-      else:
-        logging.info('Table "%s" successfully created', table.name)
-
-    # Attempt the row insertion again. Apparently insertion 404s are cached
-    # until the table creation fully propagates, so attempt the insertion a few
-    # times with increasing delays before giving up and letting the taskqueue
-    # retry it.
-    for mins in xrange(1, 6):
-      logging.info(
-          'Waiting %dm for table "%s" to be ready', mins, table.name)
-      _Sleep(mins)
-      try:
-        errors = client.insert_rows(
-            table_ref, [row_dict], selected_fields=schema, row_ids=[row_id])
-      except exceptions.NotFound:
-        logging.info('Table "%s" is still not ready', table.name)
-      else:
-        break
+  _unready_tables.pop(table.name, None)
 
   # If the client returns errors, raise a StreamingFailureError.
   if errors:
@@ -196,15 +217,289 @@ def _SendToBigQuery(table, row_dict):
     logging.error(msg)
     raise StreamingFailureError(msg)
 
-  logging.info('Successfully streamed row to "%s" table', table.name)
+  logging.info(
+      'Successfully streamed %d row(s) to "%s" table', len(row_dicts),
+      table.name)
+
+
+def _ScheduleProvisioning(table_name):
+  # Only provision each table once in a while, no matter how many instances
+  # find it missing in the meantime.
+  window = int(time.time()) // _TABLE_NOT_READY_SECONDS
+  try:
+    deferred.defer(
+        _ProvisionTable, table_name,
+        _name='provision-%s-%d' % (table_name, window),
+        _queue=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _ProvisionTable(table_name):
+  """Ensures the dataset and a table exist in BigQuery.
+
+  Args:
+    table_name: str, The name of the table to provision.
+  """
+  table = _TABLE_MAP[table_name]
+  client = _GetClient()
+  dataset_ref = client.dataset(constants.BIGQUERY_DATASET)
+  table_ref = dataset_ref.table(table.name)
+
+  # See if the destination dataset exists.
+  try:
+    client.get_dataset(dataset_ref)
+    logging.info('Dataset "%s" exists', constants.BIGQUERY_DATASET)
+
+  # If it doesn't, then try to create it. We're probably racing against other
+  # tables, so just ignore 409s.
+  except exceptions.NotFound:
+    logging.info('Creating dataset "%s"', constants.BIGQUERY_DATASET)
+    try:
+      client.create_dataset(bigquery.Dataset(dataset_ref))
+    except exceptions.Conflict:
+      logging.info(
+          'Dataset "%s" was already created', constants.BIGQUERY_DATASET)
+    else:
+      logging.info('Dataset "%s" created', constants.BIGQUERY_DATASET)
+
+  # See if the destination table exists.
+  try:
+    client.get_table(table_ref)
+    logging.info('Table "%s" exists', table.name)
+
+  # If it doesn't, then try to create it. Insertion 404s are cached until the
+  # table creation fully propagates, but there's no need to wait for that here,
+  # since the rows will be retried long after.
+  except exceptions.NotFound:
+    logging.info('Creating table "%s"', table.name)
+    try:
+      client.create_table(bigquery.Table(table_ref, schema=table.schema))
+    except exceptions.Conflict:
+      logging.info('Table "%s" has already been created', table.name)
+    else:
+      logging.info('Table "%s" successfully created', table.name)
+
+
+class BigQueryStreamingSink(sinks.Sink):
+  """Streams rows into BigQuery."""
+  NAME = 'bigquery'
+
+  @property
+  def batch_size(self):
+    return _MAX_ROWS_PER_INSERT
+
+  def IsEnabled(self):
+    return env_utils.ENV.ENABLE_BIGQUERY_STREAMING
+
+  def Write(self, table, row_dicts):
+    _SendToBigQuery(table, row_dicts)
+
+
+# The sinks that rows are written to, unless a table specifies otherwise.
+_SINKS = [BigQueryStreamingSink(), sinks.FileSink()]
+
+
+def _CreateTag(sink, table):
+  return '%s:%s' % (sink.NAME, table.name)
+
+
+def _ParseTag(tag):
+  """Returns the names of the sink and table a buffered row is tagged with."""
+  sink_name, _, table_name = tag.rpartition(':')
+
+  # Rows buffered before there were multiple sinks are tagged with just the
+  # name of their table.
+  return sink_name or BigQueryStreamingSink.NAME, table_name
+
+
+def _ScheduleFlush():
+  """Ensures a flush task is scheduled for the current window."""
+  global _last_flush_window
+
+  window = int(time.time()) // _FLUSH_INTERVAL
+  if window == _last_flush_window:
+    return
+
+  try:
+    deferred.defer(
+        _FlushRows, _name='flush-%d' % window, _countdown=_FLUSH_INTERVAL,
+        _queue=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+  _last_flush_window = window
+
+
+def _EnqueueRows(tasks):
+  """Adds buffered rows to the row queue, and ensures they'll be flushed."""
+  queue = taskqueue.Queue(constants.TASK_QUEUE.BIGQUERY_ROWS)
+  for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+  _ScheduleFlush()
+
+
+def _BufferUntilCommit(tasks):
+  """Holds rows inserted in a transaction until it commits.
+
+  A transaction which is retried gets a new context for each attempt, so rows
+  inserted by attempts which fail are simply never enqueued. This also means
+  all of a transaction's rows can be enqueued with a single RPC.
+
+  Args:
+    tasks: list<taskqueue.Task>, The buffered rows to enqueue.
+  """
+  context = ndb.get_context()
+  pending = getattr(_local, 'pending_rows', None)
+  if pending is None or pending[0] is not context:
+    pending = (context, [])
+    _local.pending_rows = pending
+
+    def _Enqueue():
+      _local.pending_rows = None
+      _EnqueueRows(pending[1])
+
+    context.call_on_commit(_Enqueue)
+
+  pending[1].extend(tasks)
+
+
+def _FlushRows():
+  """Writes buffered rows to their sinks, a table at a time.
+
+  Rows left over when time runs out are handed off to a new task, unless this
+  one is going to be retried anyway.
+
+  Raises:
+    StreamingFailureError: if any rows failed to be written, so that the task
+        is retried.
+  """
+  queue = taskqueue.Queue(constants.TASK_QUEUE.BIGQUERY_ROWS)
+  start_time = time_utils.Now()
+  failed_tags = set()
+
+  while time_utils.TimeRemains(start_time, _FLUSH_DURATION):
+
+    # Lease the oldest rows, along with others destined for the same table and
+    # sink.
+    tasks = queue.lease_tasks_by_tag(
+        _ROW_LEASE_SECONDS, _MAX_ROWS_PER_INSERT)
+    if not tasks:
+      break
+
+    tag = tasks[0].tag
+    sink_name, table_name = _ParseTag(tag)
+    table = _TABLE_MAP[table_name]
+    sink = table.GetSink(sink_name)
+
+    # Some sinks write larger batches than BigQuery will accept, so top those
+    # up with more of the same rows.
+    while len(tasks) < sink.batch_size:
+      more_tasks = queue.lease_tasks_by_tag(
+          _ROW_LEASE_SECONDS,
+          min(_MAX_ROWS_PER_LEASE, sink.batch_size - len(tasks)), tag=tag)
+      if not more_tasks:
+        break
+      tasks.extend(more_tasks)
+
+    # If the sink has been disabled since the rows were buffered, drop them as
+    # they would have been if it had been disabled all along.
+    if not sink.IsEnabled():
+      logging.warning(
+          'Dropping %d row(s) for the %s table, since the %s sink is disabled',
+          len(tasks), table_name, sink_name)
+      queue.delete_tasks(tasks)
+      continue
+
+    rows = [pickle.loads(task.payload)[1] for task in tasks]
+    try:
+      sink.Write(table, rows)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception(
+          'Error encountered while writing %d row(s) for the %s table to the '
+          '%s sink', len(rows), table_name, sink_name)
+      monitoring.row_insertions.IncrementBy(len(rows), 'Failure')
+      failed_tags.add(tag)
+
+      # Leave the rows leased, so they're retried once the lease expires.
+      continue
+
+    queue.delete_tasks(tasks)
+    monitoring.row_insertions.IncrementBy(len(rows), 'Success')
+
+  else:
+    # Hand off whatever is left to a new task. A failed run is retried instead,
+    # so handing off as well would leave two tasks flushing the same rows.
+    if not failed_tags:
+      deferred.defer(
+          _FlushRows, _queue=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  if failed_tags:
+    raise StreamingFailureError(
+        'Failed to write rows to: %s' % ', '.join(sorted(failed_tags)))
+
+
+def _CompileColumnCheck(column):
+  """Compiles a predicate for whether a value is valid for a column.
+
+  The predicate only needs to be fast for valid values. Rows containing invalid
+  ones are diagnosed by BigQueryTable._DiagnoseInsertion().
+
+  Args:
+    column: The Column to compile a predicate for.
+
+  Returns:
+    A function which takes a value and returns whether it's valid.
+  """
+  expected_types = frozenset(FIELD_TYPE_MAP[column.field_type])
+  choices = frozenset(column.choices) if column.choices else None
+
+  if column.mode == MODE.REQUIRED:
+    if choices is None:
+      return lambda v: type(v) in expected_types
+    return lambda v: type(v) in expected_types and v in choices
+
+  elif column.mode == MODE.REPEATED:
+    if choices is None:
+      return lambda v: (  # pylint: disable=g-long-lambda
+          type(v) is list and all(type(i) in expected_types for i in v))
+    return lambda v: (  # pylint: disable=g-long-lambda
+        type(v) is list and
+        all(type(i) in expected_types and i in choices for i in v))
+
+  # NULLABLE values aren't type checked, so they may not be hashable.
+  elif column.choices:
+    return lambda v: v in column.choices
+  else:
+    return lambda v: True
 
 
 class BigQueryTable(object):
   """Base class for all Upvote BigQuery table definitions."""
 
-  def __init__(self, name, columns):
+  def __init__(self, name, columns, table_sinks=None):
+    """Constructor.
+
+    Args:
+      name: str, The name of the table.
+      columns: list<Column>, The columns of the table.
+      table_sinks: list<sinks.Sink>, The sinks that rows are written to. If not
+          provided, the default sinks are used.
+    """
     self._name = name
     self._columns = columns
+    self._sinks = table_sinks
+
+    # Rows are validated every time one is inserted, so do as much of the work
+    # as possible up front.
+    self._schema = [
+        bigquery.SchemaField(column.name, column.field_type, mode=column.mode)
+        for column in columns]
+    self._column_map = {column.name: column for column in columns}
+    self._column_names = frozenset(self._column_map)
+    self._required_names = frozenset(
+        column.name for column in columns if column.mode == MODE.REQUIRED)
+    self._column_checks = {
+        column.name: _CompileColumnCheck(column) for column in columns}
 
   @property
   def name(self):
@@ -212,9 +507,25 @@ class BigQueryTable(object):
 
   @property
   def schema(self):
-    return [
-        bigquery.SchemaField(column.name, column.field_type, mode=column.mode)
-        for column in self._columns]
+    return list(self._schema)
+
+  @property
+  def sinks(self):
+    return _SINKS if self._sinks is None else self._sinks
+
+  def GetSink(self, sink_name):
+    """Returns the sink of this table with the given name.
+
+    Args:
+      sink_name: str, The NAME of the sink.
+
+    Raises:
+      KeyError: if this table doesn't write to such a sink.
+    """
+    for sink in self.sinks:
+      if sink.NAME == sink_name:
+        return sink
+    raise KeyError(sink_name)
 
   def _ValidateInsertion(self, **kwargs):
     """Verifies that the row can be inserted into the target table.
@@ -235,23 +546,38 @@ class BigQueryTable(object):
       InvalidTypeError: if an invalid type is provided for a column.
       InvalidValueError: if an invalid value is provided for a column.
     """
-    column_map = {c.name: c for c in self._columns}
+    # Nearly every row is valid, which is quicker to confirm than it is to work
+    # out what's wrong with an invalid one.
+    column_checks = self._column_checks
+    if (kwargs.viewkeys() <= self._column_names and
+        self._required_names <= kwargs.viewkeys() and
+        all(column_checks[k](v) for k, v in kwargs.iteritems())):
+      return
+
+    self._DiagnoseInsertion(kwargs)
 
+  def _DiagnoseInsertion(self, row):
+    """Raises the appropriate exception for a row which failed validation.
+
+    Args:
+      row: dict, The row being inserted.
+
+    Raises:
+      See _ValidateInsertion().
+    """
     # Verify that no unexpected columns are passed in.
-    unexpected_columns = set(kwargs.keys()) - {c.name for c in self._columns}
+    unexpected_columns = row.viewkeys() - self._column_names
     if unexpected_columns:
       raise UnexpectedColumnError(sorted(list(unexpected_columns)))
 
     # Verify that all REQUIRED columns are present.
-    required_columns = {
-        c.name for c in self._columns if c.mode == MODE.REQUIRED}
-    missing_columns = required_columns - set(kwargs.keys())
+    missing_columns = self._required_names - row.viewkeys()
     if missing_columns:
       raise MissingColumnError(sorted(list(missing_columns)))
 
-    for k, v in kwargs.iteritems():
+    for k, v in row.iteritems():
 
-      column = column_map[k]
+      column = self._column_map[k]
       expected_types = FIELD_TYPE_MAP[column.field_type]
 
       # Verify that all non-NULLABLE columns have values.
@@ -304,56 +630,50 @@ class BigQueryTable(object):
     row_str = '|'.join(row_values)
     return hashlib.sha256(row_str).hexdigest()
 
-  def _DoInsertRow(self, **kwargs):
-    """Performs the actual BigQuery row insertion.
+  def InsertRow(self, **kwargs):
+    """Buffers a row to be written to each enabled sink of this table.
 
     Args:
-      **kwargs: The kwargs that InsertRow() is called with, representing the
-          individual values of this particular row.
+      **kwargs: Key/value pairs which correspond to the row being inserted.
     """
-    logging.info('Inserting row into the %s table: %s', self.name, kwargs)
-    try:
+    enabled_sinks = [sink for sink in self.sinks if sink.IsEnabled()]
+    if not enabled_sinks:
+      logging.info('Skipping row for BigQuery %s table', self.name)
+      return
 
+    logging.info('Buffering row for the %s table: %s', self.name, kwargs)
+    try:
       self._ValidateInsertion(**kwargs)
+    except Error:
+      # An invalid row would never be accepted by BigQuery, so don't hold up
+      # the rest of its batch with it.
+      logging.exception('Dropping invalid row for the %s table', self.name)
+      monitoring.row_insertions.Failure()
+      return
 
-      # If this is being called within a transaction, make a reasonable attempt
-      # to avoid inserting 'duplicate' rows that only differ due to a miniscule
-      # difference in the 'timestamp' value. This can easily occur if a
-      # transaction retries, and uses something like datetime.datetime.utcnow()
-      # to populate the 'timestamp' value.
-      if ndb.in_transaction() and 'timestamp' in kwargs:
-
-        # Create a unique identifier based on all columns except 'timestamp'.
-        memcache_key = self.CreateUniqueId(
-            **{k: v for k, v in kwargs.iteritems() if k != 'timestamp'})
+    payload = pickle.dumps((self.name, kwargs))
+    tasks = [
+        taskqueue.Task(
+            payload=payload, method='PULL', tag=_CreateTag(sink, self))
+        for sink in enabled_sinks]
 
-        # If the key is already in memcache despite the extremely short timeout,
-        # this is likely a repeat insertion due to a retry, so skip it.
-        if memcache.get(memcache_key):
-          logging.info('Skipping row due to likely transaction retry')
-          return
+    if ndb.in_transaction():
+      _BufferUntilCommit(tasks)
+    else:
+      _EnqueueRows(tasks)
 
-        # Otherwise, set the key as a guard in case this transaction retries.
-        else:
-          memcache.set(memcache_key, True, time=5)
+  def _DoInsertRow(self, **kwargs):
+    """Buffers a row from a task deferred by the previous release.
 
-      _SendToBigQuery(self, kwargs)
-      monitoring.row_insertions.Success()
+    Rows used to be streamed by deferring this method, and such tasks may still
+    be in the bigquery-streaming queue when this release is deployed. Tables
+    unpickled from them only have the attributes of that release, so the row is
+    handed to the current table of the same name. Remove once they've drained.
 
-    except Exception:  # pylint: disable=broad-except
-      logging.exception(
-          'Error encountered while inserting row into the %s table', self.name)
-      monitoring.row_insertions.Failure()
-      raise  # Must re-raise in order to trigger a retry.
-
-  def InsertRow(self, **kwargs):
-    if env_utils.ENV.ENABLE_BIGQUERY_STREAMING:
-      logging.info('Sending a row to BigQuery %s table', self.name)
-      deferred.defer(
-          self._DoInsertRow, _queue=constants.TASK_QUEUE.BIGQUERY_STREAMING,
-          **kwargs)
-    else:
-      logging.info('Skipping row for BigQuery %s table', self.name)
+    Args:
+      **kwargs: Key/value pairs which correspond to the row being inserted.
+    """
+    _TABLE_MAP[self.name].InsertRow(**kwargs)
 
 
 BINARY = BigQueryTable(
@@ -484,3 +804,9 @@ RULE = BigQueryTable(
         Column(name='device_id', mode=MODE.NULLABLE),  # NULLABLE b/c of globals
         Column(name='user', mode=MODE.NULLABLE),  # NULLABLE b/c of globals
         Column(name='comment', mode=MODE.NULLABLE)])
+
+
+_TABLE_MAP = {
+    table.name: table for table in [
+        BINARY, BUNDLE, BUNDLE_BINARY, CERTIFICATE, EXECUTION, EXEMPTION, HOST,
+        USER, VOTE, RULE]}
@@ -0,0 +1,151 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of BigQuery row validation.
+
+Compares the validators and schemas which each BigQueryTable compiles when it's
+defined against building them for every row, as was done previously.
+
+  bazel run //upvote/gae/bigquery:tables_benchmark -- --benchmark_rows=100000
+"""
+
+import datetime
+import time
+
+import upvote.gae.lib.cloud.google_cloud_lib_fixer  # pylint: disable=unused-import
+# pylint: disable=g-bad-import-order,g-import-not-at-top
+from google.cloud import bigquery
+
+from upvote.gae.bigquery import tables
+from upvote.gae.lib.testing import basetest
+from upvote.shared import constants
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    'benchmark_rows', 20000, 'The number of rows to validate per scenario.')
+
+
+# pylint: disable=protected-access
+def _LegacyValidateInsertion(table, **kwargs):
+  """The per-row validation BigQueryTable._ValidateInsertion() used to do."""
+  column_map = {c.name: c for c in table._columns}
+
+  unexpected_columns = set(kwargs.keys()) - {c.name for c in table._columns}
+  if unexpected_columns:
+    raise tables.UnexpectedColumnError(sorted(list(unexpected_columns)))
+
+  required_columns = {
+      c.name for c in table._columns if c.mode == tables.MODE.REQUIRED}
+  missing_columns = required_columns - set(kwargs.keys())
+  if missing_columns:
+    raise tables.MissingColumnError(sorted(list(missing_columns)))
+
+  for k, v in kwargs.iteritems():
+    column = column_map[k]
+    expected_types = tables.FIELD_TYPE_MAP[column.field_type]
+    if column.mode != tables.MODE.NULLABLE and v is None:
+      raise tables.UnexpectedNullError('Column "%s" is None' % k)
+    if column.mode == tables.MODE.REPEATED and not isinstance(v, list):
+      raise tables.InvalidRepeatedError('Column "%s" is not a list' % k)
+    if column.mode == tables.MODE.REPEATED:
+      for item in v:
+        if type(item) not in expected_types:
+          raise tables.InvalidTypeError(k)
+    if column.mode == tables.MODE.REQUIRED:
+      if type(v) not in expected_types:
+        raise tables.InvalidTypeError(k)
+    if column.choices:
+      v = v if column.mode == tables.MODE.REPEATED else [v]
+      for item in v:
+        if item not in column.choices:
+          raise tables.InvalidValueError(k)
+
+
+def _LegacySchema(table):
+  return [
+      bigquery.SchemaField(column.name, column.field_type, mode=column.mode)
+      for column in table._columns]
+
+
+class TablesBenchmark(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(TablesBenchmark, self).setUp()
+
+    now = datetime.datetime.utcnow()
+    self.rows = [
+        (tables.EXECUTION, {
+            'sha256': 'a' * 64,
+            'device_id': 'device',
+            'timestamp': now,
+            'platform': constants.PLATFORM.MACOS,
+            'client': constants.CLIENT.SANTA,
+            'bundle_path': None,
+            'file_path': '/Applications/Foo.app/Contents/MacOS',
+            'file_name': 'Foo',
+            'executing_user': 'user',
+            'associated_users': ['user', 'other_user'],
+            'decision': constants.EVENT_TYPE.BLOCK_BINARY,
+            'comment': None}),
+        (tables.VOTE, {
+            'sha256': 'b' * 64,
+            'timestamp': now,
+            'upvote': True,
+            'weight': 1,
+            'platform': constants.PLATFORM.WINDOWS,
+            'target_type': constants.RULE_TYPE.BINARY,
+            'voter': 'user'})]
+
+  def _Benchmark(self, scenario, legacy_func, compiled_func):
+    """Times the legacy and compiled versions of func(table, row)."""
+    timings = []
+    for func in (legacy_func, compiled_func):
+      start = time.time()
+      for _ in xrange(FLAGS.benchmark_rows // len(self.rows)):
+        for table, row in self.rows:
+          func(table, row)
+      timings.append(time.time() - start)
+
+    legacy_elapsed, compiled_elapsed = timings
+    logging.info(
+        '%s: %d row(s), legacy %.3fs, compiled %.3fs (%.1fx)', scenario,
+        FLAGS.benchmark_rows, legacy_elapsed, compiled_elapsed,
+        legacy_elapsed / compiled_elapsed if compiled_elapsed else 0)
+
+  def testValidateInsertion(self):
+    self._Benchmark(
+        'Validate insertion',
+        lambda table, row: _LegacyValidateInsertion(table, **row),
+        lambda table, row: table._ValidateInsertion(**row))
+
+  def testSchema(self):
+    self._Benchmark(
+        'Schema',
+        lambda table, _: _LegacySchema(table),
+        lambda table, _: table.schema)
+
+  def testInsertRow(self):
+    self._Benchmark(
+        'Validate insertion and schema',
+        lambda table, row: (  # pylint: disable=g-long-lambda
+            _LegacyValidateInsertion(table, **row), _LegacySchema(table)),
+        lambda table, row: (table._ValidateInsertion(**row), table.schema))
+# pylint: enable=protected-access
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -15,6 +15,8 @@
 """Unit tests for tables.py."""
 
 import datetime
+import threading
+
 import mock
 
 from google.appengine.ext import ndb
@@ -23,6 +25,7 @@ import upvote.gae.lib.cloud.google_cloud_lib_fixer  # pylint: disable=unused-imp
 # pylint: disable=g-bad-import-order,g-import-not-at-top
 from google.cloud import exceptions
 
+from upvote.gae import settings
 from upvote.gae.bigquery import tables
 from upvote.gae.lib.testing import basetest
 from upvote.shared import constants
@@ -63,6 +66,10 @@ TEST_TABLE = tables.BigQueryTable(
     ])
 
 
+class _TestModel(ndb.Model):
+  pass
+
+
 class Error(Exception):
   """Base Exception class."""
 
@@ -99,126 +106,145 @@ class SendToBigQueryTest(basetest.UpvoteTestCase):
     super(SendToBigQueryTest, self).setUp(patch_send_to_bigquery=False)
     self.row_dict = {'aaa': 111, 'bbb': 222, 'ccc': 333}
     self.row_id = TEST_TABLE.CreateUniqueId(**self.row_dict)
-    self.Patch(tables, '_Sleep')
+    self.Patch(tables, '_local', threading.local())
+    self.Patch(tables, '_unready_tables', {})
 
-  def testMissingDataset_Created(self):
+  def testClientReused(self):
 
     mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.side_effect = [exceptions.NotFound('OMG'), []]
-    mock_client.get_dataset.side_effect = exceptions.NotFound('OMG')
-    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
-    self.Patch(tables.bigquery, 'Client', return_value=mock_client)
+    mock_client.insert_rows.return_value = []
+    mock_client_cls = self.Patch(
+        tables.bigquery, 'Client', return_value=mock_client)
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+    tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
+    tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
 
-    insert_rows_call = mock.call(
-        mock.ANY, [self.row_dict], selected_fields=TEST_TABLE.schema,
-        row_ids=[self.row_id])
+    mock_client_cls.assert_called_once()
+    self.assertEqual(2, mock_client.insert_rows.call_count)
 
-    mock_client.insert_rows.assert_has_calls([insert_rows_call] * 2)
-    mock_client.get_dataset.assert_called_once()
-    mock_client.create_dataset.assert_called_once()
-    mock_client.get_table.assert_called_once()
-    mock_client.create_table.assert_called_once()
-
-  def testMissingDataset_Conflict(self):
+  def testMissingTable(self):
 
     mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.side_effect = [exceptions.NotFound('OMG'), []]
-    mock_client.get_dataset.side_effect = exceptions.NotFound('OMG')
-    mock_client.create_dataset.side_effect = exceptions.Conflict('WTF')
-    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
+    mock_client.insert_rows.side_effect = exceptions.NotFound('OMG')
     self.Patch(tables.bigquery, 'Client', return_value=mock_client)
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+    with self.assertRaises(tables.TableNotReadyError):
+      tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_STREAMING, 1)
 
-    insert_rows_call = mock.call(
-        mock.ANY, [self.row_dict], selected_fields=TEST_TABLE.schema,
-        row_ids=[self.row_id])
+    # Subsequent rows shouldn't hit the API until the table has been given a
+    # chance to be provisioned.
+    with self.assertRaises(tables.TableNotReadyError):
+      tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
+    mock_client.insert_rows.assert_called_once()
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_STREAMING, 1)
 
-    mock_client.insert_rows.assert_has_calls([insert_rows_call] * 2)
-    mock_client.get_dataset.assert_called_once()
-    mock_client.create_dataset.assert_called_once()
-    mock_client.get_table.assert_called_once()
+    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
+    self.DrainTaskQueue(constants.TASK_QUEUE.BIGQUERY_STREAMING)
     mock_client.create_table.assert_called_once()
 
-  def testMissingTable_Created(self):
+    # Once the table is ready again, it should be streamed to as normal.
+    mock_client.insert_rows.side_effect = None
+    mock_client.insert_rows.return_value = []
+    tables._unready_tables[TEST_TABLE.name] = 0
+    tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
+    self.assertEqual({}, tables._unready_tables)
+
+  def testClientReturnsErrors(self):
 
     mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.side_effect = [exceptions.NotFound('OMG'), []]
-    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
+    mock_client.insert_rows.return_value = [{'err1': 'xxx'}, {'err2': 'yyy'}]
     self.Patch(tables.bigquery, 'Client', return_value=mock_client)
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+    with self.assertRaises(tables.StreamingFailureError):
+      tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
 
-    insert_rows_call = mock.call(
-        mock.ANY, [self.row_dict], selected_fields=TEST_TABLE.schema,
-        row_ids=[self.row_id])
+  def testSuccess(self):
 
-    mock_client.insert_rows.assert_has_calls([insert_rows_call] * 2)
-    mock_client.get_dataset.assert_called_once()
-    mock_client.create_dataset.assert_not_called()
-    mock_client.get_table.assert_called_once()
-    mock_client.create_table.assert_called_once()
+    mock_client = mock.Mock(spec=tables.bigquery.Client)
+    mock_client.insert_rows.return_value = []
+    self.Patch(tables.bigquery, 'Client', return_value=mock_client)
 
-  def testMissingTable_Conflict(self):
+    tables._SendToBigQuery(TEST_TABLE, [self.row_dict])
+    self.assertTrue(mock_client.insert_rows.called)
+
+  def testBatch(self):
 
     mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.side_effect = [exceptions.NotFound('OMG'), []]
-    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
-    mock_client.create_table.side_effect = exceptions.Conflict('WTF')
+    mock_client.insert_rows.return_value = []
     self.Patch(tables.bigquery, 'Client', return_value=mock_client)
+    other_row_dict = {'aaa': 444, 'bbb': 555, 'ccc': 666}
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+    tables._SendToBigQuery(TEST_TABLE, [self.row_dict, other_row_dict])
 
-    insert_rows_call = mock.call(
-        mock.ANY, [self.row_dict], selected_fields=TEST_TABLE.schema,
-        row_ids=[self.row_id])
+    mock_client.insert_rows.assert_called_once_with(
+        mock.ANY, [self.row_dict, other_row_dict],
+        selected_fields=TEST_TABLE.schema,
+        row_ids=[self.row_id, TEST_TABLE.CreateUniqueId(**other_row_dict)])
 
-    mock_client.insert_rows.assert_has_calls([insert_rows_call] * 2)
-    mock_client.get_dataset.assert_called_once()
-    mock_client.create_dataset.assert_not_called()
-    mock_client.get_table.assert_called_once()
-    mock_client.create_table.assert_called_once()
 
-  def testMissingTable_NotReady(self):
+class ProvisionTableTest(basetest.UpvoteTestCase):
 
-    mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.side_effect = [
-        exceptions.NotFound('OMG'), exceptions.NotFound('OMG'), []]
-    mock_client.get_table.side_effect = exceptions.NotFound('OMG')
-    self.Patch(tables.bigquery, 'Client', return_value=mock_client)
+  def setUp(self):
+    super(ProvisionTableTest, self).setUp()
+    self.Patch(tables, '_local', threading.local())
+    self.mock_client = mock.Mock(spec=tables.bigquery.Client)
+    self.Patch(tables.bigquery, 'Client', return_value=self.mock_client)
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+  def testMissingDataset_Created(self):
 
-    insert_rows_call = mock.call(
-        mock.ANY, [self.row_dict], selected_fields=TEST_TABLE.schema,
-        row_ids=[self.row_id])
+    self.mock_client.get_dataset.side_effect = exceptions.NotFound('OMG')
+    self.mock_client.get_table.side_effect = exceptions.NotFound('OMG')
 
-    mock_client.insert_rows.assert_has_calls([insert_rows_call] * 3)
-    mock_client.get_dataset.assert_called_once()
-    mock_client.create_dataset.assert_not_called()
-    mock_client.get_table.assert_called_once()
-    mock_client.create_table.assert_called_once()
-    tables._Sleep.assert_has_calls([mock.call(1), mock.call(2)])
+    tables._ProvisionTable(constants.BIGQUERY_TABLE.BINARY)
 
-  def testClientReturnsErrors(self):
+    self.mock_client.get_dataset.assert_called_once()
+    self.mock_client.create_dataset.assert_called_once()
+    self.mock_client.get_table.assert_called_once()
+    self.mock_client.create_table.assert_called_once()
 
-    mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.return_value = [{'err1': 'xxx'}, {'err2': 'yyy'}]
-    self.Patch(tables.bigquery, 'Client', return_value=mock_client)
+  def testMissingDataset_Conflict(self):
 
-    with self.assertRaises(tables.StreamingFailureError):
-      tables._SendToBigQuery(TEST_TABLE, self.row_dict)
+    self.mock_client.get_dataset.side_effect = exceptions.NotFound('OMG')
+    self.mock_client.create_dataset.side_effect = exceptions.Conflict('WTF')
+    self.mock_client.get_table.side_effect = exceptions.NotFound('OMG')
 
-  def testSuccess(self):
+    tables._ProvisionTable(constants.BIGQUERY_TABLE.BINARY)
 
-    mock_client = mock.Mock(spec=tables.bigquery.Client)
-    mock_client.insert_rows.return_value = []
-    self.Patch(tables.bigquery, 'Client', return_value=mock_client)
+    self.mock_client.get_dataset.assert_called_once()
+    self.mock_client.create_dataset.assert_called_once()
+    self.mock_client.get_table.assert_called_once()
+    self.mock_client.create_table.assert_called_once()
 
-    tables._SendToBigQuery(TEST_TABLE, self.row_dict)
-    self.assertTrue(mock_client.insert_rows.called)
+  def testMissingTable_Created(self):
+
+    self.mock_client.get_table.side_effect = exceptions.NotFound('OMG')
+
+    tables._ProvisionTable(constants.BIGQUERY_TABLE.BINARY)
+
+    self.mock_client.get_dataset.assert_called_once()
+    self.mock_client.create_dataset.assert_not_called()
+    self.mock_client.get_table.assert_called_once()
+    self.mock_client.create_table.assert_called_once()
+
+  def testMissingTable_Conflict(self):
+
+    self.mock_client.get_table.side_effect = exceptions.NotFound('OMG')
+    self.mock_client.create_table.side_effect = exceptions.Conflict('WTF')
+
+    tables._ProvisionTable(constants.BIGQUERY_TABLE.BINARY)
+
+    self.mock_client.get_dataset.assert_called_once()
+    self.mock_client.create_dataset.assert_not_called()
+    self.mock_client.get_table.assert_called_once()
+    self.mock_client.create_table.assert_called_once()
+
+  def testExists(self):
+
+    tables._ProvisionTable(constants.BIGQUERY_TABLE.BINARY)
+
+    self.mock_client.create_dataset.assert_not_called()
+    self.mock_client.create_table.assert_not_called()
 
 
 class BigQueryTableTest(basetest.UpvoteTestCase):
@@ -232,6 +258,10 @@ class BigQueryTableTest(basetest.UpvoteTestCase):
         [column.name for column in TEST_TABLE._columns],
         [column.name for column in TEST_TABLE.schema])
 
+  def testSchema_Copy(self):
+    TEST_TABLE.schema.pop()
+    self.assertLen(TEST_TABLE.schema, len(TEST_TABLE._columns))
+
   def testValidateInsertion_UnexpectedColumnError(self):
     with self.assertRaises(tables.UnexpectedColumnError):
       TEST_TABLE._ValidateInsertion(aaa=True, bbb=4, omg='OMG')
@@ -264,6 +294,13 @@ class BigQueryTableTest(basetest.UpvoteTestCase):
     with self.assertRaises(tables.InvalidValueError):
       TEST_TABLE._ValidateInsertion(aaa=True, bbb=4, fff=['f1', 'f2', 'xyz'])
 
+  def testValidateInsertion_ListSubclass(self):
+
+    class _List(list):
+      pass
+
+    TEST_TABLE._ValidateInsertion(aaa=True, bbb=4, ccc=_List(['c1']))
+
   def testValidateInsertion_Nullable_Omitted(self):
     TEST_TABLE._ValidateInsertion(aaa=True, bbb=4)
 
@@ -315,59 +352,247 @@ class BigQueryTableTest(basetest.UpvoteTestCase):
         TEST_TABLE.CreateUniqueId(**row_1),
         TEST_TABLE.CreateUniqueId(**row_2))
 
-  def testDoInsertRow_Exception(self):
+  def testInsertRow_Invalid(self):
 
-    self.mock_send_to_bigquery.side_effect = VerySpecificError
+    TEST_TABLE.InsertRow(aaa='blah', bbb=4)
+
+    self.assertTrue(tables.monitoring.row_insertions.Failure.called)
+    self.assertNoBigQueryInsertions()
+
+  def testInsertRow_StreamingDisabled(self):
+
+    self.PatchEnv(settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=False)
+
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+
+    self.assertNoBigQueryInsertions()
+
+  def testInsertRow_SchedulesFlush(self):
+
+    self.Patch(tables, '_last_flush_window', None)
+
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_STREAMING, 1)
+    self.assertBigQueryInsertion(constants.BIGQUERY_TABLE.BINARY)
+
+  def testInsertRow_InsideTransaction(self):
+
+    @ndb.transactional
+    def _Inserts():
+      for bbb in xrange(3):
+        TEST_TABLE.InsertRow(aaa=True, bbb=bbb)
+
+      # Nothing should be enqueued until the transaction commits.
+      self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 0)
+
+    _Inserts()
+
+    self.assertBigQueryInsertions([constants.BIGQUERY_TABLE.BINARY] * 3)
+
+  def testInsertRow_InsideTransaction_RolledBack(self):
+
+    @ndb.transactional
+    def _InsertAndFail():
+      TEST_TABLE.InsertRow(aaa=True, bbb=4)
+      raise VerySpecificError
 
-    now = datetime.datetime.utcnow()
-    row_values = {'aaa': True, 'bbb': 4, 'ccc': ['ccc'], 'ddd': now}
     with self.assertRaises(VerySpecificError):
-      TEST_TABLE._DoInsertRow(**row_values)
+      _InsertAndFail()
 
-    self.assertTrue(tables.monitoring.row_insertions.Failure.called)
-    self.mock_send_to_bigquery.reset_mock()
+    self.assertNoBigQueryInsertions()
 
-  @mock.patch.object(tables.memcache, 'get')
-  def testDoInsertRow_Repeats_InsideTransaction(self, mock_get):
+  def testInsertRow_InsideTransaction_Retried(self):
 
-    attempts = 3
-    mock_get.side_effect = [None] + [True] * (attempts - 1)
+    model_key = _TestModel(id='model').put()
+    attempts = []
 
     @ndb.transactional
-    def _RepeatedInserts():
-      for _ in xrange(attempts):
-        now = datetime.datetime.utcnow()
-        row_values = {'aaa': True, 'bbb': 4, 'timestamp': now}
-        TEST_TABLE._DoInsertRow(**row_values)
+    def _Insert():
+      attempts.append(True)
+      model = model_key.get()
+      now = datetime.datetime.utcnow()
+      TEST_TABLE.InsertRow(aaa=True, bbb=4, timestamp=now)
 
-    _RepeatedInserts()
+      # Modify the entity from another transaction the first time through, so
+      # that this one conflicts and is retried.
+      if len(attempts) == 1:
+        ndb.transaction(
+            _TestModel(key=model_key).put,
+            propagation=ndb.TransactionOptions.INDEPENDENT)
+      model.put()
 
-    self.assertEqual(1, self.mock_send_to_bigquery.call_count)
-    self.assertTrue(tables.monitoring.row_insertions.Success.called)
-    self.mock_send_to_bigquery.reset_mock()
+    _Insert()
+
+    self.assertLen(attempts, 2)
+    self.assertBigQueryInsertion(constants.BIGQUERY_TABLE.BINARY)
 
-  def testDoInsertRow_Repeats_OutsideTransaction(self):
+  def testInsertRow_Repeats_OutsideTransaction(self):
 
     attempts = 3
 
     for _ in xrange(attempts):
       now = datetime.datetime.utcnow()
-      row_values = {'aaa': True, 'bbb': 4, 'timestamp': now}
-      TEST_TABLE._DoInsertRow(**row_values)
+      TEST_TABLE.InsertRow(aaa=True, bbb=4, timestamp=now)
+
+    self.assertBigQueryInsertions([constants.BIGQUERY_TABLE.BINARY] * attempts)
+
+  def testDoInsertRow_PreviousRelease(self):
+
+    self.Patch(
+        tables, '_TABLE_MAP', {constants.BIGQUERY_TABLE.BINARY: TEST_TABLE})
+
+    # A table unpickled from a task deferred by the previous release.
+    old_table = tables.BigQueryTable.__new__(tables.BigQueryTable)
+    old_table.__dict__.update(
+        _name=TEST_TABLE.name, _columns=TEST_TABLE._columns)
+    old_table._DoInsertRow(aaa=True, bbb=4)
 
-    self.assertEqual(attempts, self.mock_send_to_bigquery.call_count)
-    self.assertTrue(tables.monitoring.row_insertions.Success.called)
+    self.assertBigQueryInsertion(constants.BIGQUERY_TABLE.BINARY)
+
+
+class FlushRowsTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(FlushRowsTest, self).setUp()
+    self.Patch(tables.monitoring, 'row_insertions')
+
+  @mock.patch.object(tables, '_MAX_ROWS_PER_INSERT', 2)
+  def testBatchedByTable(self):
+
+    for bbb in xrange(5):
+      TEST_TABLE.InsertRow(aaa=True, bbb=bbb)
+    tables.VOTE.InsertRow(
+        sha256='a' * 64, timestamp=datetime.datetime.utcnow(), upvote=True,
+        weight=1, platform=constants.PLATFORM.MACOS,
+        target_type=constants.RULE_TYPE.BINARY, voter='user')
+
+    tables._FlushRows()
+
+    batches = sorted(
+        (c[0][0].name, len(c[0][1]))
+        for c in self.mock_send_to_bigquery.call_args_list)
+    self.assertEqual([
+        (constants.BIGQUERY_TABLE.BINARY, 1),
+        (constants.BIGQUERY_TABLE.BINARY, 2),
+        (constants.BIGQUERY_TABLE.BINARY, 2),
+        (constants.BIGQUERY_TABLE.VOTE, 1)], batches)
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 0)
     self.mock_send_to_bigquery.reset_mock()
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
 
-  def testDoInsertRow_Success(self):
+  def testFailure(self):
 
-    now = datetime.datetime.utcnow()
-    row_values = {'aaa': True, 'bbb': 4, 'ccc': ['ccc'], 'ddd': now}
-    TEST_TABLE._DoInsertRow(**row_values)
+    self.mock_send_to_bigquery.side_effect = VerySpecificError
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+
+    with self.assertRaises(tables.StreamingFailureError):
+      tables._FlushRows()
+
+    # The row should be left in the buffer to be retried.
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 1)
+    tables.monitoring.row_insertions.IncrementBy.assert_called_once_with(
+        1, 'Failure')
 
-    self.assertTrue(self.mock_send_to_bigquery.called)
-    self.assertTrue(tables.monitoring.row_insertions.Success.called)
     self.mock_send_to_bigquery.reset_mock()
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_ROWS)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  def testHandOff(self):
+
+    self.Patch(
+        tables.time_utils, 'TimeRemains', side_effect=[True, True, False])
+    for bbb in xrange(3):
+      TEST_TABLE.InsertRow(aaa=True, bbb=bbb)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+    with mock.patch.object(tables, '_MAX_ROWS_PER_INSERT', 1):
+      tables._FlushRows()
+
+    # Time ran out with a row left over, so it should be handed off.
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 1)
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_STREAMING, 1)
+
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_ROWS)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  def testHandOff_Failure(self):
+
+    self.mock_send_to_bigquery.side_effect = VerySpecificError
+    self.Patch(tables.time_utils, 'TimeRemains', side_effect=[True, False])
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+    with self.assertRaises(tables.StreamingFailureError):
+      tables._FlushRows()
+
+    # The failed task is retried, so nothing should be handed off.
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_STREAMING, 0)
+
+    self.mock_send_to_bigquery.reset_mock()
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_ROWS)
+
+  def testMultipleSinks(self):
+
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH='gs://bucket')
+    mock_write = self.Patch(tables.sinks.FileSink, 'Write')
+
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 2)
+
+    tables._FlushRows()
+
+    self.assertLen(self.GetBigQueryCalls(), 1)
+    mock_write.assert_called_once_with(tables.BINARY, [{'aaa': True, 'bbb': 4}])
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  @mock.patch.object(tables, '_MAX_ROWS_PER_INSERT', 2)
+  @mock.patch.object(tables, '_MAX_ROWS_PER_LEASE', 2)
+  def testLargerBatches(self):
+
+    self.PatchEnv(
+        settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=False,
+        ANALYTICS_FILE_PATH='gs://bucket')
+    mock_write = self.Patch(tables.sinks.FileSink, 'Write')
+
+    for bbb in xrange(5):
+      TEST_TABLE.InsertRow(aaa=True, bbb=bbb)
+
+    tables._FlushRows()
+
+    mock_write.assert_called_once()
+    self.assertLen(mock_write.call_args[0][1], 5)
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 0)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  def testSinkDisabled(self):
+
+    self.PatchEnv(settings.ProdEnv, ANALYTICS_FILE_PATH='gs://bucket')
+    mock_write = self.Patch(tables.sinks.FileSink, 'Write')
+    TEST_TABLE.InsertRow(aaa=True, bbb=4)
+
+    self.PatchEnv(
+        settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=True,
+        ANALYTICS_FILE_PATH=None)
+    tables._FlushRows()
+
+    self.assertLen(self.GetBigQueryCalls(), 1)
+    mock_write.assert_not_called()
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 0)
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
+
+  def testLegacyTag(self):
+
+    task = tables.taskqueue.Task(
+        payload=tables.pickle.dumps(
+            (constants.BIGQUERY_TABLE.BINARY, {'aaa': True, 'bbb': 4})),
+        method='PULL', tag=constants.BIGQUERY_TABLE.BINARY)
+    tables.taskqueue.Queue(constants.TASK_QUEUE.BIGQUERY_ROWS).add(task)
+
+    tables._FlushRows()
+
+    self.assertLen(self.GetBigQueryCalls(), 1)
+    self.assertTaskCount(constants.TASK_QUEUE.BIGQUERY_ROWS, 0)
 
 
 if __name__ == '__main__':
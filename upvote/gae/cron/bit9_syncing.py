@@ -43,8 +43,10 @@ from upvote.gae.lib.analysis import metrics
 from upvote.gae.lib.bit9 import api
 from upvote.gae.lib.bit9 import change_set
 from upvote.gae.lib.bit9 import constants as bit9_constants
+from upvote.gae.lib.bit9 import mirror
 from upvote.gae.lib.bit9 import monitoring
 from upvote.gae.lib.bit9 import utils as bit9_utils
+from upvote.gae.lib.rules import host_index
 from upvote.gae.taskqueue import utils as taskqueue_utils
 from upvote.gae.utils import handler_utils
 from upvote.gae.utils import time_utils
@@ -75,11 +77,29 @@ _PROCESS_LOCK_TIMEOUT = int(
     datetime.timedelta(minutes=10, seconds=30).total_seconds())
 _PROCESS_LOCK_MAX_ACQUIRE_ATTEMPTS = 1
 
+# The amount of time after a Process task is dispatched for a host during which
+# Dispatch won't dispatch another one. Normally the task clears this itself
+# when it finishes, so this only matters if the task is lost or fails.
+_PROCESS_DISPATCH_LEASE = datetime.timedelta(minutes=15)
+
+# Events pulled for a host within this window before Process started its final
+# scan may not have been visible to that (eventually consistent) scan, so the
+# host is left pending rather than being cleared.
+_PENDING_HOST_GRACE_PERIOD = datetime.timedelta(minutes=1)
+
 _CERT_MEMCACHE_KEY = 'bit9_cert_%s'
 _CERT_MEMCACHE_TIMEOUT = datetime.timedelta(days=7).total_seconds()
 
+# The number of certificates to also hold in each instance, since the same few
+# signing chains are looked up for nearly every event.
+_CERT_LOCAL_CACHE_SIZE = 500
+
 _GET_CERT_ATTEMPTS = 3
 
+# The number of shards over which the _UnsyncedEvent count is spread, so that
+# concurrent Process tasks don't contend on a single counter entity.
+_UNSYNCED_EVENT_COUNT_SHARDS = 20
+
 
 # Done for the sake of brevity.
 _POLICY = constants.RULE_POLICY
@@ -125,6 +145,166 @@ class _UnsyncedEvent(ndb.Model):
         bit9_id=event.id)
 
 
+class _UnsyncedEventCountShard(ndb.Model):
+  """A shard of the running count of outstanding _UnsyncedEvents.
+
+  key = The integer shard index, in [1, _UNSYNCED_EVENT_COUNT_SHARDS].
+
+  Attributes:
+    count: The net number of _UnsyncedEvents added via this shard.
+  """
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _GetUnsyncedEventCountShardKeys():
+  return [
+      ndb.Key(_UnsyncedEventCountShard, shard_id)
+      for shard_id in xrange(1, _UNSYNCED_EVENT_COUNT_SHARDS + 1)]
+
+
+@ndb.transactional
+def _AdjustUnsyncedEventCount(delta):
+  """Adds delta to a randomly-chosen shard of the _UnsyncedEvent count."""
+  key = random.choice(_GetUnsyncedEventCountShardKeys())
+  shard = key.get() or _UnsyncedEventCountShard(key=key)
+  shard.count += delta
+  shard.put()
+
+
+def _GetUnsyncedEventCount():
+  """Returns the maintained count of outstanding _UnsyncedEvents."""
+  shards = ndb.get_multi(_GetUnsyncedEventCountShardKeys())
+  return sum(shard.count for shard in shards if shard is not None)
+
+
+def _ResetUnsyncedEventCount():
+  ndb.delete_multi(_GetUnsyncedEventCountShardKeys())
+
+
+def _PutUnsyncedEvents(unsynced_events):
+  """Persists new _UnsyncedEvents and increments the maintained count."""
+  keys = ndb.put_multi(unsynced_events)
+  if keys:
+    _AdjustUnsyncedEventCount(len(keys))
+  return keys
+
+
+def _DecrementUnsyncedEventCount(processed_count):
+  """Decrements the maintained count once a page of events is processed.
+
+  Failures are only logged, since the count is corrected by
+  CountEventsToProcess anyway and processing shouldn't stop over it.
+
+  Args:
+    processed_count: int, The number of _UnsyncedEvents deleted.
+  """
+  if not processed_count:
+    return
+  try:
+    _AdjustUnsyncedEventCount(-processed_count)
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Unable to decrement the unprocessed event count')
+
+
+class _PendingHost(ndb.Model):
+  """Marks a host as having _UnsyncedEvents that are awaiting processing.
+
+  key = The integer Bit9 ID of the host.
+
+  Attributes:
+    pending_dt: When the host's outstanding events first became pending.
+    marked_dt: The last time new events were pulled for the host.
+    dispatched_dt: When a Process task was last dispatched for the host, or
+        None if there's no task in flight.
+  """
+  pending_dt = ndb.DateTimeProperty()
+  marked_dt = ndb.DateTimeProperty(indexed=False)
+  dispatched_dt = ndb.DateTimeProperty(indexed=False)
+
+
+@ndb.transactional_tasklet
+def _MarkHostPendingAsync(key, now):
+  pending_host = yield key.get_async()
+  if pending_host is None:
+    pending_host = _PendingHost(key=key, pending_dt=now)
+  pending_host.marked_dt = now
+  yield pending_host.put_async()
+
+
+def _MarkHostsPending(host_ids):
+  """Ensures there's a _PendingHost for each of the given hosts."""
+  now = _Now()
+  futures = [
+      _MarkHostPendingAsync(ndb.Key(_PendingHost, host_id), now)
+      for host_id in sorted(set(host_ids))]
+  ndb.Future.wait_all(futures)
+  for future in futures:
+    future.check_success()
+
+
+@ndb.transactional_tasklet
+def _ClaimPendingHostAsync(key, now):
+  """Marks a host as dispatched, unless it's gone or already in flight.
+
+  Args:
+    key: Key, The key of the host's _PendingHost.
+    now: datetime, The time of dispatch.
+
+  Returns:
+    A Future resolving to whether a Process task should be dispatched.
+  """
+  pending_host = yield key.get_async()
+  if pending_host is None or not _IsReadyForDispatch(pending_host, now):
+    raise ndb.Return(False)
+  pending_host.dispatched_dt = now
+  yield pending_host.put_async()
+  raise ndb.Return(True)
+
+
+def _IsReadyForDispatch(pending_host, now):
+  return (
+      pending_host.dispatched_dt is None or
+      now - pending_host.dispatched_dt > _PROCESS_DISPATCH_LEASE)
+
+
+@ndb.transactional
+def _ReleasePendingHost(host_id, drained, scan_start_dt):
+  """Updates a host's _PendingHost once a Process task for it has finished.
+
+  Args:
+    host_id: int, The ID of the host.
+    drained: bool, Whether the Process task ran out of _UnsyncedEvents.
+    scan_start_dt: datetime, When the Process task began querying for events.
+  """
+  pending_host = ndb.Key(_PendingHost, host_id).get()
+  if pending_host is None:
+    return
+
+  if drained and (
+      pending_host.marked_dt < scan_start_dt - _PENDING_HOST_GRACE_PERIOD):
+    pending_host.key.delete()
+  else:
+    pending_host.dispatched_dt = None
+    pending_host.put()
+
+
+def _BackfillPendingHosts():
+  """Seeds _PendingHosts from the _UnsyncedEvents if there are none.
+
+  This covers _UnsyncedEvents which predate the _PendingHost index.
+  """
+  if _PendingHost.query().get(keys_only=True) is not None:
+    return
+  if _UnsyncedEvent.query().get(keys_only=True) is None:
+    return
+
+  logging.info('Backfilling hosts with pending events')
+  query = _UnsyncedEvent.query(
+      projection=[_UnsyncedEvent.host_id], distinct=True)
+  for event_page in datastore_utils.Paginate(query, page_size=25):
+    _MarkHostsPending(event.host_id for event in event_page)
+
+
 def _Now():
   """Returns the current datetime. Primarily for easier unit testing."""
   return datetime.datetime.utcnow()
@@ -149,11 +329,13 @@ def BuildEventSubtypeFilter():
 @memcache_decorator.Cached(
     expire_time=_CERT_MEMCACHE_TIMEOUT,
     create_key_func=lambda f, key, args, kwargs: _CERT_MEMCACHE_KEY % args[0],
-    namespace=None)
+    namespace=None, local_cache_size=_CERT_LOCAL_CACHE_SIZE,
+    local_expire_time=datetime.timedelta(hours=1).total_seconds(),
+    single_flight=True)
 def _GetCertificate(cert_id):
   """Gets a certificate entity."""
   for _ in xrange(_GET_CERT_ATTEMPTS):
-    cert = api.Certificate.get(cert_id, bit9_utils.CONTEXT)
+    cert = mirror.GetCertificate(cert_id)
 
     # Attempt to parse the cert before caching it, in case the related
     # fileCatalog contains an "embedded signer". In such cases, the fileCatalog
@@ -326,10 +508,15 @@ def Pull(batch_size=_PULL_BATCH_SIZE):
             total_pull_count)
         monitoring.events_pulled.IncrementBy(pull_count)
 
-        # Persist an _UnsyncedEvent for each retrieved Event proto.
-        ndb.put_multi(
+        # Flag the hosts of the retrieved events as needing to be processed,
+        # then persist an _UnsyncedEvent for each Event proto. Once persisted,
+        # the events won't be pulled again, so the hosts are flagged first. A
+        # host which is processed before its events arrive stays flagged.
+        unsynced_events = [
             _UnsyncedEvent.Generate(event, signing_chain)
-            for event, signing_chain in event_tuples)
+            for event, signing_chain in event_tuples]
+        _MarkHostsPending(event.host_id for event in unsynced_events)
+        _PutUnsyncedEvents(unsynced_events)
 
         # Briefly pause between requests in order to avoid hammering the Bit9
         # server too hard.
@@ -343,14 +530,26 @@ def Dispatch():
   total_dispatch_count = 0
   logging.info('Starting a new dispatch task')
 
-  # Query for all distinct host_id values among the _UnsyncedEvents, in batches,
-  # either until we run out, or the task nears its deadline.
-  query = _UnsyncedEvent.query(
-      projection=[_UnsyncedEvent.host_id], distinct=True)
-  for event_page in datastore_utils.Paginate(query, page_size=25):
-    host_ids = [event.host_id for event in event_page]
-    for host_id in host_ids:
-      deferred.defer(Process, host_id, _queue=constants.TASK_QUEUE.BIT9_PROCESS)
+  _BackfillPendingHosts()
+
+  # Dispatch a task for each host with pending events, oldest first, skipping
+  # any host which already has a task in flight. The query may be out of date,
+  # so each host is re-read when it's claimed, leaving the rest of its
+  # _PendingHost as Pull and Process last wrote it.
+  now = _Now()
+  query = _PendingHost.query().order(_PendingHost.pending_dt)
+  for pending_host_page in datastore_utils.Paginate(query, page_size=25):
+    ready_keys = [
+        pending_host.key for pending_host in pending_host_page
+        if _IsReadyForDispatch(pending_host, now)]
+    futures = [_ClaimPendingHostAsync(key, now) for key in ready_keys]
+    ndb.Future.wait_all(futures)
+
+    for key, future in zip(ready_keys, futures):
+      if not future.get_result():
+        continue
+      deferred.defer(
+          Process, key.id(), _queue=constants.TASK_QUEUE.BIT9_PROCESS)
       total_dispatch_count += 1
 
   logging.info('Dispatched %d task(s)', total_dispatch_count)
@@ -379,44 +578,58 @@ def Process(host_id):
       event_pages = datastore_utils.Paginate(query, page_size=25)
       event_page = next(event_pages, None)
       while time_utils.TimeRemains(start_time, _TASK_DURATION) and event_page:
-        for unsynced_event in event_page:
-          event = api.Event.from_dict(unsynced_event.event)
-          signing_chain = [
-              api.Certificate.from_dict(cert)
-              for cert in unsynced_event.signing_chain
-          ]
-          file_catalog = event.get_expand(api.Event.file_catalog_id)
-          computer = event.get_expand(api.Event.computer_id)
-
-          # Persist the event data.
-          persist_futures = [
-              _PersistBit9Certificates(signing_chain),
-              _PersistBit9Binary(
-                  event, file_catalog, signing_chain,
-                  datetime.datetime.utcnow()),
-              _PersistBanNote(file_catalog),
-              _PersistBit9Host(computer, event.timestamp),
-              _PersistBit9Events(event, file_catalog, computer, signing_chain)
-          ]
-          ndb.Future.wait_all(persist_futures)
-          for persist_future in persist_futures:
-            persist_future.check_success()
-
-          # Now that the event sync has completed successfully, remove the
-          # intermediate proto entity.
-          unsynced_event.key.delete()
-
-          monitoring.events_processed.Increment()
-          total_process_count += 1
+        # The maintained count is adjusted once per page, even if processing
+        # fails part way through it.
+        processed_count = 0
+        try:
+          for unsynced_event in event_page:
+            _ProcessUnsyncedEvent(unsynced_event)
+            processed_count += 1
+        finally:
+          _DecrementUnsyncedEventCount(processed_count)
+        total_process_count += processed_count
 
         event_page = next(event_pages, None)
 
+      # Let Dispatch know whether this host still needs processing.
+      _ReleasePendingHost(host_id, event_page is None, start_time)
+
     logging.info('Processed %d event(s)', total_process_count)
 
   except datastore_locks.AcquireLockError:
     logging.info('Unable to acquire datastore lock')
 
 
+def _ProcessUnsyncedEvent(unsynced_event):
+  """Persists the data of an _UnsyncedEvent, then deletes it."""
+  event = api.Event.from_dict(unsynced_event.event)
+  signing_chain = [
+      api.Certificate.from_dict(cert)
+      for cert in unsynced_event.signing_chain
+  ]
+  file_catalog = event.get_expand(api.Event.file_catalog_id)
+  computer = event.get_expand(api.Event.computer_id)
+
+  # Persist the event data.
+  persist_futures = [
+      _PersistBit9Certificates(signing_chain),
+      _PersistBit9Binary(
+          event, file_catalog, signing_chain, datetime.datetime.utcnow()),
+      _PersistBanNote(file_catalog),
+      _PersistBit9Host(computer, event.timestamp),
+      _PersistBit9Events(event, file_catalog, computer, signing_chain)
+  ]
+  ndb.Future.wait_all(persist_futures)
+  for persist_future in persist_futures:
+    persist_future.check_success()
+
+  # Now that the event sync has completed successfully, remove the
+  # intermediate proto entity.
+  unsynced_event.key.delete()
+
+  monitoring.events_processed.Increment()
+
+
 def _PersistBit9Certificates(signing_chain):
   """Creates Bit9Certificates from the given Event protobuf.
 
@@ -683,12 +896,20 @@ def _CopyLocalRules(user_key, dest_host_id):
     raise ndb.Return()
   src_host_id = src_host.key.id()
 
-  # Query for all the Bit9Rules in effect for the given user on the chosen host.
-  query = rule_models.Bit9Rule.query(
-      rule_models.Bit9Rule.host_id == src_host_id,
-      rule_models.Bit9Rule.user_key == user_key,
-      rule_models.Bit9Rule.in_effect == True)  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
-  src_rules = yield query.fetch_async()
+  # Look up the Bit9Rules in effect for the given user on the chosen host,
+  # falling back to a query if the host hasn't been indexed yet.
+  entries = yield host_index.GetEntriesAsync(src_host_id)
+  if entries is None:
+    query = rule_models.Bit9Rule.query(
+        rule_models.Bit9Rule.host_id == src_host_id,
+        rule_models.Bit9Rule.user_key == user_key,
+        rule_models.Bit9Rule.in_effect == True)  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+    src_rules = yield query.fetch_async()
+  else:
+    rules = yield ndb.get_multi_async([entry.rule_key for entry in entries])
+    src_rules = [
+        rule for rule in rules
+        if rule is not None and rule.in_effect and rule.user_key == user_key]
   logging.info(
       'Found a total of %d rule(s) for user %s', len(src_rules), user_key.id())
 
@@ -702,6 +923,7 @@ def _CopyLocalRules(user_key, dest_host_id):
     new_rules.append(new_rule)
     new_rule.InsertBigQueryRow()
   yield ndb.put_multi_async(new_rules)
+  host_index.Update(new_rules)
 
   # Create the change sets necessary to submit the new rules to Bit9.
   changes = []
@@ -850,6 +1072,12 @@ def _CheckAndResolveAnomalousBlock(blockable_key, host_id):
     Whether the block was anomalous (i.e. whether an unfulfilled rule existed
     for the blockable-host pair).
   """
+  # Most blocks happen on hosts without any local rules for the blockable, which
+  # the host's rule index can rule out without a query.
+  indexed_rule_keys = host_index.GetRuleKeys(host_id, blockable_key.id())
+  if indexed_rule_keys is not None and not indexed_rule_keys:
+    return False
+
   # Check and handle anomalous block events by detecting unfulfilled rules and,
   # if present, attempting to commit them.
   # pylint: disable=g-explicit-bool-comparison, singleton-comparison
@@ -1004,58 +1232,81 @@ class CommitAllChangeSets(handler_utils.CronJobHandler):
           selected_key, countdown=countdown)
 
 
+def _UpdateLocalPolicies(changed_policies):
+  """Brings the local Bit9Policies up to date with policies changed in Bit9.
+
+  Args:
+    changed_policies: list<api.Policy>, The policies modified in Bit9.
+  """
+  policy_keys = [
+      ndb.Key(policy_models.Bit9Policy, str(policy.id))
+      for policy in changed_policies]
+  local_policies = {
+      policy.key.id(): policy
+      for policy in ndb.get_multi(policy_keys) if policy is not None}
+  policies_to_update = []
+  for policy in changed_policies:
+    try:
+      level = constants.BIT9_ENFORCEMENT_LEVEL.MAP_FROM_INTEGRAL_LEVEL[
+          policy.enforcement_level]
+    except KeyError:
+      logging.warning(
+          'Unknown enforcement level "%s". Skipping...',
+          policy.enforcement_level)
+      continue
+    local_policy = local_policies.get(str(policy.id))
+
+    if local_policy is None:
+      new_policy = policy_models.Bit9Policy(
+          id=str(policy.id), name=policy.name, enforcement_level=level)
+      policies_to_update.append(new_policy)
+    else:
+      dirty = False
+      if local_policy.name != policy.name:
+        local_policy.name = policy.name
+        dirty = True
+      if local_policy.enforcement_level != level:
+        local_policy.enforcement_level = level
+        dirty = True
+      if dirty:
+        policies_to_update.append(local_policy)
+
+  if policies_to_update:
+    logging.info('Updating %s policies', len(policies_to_update))
+    ndb.put_multi(policies_to_update)
+
+
 class UpdateBit9Policies(handler_utils.CronJobHandler):
   """Ensures locally cached policies are up-to-date."""
 
   def get(self):
-    policies_future = policy_models.Bit9Policy.query().fetch_async()
+    # Only policies modified in Bit9 since the last run need to be examined.
+    # They're only mirrored, which advances the sync past them, once the local
+    # policies have been updated.
+    mirror.Sync(api.Policy, callback=_UpdateLocalPolicies)
 
-    active_policies = (
-        api.Policy.query().filter(api.Policy.total_computers > 0)
-        .execute(bit9_utils.CONTEXT))
-    local_policies = {
-        policy.key.id(): policy for policy in policies_future.get_result()}
-    policies_to_update = []
-    for policy in active_policies:
-      try:
-        level = constants.BIT9_ENFORCEMENT_LEVEL.MAP_FROM_INTEGRAL_LEVEL[
-            policy.enforcement_level]
-      except KeyError:
-        logging.warning(
-            'Unknown enforcement level "%s". Skipping...',
-            policy.enforcement_level)
-        continue
-      local_policy = local_policies.get(str(policy.id))
-
-      if local_policy is None:
-        new_policy = policy_models.Bit9Policy(
-            id=str(policy.id), name=policy.name, enforcement_level=level)
-        policies_to_update.append(new_policy)
-      else:
-        dirty = False
-        if local_policy.name != policy.name:
-          local_policy.name = policy.name
-          dirty = True
-        if local_policy.enforcement_level != level:
-          local_policy.enforcement_level = level
-          dirty = True
-        if dirty:
-          policies_to_update.append(local_policy)
-
-    if policies_to_update:
-      logging.info('Updating %s policies', len(policies_to_update))
-      ndb.put_multi(policies_to_update)
+
+class SyncBit9Certificates(handler_utils.CronJobHandler):
+  """Keeps the local mirror of Bit9 certificates up-to-date."""
+
+  def get(self):
+    mirror.Sync(api.Certificate)
 
 
 class CountEventsToPull(handler_utils.CronJobHandler):
 
   def get(self):
-    queue_length = (
-        api.Event.query().filter(api.Event.id > GetLastSyncedId())
-        .filter(api.Event.file_catalog_id > 0).filter(
-            BuildEventSubtypeFilter()).count(bit9_utils.CONTEXT))
+    # Rather than counting the matching events in Bit9, which gets slower as
+    # the backlog grows, estimate the backlog from the distance between the
+    # newest event ID in Bit9 and the newest one we've pulled. This overcounts
+    # slightly, since it includes events which GetEvents() filters out.
+    newest_events = (
+        api.Event.query().order(-api.Event.id).limit(1)
+        .execute(bit9_utils.CONTEXT))
+    newest_id = newest_events[0].id if newest_events else 0
+    queue_length = max(newest_id - GetLastSyncedId(), 0)
     logging.info(
-        'There are currently %d events waiting in Bit9', queue_length)
+        'There are currently ~%d events waiting in Bit9', queue_length)
     monitoring.events_to_pull.Set(queue_length)
 
 
@@ -1069,7 +1320,18 @@ class PullEvents(handler_utils.CronJobHandler):
 class CountEventsToProcess(handler_utils.CronJobHandler):
 
   def get(self):
-    events_to_process = _UnsyncedEvent.query().count()  # pylint: disable=protected-access
+    events_to_process = _GetUnsyncedEventCount()
+
+    # The count and the _UnsyncedEvents aren't updated transactionally, so the
+    # count can drift (e.g. if a task dies between the two writes). Whenever
+    # the backlog is fully drained, take the opportunity to correct it.
+    if events_to_process and _UnsyncedEvent.query().get(keys_only=True) is None:
+      logging.info(
+          'Resetting the unprocessed event count from %d', events_to_process)
+      _ResetUnsyncedEventCount()
+      events_to_process = 0
+
+    events_to_process = max(events_to_process, 0)
     logging.info('There are currently %d unprocessed events', events_to_process)
     monitoring.events_to_process.Set(events_to_process)
 
@@ -1085,6 +1347,7 @@ class ProcessEvents(handler_utils.CronJobHandler):
 ROUTES = routes.PathPrefixRoute('/bit9', [
     webapp2.Route('/commit-pending-change-sets', handler=CommitAllChangeSets),
     webapp2.Route('/update-policies', handler=UpdateBit9Policies),
+    webapp2.Route('/sync-certificates', handler=SyncBit9Certificates),
     webapp2.Route('/count-events-to-pull', handler=CountEventsToPull),
     webapp2.Route('/pull-events', handler=PullEvents),
     webapp2.Route('/count-events-to-process', handler=CountEventsToProcess),
@@ -0,0 +1,145 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End-to-end benchmark of the Bit9 syncing pipeline.
+
+Runs pull -> dispatch -> process -> commit against an in-process FakeBit9, and
+reports throughput, per-stage latency, and the number of REST calls made.
+
+  bazel run //upvote/gae/cron:bit9_syncing_benchmark -- \
+      --benchmark_events=2000 --benchmark_latency_ms=20
+"""
+
+import collections
+import time
+
+import mock
+
+from upvote.gae.cron import bit9_syncing
+from upvote.gae.datastore import test_utils
+from upvote.gae.datastore.models import binary as binary_models
+from upvote.gae.datastore.models import host as host_models
+from upvote.gae.datastore.models import rule as rule_models
+from upvote.gae.lib.bit9 import change_set
+from upvote.gae.lib.bit9 import fake_server
+from upvote.gae.lib.bit9 import utils as bit9_utils
+from upvote.gae.lib.testing import bit9test
+from upvote.shared import constants
+from absl import flags
+from absl import logging
+from absl.testing import absltest
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    'benchmark_events', 200, 'The number of Bit9 events to sync.')
+flags.DEFINE_integer(
+    'benchmark_hosts', 10, 'The number of Bit9 computers to spread events over.')
+flags.DEFINE_integer(
+    'benchmark_binaries', 20, 'The number of distinct fileCatalogs.')
+flags.DEFINE_integer(
+    'benchmark_commits', 5,
+    'The number of binaries to locally whitelist on every host.')
+flags.DEFINE_float(
+    'benchmark_latency_ms', 0, 'The latency of each fake Bit9 request.')
+flags.DEFINE_float(
+    'benchmark_error_rate', 0,
+    'The fraction of fake Bit9 requests which should fail.')
+
+
+class Bit9SyncingBenchmark(bit9test.Bit9TestCase):
+
+  def setUp(self):
+    super(Bit9SyncingBenchmark, self).setUp()
+
+    self.fake = fake_server.FakeBit9(
+        latency=FLAGS.benchmark_latency_ms / 1000.0,
+        error_rate=FLAGS.benchmark_error_rate, seed=0)
+    fake_server.SeedEvents(
+        self.fake, FLAGS.benchmark_events, host_count=FLAGS.benchmark_hosts,
+        binary_count=FLAGS.benchmark_binaries, seed=0)
+    self.Patch(
+        bit9_utils.api, 'Context',
+        return_value=fake_server.FakeContext(self.fake))
+
+    # Don't pause between pull batches.
+    self.Patch(bit9_syncing.time, 'sleep')
+
+    self.timings = collections.OrderedDict()
+
+  def _Time(self, stage, func, *args):
+    start = time.time()
+    func(*args)
+    self.timings[stage] = time.time() - start
+
+  def _Pull(self):
+    # Keep pulling until every seeded event has been retrieved. This only
+    # applies to Pull, since Process also checks TimeRemains and would
+    # otherwise never get to process anything.
+    with mock.patch.object(
+        bit9_syncing.time_utils, 'TimeRemains',
+        side_effect=lambda *_: (
+            bit9_syncing.GetLastSyncedId() < FLAGS.benchmark_events)):
+      bit9_syncing.Pull()
+
+  def _DrainProcessQueue(self):
+    self.DrainTaskQueue(constants.TASK_QUEUE.BIT9_PROCESS)
+
+  def _Commit(self):
+    host_ids = [key.id() for key in host_models.Bit9Host.query().fetch(
+        keys_only=True)]
+    binaries = binary_models.Bit9Binary.query().fetch(
+        FLAGS.benchmark_commits)
+    for binary in binaries:
+      rules = [
+          test_utils.CreateBit9Rule(
+              binary.key, host_id=host_id,
+              policy=constants.RULE_POLICY.WHITELIST)
+          for host_id in host_ids]
+      test_utils.CreateRuleChangeSet(
+          binary.key, rule_keys=[rule.key for rule in rules],
+          change_type=constants.RULE_POLICY.WHITELIST)
+      change_set.DeferCommitBlockableChangeSet(binary.key)
+    self.DrainTaskQueue(constants.TASK_QUEUE.BIT9_COMMIT_CHANGE)
+
+  def testPipeline(self):
+    self.fake.ResetStats()
+
+    self._Time('pull', self._Pull)
+    self._Time('dispatch', bit9_syncing.Dispatch)
+    self._Time('process', self._DrainProcessQueue)
+    self._Time('commit', self._Commit)
+
+    self.assertEntityCount(bit9_syncing._UnsyncedEvent, 0)
+    self.assertFalse(
+        rule_models.Bit9Rule.query(
+            rule_models.Bit9Rule.is_committed == False).fetch(1))  # pylint: disable=g-explicit-bool-comparison
+
+    total = sum(self.timings.values())
+    logging.info(
+        'Synced %d events in %.2fs (%.1f events/sec)', FLAGS.benchmark_events,
+        total, FLAGS.benchmark_events / total if total else 0)
+    for stage, elapsed in self.timings.items():
+      logging.info('  %-10s %.3fs', stage, elapsed)
+
+    stats = self.fake.GetStats()
+    logging.info(
+        'Made %d Bit9 request(s), %d failed', sum(stats['requests'].values()),
+        sum(stats['errors'].values()))
+    for request, count in sorted(stats['requests'].items()):
+      logging.info('  %-20s %d', request, count)
+
+
+if __name__ == '__main__':
+  absltest.main()
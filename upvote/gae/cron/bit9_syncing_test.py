@@ -43,6 +43,7 @@ from upvote.gae.datastore.models import user as user_models
 from upvote.gae.lib.bit9 import api
 from upvote.gae.lib.bit9 import change_set
 from upvote.gae.lib.bit9 import constants as bit9_constants
+from upvote.gae.lib.bit9 import mirror
 from upvote.gae.lib.bit9 import monitoring
 from upvote.gae.lib.bit9 import test_utils as bit9_test_utils
 from upvote.gae.lib.bit9 import utils as bit9_utils
@@ -130,7 +131,7 @@ def _CreateUnsyncedEvents(host_count=1, events_per_host=-1):
   Returns:
     A sorted list of the randomly generated host IDs.
   """
-  computer_ids = range(host_count)
+  computer_ids = range(1, host_count + 1)
 
   for computer_id in computer_ids:
     event_count = (
@@ -166,6 +167,7 @@ class SyncTestCase(basetest.UpvoteTestCase):
     self.Patch(bit9_utils, 'CONTEXT')
     self._api_side_effects = []
     self._api_cert_ids = set()
+    mirror.ClearCache()
 
 
 class UnsyncedEventTest(basetest.UpvoteTestCase):
@@ -195,6 +197,10 @@ class BuildEventSubtypeFilterTest(basetest.UpvoteTestCase):
 
 class GetCertificateTest(basetest.UpvoteTestCase):
 
+  def setUp(self):
+    super(GetCertificateTest, self).setUp()
+    mirror.ClearCache()
+
   @mock.patch.object(bit9_syncing.api.Certificate, 'get', side_effect=Exception)
   def testApiError(self, mock_get):
 
@@ -555,11 +561,38 @@ class PullTest(SyncTestCase):
 
     self.assertEntityCount(
         bit9_syncing._UnsyncedEvent, batch_count * events_per_batch)
+    self.assertEqual(
+        batch_count * events_per_batch, bit9_syncing._GetUnsyncedEventCount())
     self.assertEqual(
         batch_count, self.mock_events_pulled.IncrementBy.call_count)
 
     self.assertTaskCount(constants.TASK_QUEUE.BIT9_PULL, 0)
 
+  def testMarksHostsPending(self):
+    events, certs = _CreateEventsAndCerts(
+        count=2, computer_kwargs={'id': 123})
+    self._AppendMockApiResults(events, *certs)
+    self.Patch(time_utils, 'TimeRemains', side_effect=[True, False])
+
+    bit9_syncing.Pull()
+
+    pending_hosts = bit9_syncing._PendingHost.query().fetch()
+    self.assertLen(pending_hosts, 1)
+    self.assertEqual(123, pending_hosts[0].key.id())
+    self.assertIsNone(pending_hosts[0].dispatched_dt)
+
+  def testMarkHostsPendingFails(self):
+    events, certs = _CreateEventsAndCerts(count=2)
+    self._AppendMockApiResults(events, *certs)
+    self.Patch(time_utils, 'TimeRemains', side_effect=[True, False])
+    self.Patch(bit9_syncing, '_MarkHostsPending', side_effect=Exception)
+
+    with self.assertRaises(Exception):
+      bit9_syncing.Pull()
+
+    # The events shouldn't be persisted, so that they're pulled again.
+    self.assertEntityCount(bit9_syncing._UnsyncedEvent, 0)
+
   def testBadEvent(self):
     event, cert = _CreateEventAndCert()
     # Create an event with no expands.
@@ -592,6 +625,68 @@ class DispatchTest(SyncTestCase):
     actual_host_ids = [task[1][0] for task in tasks]
     self.assertEqual(expected_host_ids, actual_host_ids)
 
+  def testOldestFirst(self):
+    now = datetime.datetime.utcnow()
+    for host_id, minutes_ago in ((1, 5), (2, 10), (3, 1)):
+      pending_dt = now - datetime.timedelta(minutes=minutes_ago)
+      bit9_syncing._PendingHost(
+          id=host_id, pending_dt=pending_dt, marked_dt=pending_dt).put()
+
+    bit9_syncing.Dispatch()
+
+    tasks = self.UnpackTaskQueue(queue_name=constants.TASK_QUEUE.BIT9_PROCESS)
+    actual_host_ids = [task[1][0] for task in tasks]
+    self.assertEqual([2, 1, 3], actual_host_ids)
+
+  def testSkipsInFlightHosts(self):
+    now = datetime.datetime.utcnow()
+    expired_dt = now - bit9_syncing._PROCESS_DISPATCH_LEASE * 2
+    bit9_syncing._PendingHost(
+        id=1, pending_dt=now, marked_dt=now, dispatched_dt=now).put()
+    bit9_syncing._PendingHost(
+        id=2, pending_dt=now, marked_dt=now, dispatched_dt=expired_dt).put()
+
+    bit9_syncing.Dispatch()
+    bit9_syncing.Dispatch()
+
+    # Host 1 is already in flight, and host 2 should only be dispatched once.
+    tasks = self.UnpackTaskQueue(queue_name=constants.TASK_QUEUE.BIT9_PROCESS)
+    actual_host_ids = [task[1][0] for task in tasks]
+    self.assertEqual([2], actual_host_ids)
+
+  def testKeepsNewerMark(self):
+    now = datetime.datetime.utcnow()
+    stale_dt = now - datetime.timedelta(minutes=5)
+    stale_host = bit9_syncing._PendingHost(
+        id=1, pending_dt=stale_dt, marked_dt=stale_dt)
+    bit9_syncing._PendingHost(id=1, pending_dt=stale_dt, marked_dt=now).put()
+
+    # The query returns host 1 as it was before Pull last marked it, and
+    # host 2 which has since been released.
+    self.Patch(
+        bit9_syncing.datastore_utils, 'Paginate',
+        return_value=[[stale_host, bit9_syncing._PendingHost(
+            id=2, pending_dt=stale_dt, marked_dt=stale_dt)]])
+
+    bit9_syncing.Dispatch()
+
+    pending_host = ndb.Key(bit9_syncing._PendingHost, 1).get()
+    self.assertEqual(now, pending_host.marked_dt)
+    self.assertIsNotNone(pending_host.dispatched_dt)
+    self.assertIsNone(ndb.Key(bit9_syncing._PendingHost, 2).get())
+
+    tasks = self.UnpackTaskQueue(queue_name=constants.TASK_QUEUE.BIT9_PROCESS)
+    self.assertEqual([1], [task[1][0] for task in tasks])
+
+  def testNoBackfillWhenIndexed(self):
+    _CreateUnsyncedEvents(host_count=3)
+    now = datetime.datetime.utcnow()
+    bit9_syncing._PendingHost(id=1, pending_dt=now, marked_dt=now).put()
+
+    bit9_syncing.Dispatch()
+
+    self.assertTaskCount(constants.TASK_QUEUE.BIT9_PROCESS, 1)
+
 
 class ProcessTest(SyncTestCase):
 
@@ -609,6 +704,14 @@ class ProcessTest(SyncTestCase):
 
     self.PatchEnv(settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=True)
 
+  def _PatchPersistMethods(self):
+    methods = [
+        '_PersistBit9Certificates', '_PersistBit9Binary', '_PersistBanNote',
+        '_PersistBit9Host', '_PersistBit9Events']
+    for method in methods:
+      self.Patch(
+          bit9_syncing, method, return_value=datastore_utils.GetNoOpFuture())
+
   def testInsertsCertificateRow(self):
     event, cert = _CreateEventAndCert()
     bit9_syncing._UnsyncedEvent.Generate(event, [cert]).put()
@@ -626,6 +729,74 @@ class ProcessTest(SyncTestCase):
     # Should be 1 Task for the CertificateRow caused by the event.
     self.assertBigQueryInsertions([constants.BIGQUERY_TABLE.CERTIFICATE])
 
+  def testDecrementsCount(self):
+    events, _ = _CreateEventsAndCerts(
+        count=3, computer_kwargs={'id': 123})
+    bit9_syncing._PutUnsyncedEvents([
+        bit9_syncing._UnsyncedEvent.Generate(event, []) for event in events])
+    self.assertEqual(3, bit9_syncing._GetUnsyncedEventCount())
+
+    self._PatchPersistMethods()
+
+    bit9_syncing.Process(123)
+
+    self.assertEntityCount(bit9_syncing._UnsyncedEvent, 0)
+    self.assertEqual(0, bit9_syncing._GetUnsyncedEventCount())
+
+  def testDecrementsCountOncePerPage(self):
+    events, _ = _CreateEventsAndCerts(
+        count=3, computer_kwargs={'id': 123})
+    bit9_syncing._PutUnsyncedEvents([
+        bit9_syncing._UnsyncedEvent.Generate(event, []) for event in events])
+    self._PatchPersistMethods()
+    mock_adjust = self.Patch(bit9_syncing, '_AdjustUnsyncedEventCount')
+
+    bit9_syncing.Process(123)
+
+    mock_adjust.assert_called_once_with(-3)
+
+  def testDrained_ClearsPendingHost(self):
+    _CreateUnsyncedEvents(events_per_host=1)
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    bit9_syncing._PendingHost(
+        id=1, pending_dt=long_ago, marked_dt=long_ago,
+        dispatched_dt=long_ago).put()
+    self._PatchPersistMethods()
+
+    bit9_syncing.Process(1)
+
+    self.assertIsNone(ndb.Key(bit9_syncing._PendingHost, 1).get())
+
+  def testDrained_RecentlyMarked(self):
+    _CreateUnsyncedEvents(events_per_host=1)
+    now = datetime.datetime.utcnow()
+    bit9_syncing._PendingHost(
+        id=1, pending_dt=now, marked_dt=now, dispatched_dt=now).put()
+    self._PatchPersistMethods()
+
+    bit9_syncing.Process(1)
+
+    # Events pulled just before processing may not have been visible yet, so
+    # the host should stay pending but be made available for dispatch again.
+    pending_host = ndb.Key(bit9_syncing._PendingHost, 1).get()
+    self.assertIsNotNone(pending_host)
+    self.assertIsNone(pending_host.dispatched_dt)
+
+  def testTimeout_ReleasesPendingHost(self):
+    _CreateUnsyncedEvents(events_per_host=30)
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    bit9_syncing._PendingHost(
+        id=1, pending_dt=long_ago, marked_dt=long_ago,
+        dispatched_dt=long_ago).put()
+    self._PatchPersistMethods()
+    self.Patch(time_utils, 'TimeRemains', side_effect=[True, False])
+
+    bit9_syncing.Process(1)
+
+    pending_host = ndb.Key(bit9_syncing._PendingHost, 1).get()
+    self.assertIsNotNone(pending_host)
+    self.assertIsNone(pending_host.dispatched_dt)
+
   def testInsertsExecutionRow(self):
     event_count = 3
     host_id = _CreateUnsyncedEvents(events_per_host=event_count)[0]
@@ -1410,6 +1581,65 @@ class UpdateBit9PoliciesTest(bit9test.Bit9TestCase):
     updated_policy = policy_models.Bit9Policy.get_by_id('1')
     self.assertEqual('foo', updated_policy.name)
 
+  def testGet_Incremental(self):
+    policy = api.Policy(
+        id=1, name='foo', enforcement_level=20,
+        date_modified='2018-01-01T00:00:00Z')
+    self.PatchApiRequests([policy], [policy])
+
+    self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+    policy_models.Bit9Policy.get_by_id('1').key.delete()
+
+    # Nothing has been modified in Bit9 since the last run, so the deleted
+    # policy shouldn't be recreated, even though the sync overlap returns it
+    # again.
+    self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+
+    self.assertIsNone(policy_models.Bit9Policy.get_by_id('1'))
+    self.mock_ctx.ExecuteRequest.assert_called_with(
+        'GET', api_route='policy',
+        query_args=[
+            'q=dateModified>2017-12-31T23:59:59.000000Z',
+            'sort=dateModified ASC', 'limit=500'])
+
+
+  def testGet_PutFails(self):
+    policy = api.Policy(
+        id=1, name='foo', enforcement_level=20,
+        date_modified='2018-01-01T00:00:00Z')
+    self.PatchApiRequests([policy], [policy])
+
+    with mock.patch.object(
+        bit9_syncing.ndb, 'put_multi', side_effect=Exception):
+      self.testapp.get(
+          self.ROUTE, headers={'X-AppEngine-Cron': 'true'},
+          status=httplib.INTERNAL_SERVER_ERROR)
+    self.assertIsNone(policy_models.Bit9Policy.get_by_id('1'))
+
+    # The policy wasn't mirrored, so the next run should still create it.
+    self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+    self.assertIsNotNone(policy_models.Bit9Policy.get_by_id('1'))
+
+
+class SyncBit9CertificatesTest(bit9test.Bit9TestCase):
+
+  ROUTE = '/bit9/sync-certificates'
+
+  def setUp(self):
+    app = webapp2.WSGIApplication(routes=[bit9_syncing.ROUTES])
+    super(SyncBit9CertificatesTest, self).setUp(wsgi_app=app)
+
+  def testGet(self):
+    cert = bit9_test_utils.CreateCertificate(
+        id=123, date_modified='2018-01-01T00:00:00Z')
+    self.PatchApiRequests([cert])
+
+    self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+
+    # The synced cert should now be served from the mirror.
+    self.assertEqual(cert, bit9_syncing._GetCertificate(123))
+    self.assertEqual(1, self.mock_ctx.ExecuteRequest.call_count)
+
 
 class CountEventsToPullTest(bit9test.Bit9TestCase):
 
@@ -1421,13 +1651,25 @@ class CountEventsToPullTest(bit9test.Bit9TestCase):
 
   @mock.patch.object(bit9_syncing.monitoring, 'events_to_pull')
   def testSuccess(self, mock_metric):
-    bit9_utils.CONTEXT.ExecuteRequest.return_value = {'count': 20}
+    bit9_syncing._UnsyncedEvent(bit9_id=100).put()
+    self.PatchApiRequests([bit9_test_utils.CreateEvent(id=120)])
 
     self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
 
+    self.mock_ctx.ExecuteRequest.assert_called_once_with(
+        'GET', api_route='event', query_args=['sort=id DESC', 'limit=1'])
     actual_length = mock_metric.Set.call_args_list[0][0][0]
     self.assertEqual(20, actual_length)
 
+  @mock.patch.object(bit9_syncing.monitoring, 'events_to_pull')
+  def testNoEvents(self, mock_metric):
+    self.PatchApiRequests([])
+
+    self.testapp.get(self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+
+    actual_length = mock_metric.Set.call_args_list[0][0][0]
+    self.assertEqual(0, actual_length)
+
 
 class PullEventsTest(bit9test.Bit9TestCase):
 
@@ -1457,8 +1699,8 @@ class CountEventsToProcessTest(bit9test.Bit9TestCase):
   @mock.patch.object(bit9_syncing.monitoring, 'events_to_process')
   def testSuccess(self, mock_metric):
     expected_length = 5
-    for _ in xrange(expected_length):
-      bit9_syncing._UnsyncedEvent().put()
+    bit9_syncing._PutUnsyncedEvents(
+        [bit9_syncing._UnsyncedEvent() for _ in xrange(expected_length)])
 
     response = self.testapp.get(
         self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
@@ -1467,6 +1709,19 @@ class CountEventsToProcessTest(bit9test.Bit9TestCase):
     actual_length = mock_metric.Set.call_args_list[0][0][0]
     self.assertEqual(expected_length, actual_length)
 
+  @mock.patch.object(bit9_syncing.monitoring, 'events_to_process')
+  def testDriftCorrected(self, mock_metric):
+    # Simulate a count which has drifted from the drained backlog.
+    bit9_syncing._AdjustUnsyncedEventCount(3)
+
+    response = self.testapp.get(
+        self.ROUTE, headers={'X-AppEngine-Cron': 'true'})
+
+    self.assertEqual(httplib.OK, response.status_int)
+    actual_length = mock_metric.Set.call_args_list[0][0][0]
+    self.assertEqual(0, actual_length)
+    self.assertEqual(0, bit9_syncing._GetUnsyncedEventCount())
+
 
 class ProcessEventsTest(bit9test.Bit9TestCase):
 
@@ -21,6 +21,7 @@ from webapp2_extras import routes
 from upvote.gae.cron import bit9_syncing
 from upvote.gae.cron import datastore_backup
 from upvote.gae.cron import role_syncing
+from upvote.gae.cron import rule_retention
 
 _ALL_ROUTES = [
     routes.PathPrefixRoute(
@@ -28,7 +29,8 @@ _ALL_ROUTES = [
         [
             bit9_syncing.ROUTES,
             datastore_backup.ROUTES,
-            role_syncing.ROUTES
+            role_syncing.ROUTES,
+            rule_retention.ROUTES,
         ]),
 ]
 
@@ -0,0 +1,139 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cron job for archiving old disabled Rules.
+
+Rules are never deleted when they're disabled, so without this the Rule kind
+and its composite indexes would grow without bound, slowing down every
+in_effect query made by voting, rule syncing and Bit9 change sets. Disabled
+Rules older than settings.DISABLED_RULE_RETENTION_DAYS are copied to the
+unindexed ArchivedRule kind and deleted, in batches, by a chain of tasks.
+"""
+
+import datetime
+import logging
+
+import webapp2
+from webapp2_extras import routes
+
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from upvote.gae import settings
+from upvote.gae.datastore.models import rule as rule_models
+from upvote.gae.utils import handler_utils
+from upvote.gae.utils import monitoring_utils
+from upvote.gae.utils import time_utils
+from upvote.monitoring import metrics
+from upvote.shared import constants
+
+
+# The number of Rules archived between checkpoints.
+_BATCH_SIZE = 100
+
+# The amount of time a task runs for before handing off to a new one.
+_TASK_DURATION = datetime.timedelta(minutes=9)
+
+_RULES_ARCHIVED = monitoring_utils.Counter(metrics.VOTING.RULES_ARCHIVED)
+
+
+def _GetPendingBlockableKeys(blockable_keys):
+  """Returns the Blockables which have uncommitted RuleChangeSets.
+
+  A RuleChangeSet refers to its Rules by key, so they can't be archived until
+  it has been committed to Bit9.
+
+  Args:
+    blockable_keys: set<Key>, The Blockables to check.
+
+  Returns:
+    The subset of blockable_keys with outstanding RuleChangeSets.
+  """
+  blockable_keys = list(blockable_keys)
+  futures = [
+      rule_models.RuleChangeSet.query(ancestor=blockable_key).get_async(
+          keys_only=True)
+      for blockable_key in blockable_keys]
+  return {
+      blockable_key
+      for blockable_key, future in zip(blockable_keys, futures)
+      if future.get_result() is not None}
+
+
+def _ArchiveRules(cutoff_dt, cursor=None):
+  """Archives disabled Rules last updated before cutoff_dt.
+
+  Args:
+    cutoff_dt: datetime, Rules disabled before this time are archived.
+    cursor: str, The urlsafe query cursor to resume from, if any.
+  """
+  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+  query = rule_models.Rule.query(
+      rule_models.Rule.in_effect == False,
+      rule_models.Rule.updated_dt < cutoff_dt).order(
+          rule_models.Rule.updated_dt, rule_models.Rule.key)
+  # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+
+  cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+  start_time = time_utils.Now()
+  archived_count = 0
+  skipped_count = 0
+
+  # Always make progress on at least one batch, even if the task started late.
+  while True:
+    rules, cursor, more = query.fetch_page(_BATCH_SIZE, start_cursor=cursor)
+
+    pending_keys = _GetPendingBlockableKeys(
+        {rule.key.parent() for rule in rules})
+    rules_to_archive = [
+        rule for rule in rules if rule.key.parent() not in pending_keys]
+    skipped_count += len(rules) - len(rules_to_archive)
+
+    # The archive copies are keyed by Rule ID, so if the delete fails they'll
+    # just be overwritten when the Rules are next archived.
+    ndb.put_multi(
+        [rule_models.ArchivedRule.FromRule(rule) for rule in rules_to_archive])
+    ndb.delete_multi([rule.key for rule in rules_to_archive])
+
+    archived_count += len(rules_to_archive)
+    _RULES_ARCHIVED.IncrementBy(len(rules_to_archive))
+
+    if not more or not time_utils.TimeRemains(start_time, _TASK_DURATION):
+      break
+
+  logging.info(
+      'Archived %d disabled Rule(s), skipped %d with pending change sets',
+      archived_count, skipped_count)
+
+  if more:
+    deferred.defer(
+        _ArchiveRules, cutoff_dt, cursor=cursor.urlsafe(),
+        _queue=constants.TASK_QUEUE.RULE_RETENTION)
+
+
+class ArchiveDisabledRules(handler_utils.CronJobHandler):
+  """Handler for archiving old disabled Rules."""
+
+  def get(self):  # pylint: disable=g-bad-name
+    cutoff_dt = time_utils.Now() - datetime.timedelta(
+        days=settings.DISABLED_RULE_RETENTION_DAYS)
+    logging.info('Archiving Rules disabled before %s', cutoff_dt)
+    deferred.defer(
+        _ArchiveRules, cutoff_dt, _queue=constants.TASK_QUEUE.RULE_RETENTION)
+
+
+ROUTES = routes.PathPrefixRoute('/rules', [
+    webapp2.Route('/archive-disabled', handler=ArchiveDisabledRules),
+])
@@ -0,0 +1,102 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for rule_retention.py."""
+
+import datetime
+import httplib
+
+import mock
+import webapp2
+
+from upvote.gae.cron import rule_retention
+from upvote.gae.datastore import test_utils
+from upvote.gae.datastore.models import rule as rule_models
+from upvote.gae.lib.testing import basetest
+from upvote.shared import constants
+
+
+class ArchiveDisabledRulesTest(basetest.UpvoteTestCase):
+
+  ROUTE = '/rules/archive-disabled'
+
+  def setUp(self):
+    app = webapp2.WSGIApplication(routes=[rule_retention.ROUTES])
+    super(ArchiveDisabledRulesTest, self).setUp(wsgi_app=app)
+
+    # Treat every disabled rule as old enough to be archived.
+    self.PatchSetting('DISABLED_RULE_RETENTION_DAYS', -1)
+
+  def _Run(self):
+    self.testapp.get(
+        self.ROUTE, headers={'X-AppEngine-Cron': 'true'}, status=httplib.OK)
+    self.DrainTaskQueue(constants.TASK_QUEUE.RULE_RETENTION)
+
+  def testArchive(self):
+    blockable = test_utils.CreateSantaBlockable()
+    in_effect_rule = test_utils.CreateSantaRule(blockable.key)
+    disabled_rule = test_utils.CreateSantaRule(
+        blockable.key, in_effect=False, host_id='abc',
+        custom_msg='Not anymore')
+
+    self._Run()
+
+    self.assertIsNotNone(in_effect_rule.key.get())
+    self.assertIsNone(disabled_rule.key.get())
+
+    archived_rule = rule_models.ArchivedRule.get_by_id(
+        disabled_rule.key.id(), parent=blockable.key)
+    self.assertEqual('SantaRule', archived_rule.rule_class)
+    self.assertEqual(disabled_rule.policy, archived_rule.policy)
+    self.assertEqual('abc', archived_rule.host_id)
+    self.assertEqual(disabled_rule.recorded_dt, archived_rule.recorded_dt)
+    self.assertDictEqual({'custom_msg': 'Not anymore'}, archived_rule.details)
+
+  def testNotOldEnough(self):
+    self.PatchSetting('DISABLED_RULE_RETENTION_DAYS', 90)
+    blockable = test_utils.CreateSantaBlockable()
+    test_utils.CreateSantaRule(blockable.key, in_effect=False)
+
+    self._Run()
+
+    self.assertEntityCount(rule_models.Rule, 1)
+    self.assertEntityCount(rule_models.ArchivedRule, 0)
+
+  def testPendingChangeSet(self):
+    binary = test_utils.CreateBit9Binary()
+    rule = test_utils.CreateBit9Rule(binary.key, in_effect=False)
+    test_utils.CreateRuleChangeSet(binary.key, rule_keys=[rule.key])
+
+    self._Run()
+
+    self.assertIsNotNone(rule.key.get())
+    self.assertEntityCount(rule_models.ArchivedRule, 0)
+
+  @mock.patch.object(rule_retention, '_BATCH_SIZE', 2)
+  @mock.patch.object(rule_retention, '_TASK_DURATION', datetime.timedelta(0))
+  def testBatched(self):
+    blockable = test_utils.CreateSantaBlockable()
+    test_utils.CreateSantaRules(blockable.key, 5, in_effect=False)
+
+    self._Run()
+
+    self.assertEntityCount(rule_models.Rule, 0)
+    self.assertEntityCount(rule_models.ArchivedRule, 5)
+
+  def testNotCron(self):
+    self.testapp.get(self.ROUTE, status=httplib.FORBIDDEN)
+
+
+if __name__ == '__main__':
+  basetest.main()
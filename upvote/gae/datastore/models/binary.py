@@ -19,7 +19,6 @@ from google.appengine.ext import ndb
 from google.appengine.ext.ndb import polymodel
 
 from upvote.gae.bigquery import tables
-from upvote.gae.datastore import utils as datastore_utils
 from upvote.gae.datastore.models import event as event_models
 from upvote.gae.datastore.models import mixin
 from upvote.gae.datastore.models import note as note_models
@@ -57,7 +56,9 @@ class Blockable(mixin.Base, polymodel.PolyModel):
     updated_dt: datetime, when this blockable was last updated.
     recorded_dt: datetime, when this file was first seen.
 
-    score: int, social-voting score for this blockable.
+    score: int, social-voting score for this blockable. This is maintained
+        transactionally by voting (see voting.api.BallotBox) rather than
+        re-tallied on every put. CalculateScore() recomputes it from scratch.
 
     flagged: bool, True if a user has flagged this file as potentially unsafe.
 
@@ -66,24 +67,6 @@ class Blockable(mixin.Base, polymodel.PolyModel):
     state_change_dt: datetime, when the state of this blockable changed.
   """
 
-  def _CalculateScore(self):
-    # NOTE: Since the 'score' property is a ComputedProperty, it will
-    # be re-computed before every put. Consequently, when a Blockable is put for
-    # the first time, we won't see a pre-existing value for 'score'. Here, we
-    # avoid the score calculation for newly-created Blockables as they shouldn't
-    # have any Votes associated with them and, thus, should have a score of 0.
-    if not datastore_utils.HasValue(self, 'score'):
-      return 0
-
-    tally = 0
-    votes = self.GetVotes()
-    for vote in votes:
-      if vote.was_yes_vote:
-        tally += vote.weight
-      else:
-        tally -= vote.weight
-    return tally
-
   id_type = ndb.StringProperty(choices=constants.ID_TYPE.SET_ALL, required=True)
   blockable_hash = ndb.StringProperty()
   file_name = ndb.StringProperty()
@@ -104,7 +87,7 @@ class Blockable(mixin.Base, polymodel.PolyModel):
       default=constants.STATE.UNTRUSTED)
   state_change_dt = ndb.DateTimeProperty(auto_now_add=True)
 
-  score = ndb.ComputedProperty(_CalculateScore)
+  score = ndb.IntegerProperty(default=0)
 
   def ChangeState(self, new_state):
     """Helper method for changing the state of this Blockable.
@@ -130,6 +113,14 @@ class Blockable(mixin.Base, polymodel.PolyModel):
         vote_models.Vote.in_effect == True, ancestor=self.key).fetch()
     # pylint: enable=g-explicit-bool-comparison, singleton-comparison
 
+  def CalculateScore(self):
+    """Tallies the weights of all Votes in effect for this Blockable.
+
+    Returns:
+      The score this Blockable should have according to its Votes.
+    """
+    return sum(vote.effective_weight for vote in self.GetVotes())
+
   def GetEvents(self):
     """Retrieves all Events for this Blockable.
 
@@ -148,25 +139,12 @@ class Blockable(mixin.Base, polymodel.PolyModel):
     self.state = constants.STATE.UNTRUSTED
     self.state_change_dt = datetime.datetime.utcnow()
     self.flagged = False
+    self.score = 0
     self.put()
 
     self.InsertBigQueryRow(
         constants.BLOCK_ACTION.RESET, timestamp=self.state_change_dt)
 
-  def to_dict(self, include=None, exclude=None):  # pylint: disable=g-bad-name
-    if exclude is None: exclude = []
-    exclude += ['score']
-    result = super(Blockable, self).to_dict(include=include, exclude=exclude)
-
-    # NOTE: This is not ideal but it prevents CalculateScore from being
-    # called when serializing Blockables. This will return an inaccurate value
-    # if a vote was cast after the Blockable was retrieved but this can be
-    # avoided by wrapping the call to to_dict in a transaction.
-    result['score'] = datastore_utils.GetLocalComputedPropertyValue(
-        self, 'score')
-
-    return result
-
   @classmethod
   def get_by_id(cls, blockable_id, **kwargs):
     if isinstance(blockable_id, str):
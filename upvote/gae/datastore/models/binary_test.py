@@ -43,16 +43,23 @@ class BlockableTest(basetest.UpvoteTestCase):
     self.user = test_utils.CreateUser(email=_TEST_EMAIL)
     self.Login(self.user.email)
 
-  def testAvoidInitialScoreCalculation(self):
+  def testPut_DoesNotTallyVotes(self):
     b = binary_models.Blockable(id_type='SHA256')
     with mock.patch.object(b, 'GetVotes', return_value=[]) as get_votes_mock:
-      # First put should just set the score to be 0 and avoid the Vote query.
+      b.put()
       b.put()
       self.assertFalse(get_votes_mock.called)
+    self.assertEqual(0, b.key.get().score)
 
-      # Now that b has a score value, it should do the Vote query to update it.
-      b.put()
-      self.assertTrue(get_votes_mock.called)
+  def testCalculateScore(self):
+    test_utils.CreateVotes(self.blockable_1, 3, weight=2)
+    test_utils.CreateVote(self.blockable_1, was_yes_vote=False, weight=1)
+
+    # Simulate drift in the stored score.
+    self.blockable_1.score = 0
+    self.blockable_1.put()
+
+    self.assertEqual(5, self.blockable_1.CalculateScore())
 
   def testGetVotes(self):
     self.assertLen(self.blockable_1.GetVotes(), 0)
@@ -87,18 +94,13 @@ class BlockableTest(basetest.UpvoteTestCase):
     self.assertLen(self.blockable_1.GetEvents(), 5)
 
   def testToDict_Score(self):
-    blockable = test_utils.CreateBlockable()
-    test_utils.CreateVote(blockable)
-    # Recalculate the 'score' property
-    blockable.put()
+    blockable = test_utils.CreateBlockable(score=3)
 
-    # Mock out the blockable's _CalculateScore function.
-    with mock.patch.object(
-        blockable._properties['score'], '_func') as calc_mock:  # pylint: disable=protected-access
+    with mock.patch.object(blockable, 'GetVotes') as get_votes_mock:
       blockable_dict = blockable.to_dict()
-      self.assertFalse(calc_mock.called)
+      self.assertFalse(get_votes_mock.called)
       self.assertIn('score', blockable_dict)
-      self.assertEqual(1, blockable_dict['score'])
+      self.assertEqual(3, blockable_dict['score'])
 
   def testGetById(self):
     blockable = test_utils.CreateBlockable()
@@ -14,6 +14,7 @@
 
 """Package-related Datastore models."""
 
+import collections
 import datetime
 
 from google.appengine.ext import ndb
@@ -25,6 +26,19 @@ from upvote.gae.datastore.models import mixin
 from upvote.shared import constants
 
 
+# The number of times a bundle's flags are recounted, if it keeps changing while
+# they're being counted.
+_FLAG_COUNT_ATTEMPTS = 3
+
+
+class Error(Exception):
+  """Base error for package models."""
+
+
+class FlagCountConflictError(Error):
+  """A bundle kept changing while its flags were being counted."""
+
+
 class Package(binary_models.Blockable):
 
   @property
@@ -94,16 +108,12 @@ class SantaBundle(mixin.Santa, Package):
         NOTE: This value isn't populated until the SantaBundle has finished
         being uploaded AND if the bundle's executable is not a Mach-O, it will
         never be populated.
+    flagged_binary_count: int, The number of SantaBundleBinaries whose binary
+        is flagged. None until first counted after the bundle is uploaded.
+    flagged_cert_count: int, The number of SantaBundleBinaries whose signing
+        cert is flagged. None until first counted after the bundle is uploaded.
   """
 
-  def _CalculateScore(self):
-    # NOTE: This workaround prevents score calculations before the
-    # bundle has been uploaded. Voting is disabled on bundles before upload is
-    # complete so there shouldn't be any Votes available to count.
-    if not self.has_been_uploaded:
-      return 0
-    return super(SantaBundle, self)._CalculateScore()
-
   name = ndb.StringProperty()
   bundle_id = ndb.StringProperty()
   version = ndb.StringProperty()
@@ -114,10 +124,8 @@ class SantaBundle(mixin.Santa, Package):
   main_executable_rel_path = ndb.StringProperty()
   main_executable_key = ndb.KeyProperty()
   main_cert_key = ndb.KeyProperty()
-
-  # Overrides binary_models.Blockable.score to suppress score calculation during
-  # upload.
-  score = ndb.ComputedProperty(_CalculateScore)
+  flagged_binary_count = ndb.IntegerProperty()
+  flagged_cert_count = ndb.IntegerProperty()
 
   def InsertBigQueryRow(self, action, **kwargs):
 
@@ -151,39 +159,124 @@ class SantaBundle(mixin.Santa, Package):
   def GetBundleBinaryKeys(cls, bundle_key):
     return SantaBundleBinary.query(ancestor=bundle_key).fetch(keys_only=True)
 
+  @property
+  def has_flag_counts(self):
+    return (
+        self.flagged_binary_count is not None and
+        self.flagged_cert_count is not None)
+
   @classmethod
   @ndb.tasklet
-  def _PageHasFlaggedBinary(cls, page):
+  def _PageCountFlaggedBinaries(cls, page):
     blockables = yield ndb.get_multi_async(
         bundle_binary.blockable_key for bundle_binary in page)
-    raise ndb.Return(any(blockable.flagged for blockable in blockables))
+    raise ndb.Return(sum(1 for blockable in blockables if blockable.flagged))
 
-  def HasFlaggedBinary(self):
-    """Returns whether any of the bundle's blockable contents are flagged."""
+  def _CountFlaggedBinaries(self):
     query = SantaBundleBinary.query(ancestor=self.key)
     futures = [
-        self._PageHasFlaggedBinary(page)
+        self._PageCountFlaggedBinaries(page)
         for page in datastore_utils.Paginate(query, page_size=1000)]
-    return any(future.get_result() for future in futures)
+    return sum(future.get_result() for future in futures)
 
   @classmethod
   @ndb.tasklet
-  def _PageHasFlaggedCert(cls, page):
-    certs = yield ndb.get_multi_async(
+  def _PageCountFlaggedCerts(cls, page):
+    cert_keys = set(
         bundle_binary.cert_key
         for bundle_binary in page
         if bundle_binary.cert_key)
-    raise ndb.Return(any(cert.flagged for cert in certs))
+    certs = yield ndb.get_multi_async(cert_keys)
+    flagged_keys = set(cert.key for cert in certs if cert and cert.flagged)
+    raise ndb.Return(sum(
+        1 for bundle_binary in page if bundle_binary.cert_key in flagged_keys))
 
-  def HasFlaggedCert(self):
-    """Returns whether any of the bundle's signing certs are flagged."""
+  def _CountFlaggedCerts(self):
     query = SantaBundleBinary.query(
-        projection=[SantaBundleBinary.cert_key], distinct=True,
-        ancestor=self.key)
+        projection=[SantaBundleBinary.cert_key], ancestor=self.key)
     futures = [
-        self._PageHasFlaggedCert(page)
+        self._PageCountFlaggedCerts(page)
         for page in datastore_utils.Paginate(query, page_size=1000)]
-    return any(future.get_result() for future in futures)
+    return sum(future.get_result() for future in futures)
+
+  def HasFlaggedBinary(self):
+    """Returns whether any of the bundle's blockable contents are flagged."""
+    if self.flagged_binary_count is not None:
+      return self.flagged_binary_count > 0
+    return self._CountFlaggedBinaries() > 0
+
+  def HasFlaggedCert(self):
+    """Returns whether any of the bundle's signing certs are flagged."""
+    if self.flagged_cert_count is not None:
+      return self.flagged_cert_count > 0
+    return self._CountFlaggedCerts() > 0
+
+  @classmethod
+  def UpdateFlagCounts(cls, bundle_key):
+    """Recounts the flagged binaries and certs of a bundle from its contents.
+
+    This is called whenever the flag of one of the bundle's binaries or certs
+    changes, and once the bundle has been uploaded. The contents are counted
+    outside of a transaction because they can span more than 25 entity groups,
+    so the counts are only stored if the bundle hasn't been put since counting
+    began. Otherwise, they're counted again.
+
+    Args:
+      bundle_key: Key, The key of the SantaBundle.
+
+    Returns:
+      bool, Whether the stored counts changed.
+
+    Raises:
+      FlagCountConflictError: if the bundle kept changing while being counted.
+    """
+
+    @ndb.transactional
+    def _SetCounts(counted_dt, binary_count, cert_count):
+      bundle = bundle_key.get()
+      if bundle.updated_dt != counted_dt:
+        return None
+      if (bundle.flagged_binary_count == binary_count and
+          bundle.flagged_cert_count == cert_count):
+        return False
+      bundle.flagged_binary_count = binary_count
+      bundle.flagged_cert_count = cert_count
+      bundle.put()
+      return True
+
+    for _ in xrange(_FLAG_COUNT_ATTEMPTS):
+      bundle = bundle_key.get(use_cache=False, use_memcache=False)
+      if bundle is None:
+        return False
+      changed = _SetCounts(
+          bundle.updated_dt,
+          bundle._CountFlaggedBinaries(),  # pylint: disable=protected-access
+          bundle._CountFlaggedCerts())  # pylint: disable=protected-access
+      if changed is not None:
+        return changed
+
+    raise FlagCountConflictError(
+        'Bundle %s changed while counting its flags' % bundle_key.id())
+
+  @classmethod
+  def GetMemberCountsByBundle(cls, blockable_key=None, cert_key=None):
+    """Finds the bundles containing a binary, or binaries signed by a cert.
+
+    Args:
+      blockable_key: Key, The key of a SantaBlockable.
+      cert_key: Key, The key of a SantaCertificate.
+
+    Returns:
+      A Counter mapping the key of each SantaBundle to the number of its
+      SantaBundleBinaries which reference the binary or cert.
+    """
+    if blockable_key is not None:
+      query = SantaBundleBinary.query(
+          SantaBundleBinary.blockable_key == blockable_key)
+    else:
+      query = SantaBundleBinary.query(SantaBundleBinary.cert_key == cert_key)
+    return collections.Counter(
+        key.parent() for key in query.iter(keys_only=True))
 
   def to_dict(self, include=None, exclude=None):  # pylint: disable=g-bad-name
     result = super(SantaBundle, self).to_dict(include=include, exclude=exclude)
@@ -81,6 +81,91 @@ class SantaBundleTest(basetest.UpvoteTestCase):
 
     self.assertFalse(bundle.HasFlaggedCert())
 
+  def testHasFlaggedBinary_Counted(self):
+    bundle = test_utils.CreateSantaBundle(
+        bundle_binaries=test_utils.CreateSantaBlockables(3))
+    bundle.flagged_binary_count = 1
+    bundle.flagged_cert_count = 0
+
+    self.assertTrue(bundle.HasFlaggedBinary())
+    self.assertFalse(bundle.HasFlaggedCert())
+
+  def testUpdateFlagCounts(self):
+    cert = test_utils.CreateSantaCertificate(flagged=True)
+    bundle_binaries = test_utils.CreateSantaBlockables(5)
+    bundle_binaries[0].flagged = True
+    bundle_binaries[0].put()
+    for blockable in bundle_binaries[1:3]:
+      blockable.cert_key = cert.key
+      blockable.put()
+    bundle = test_utils.CreateSantaBundle(bundle_binaries=bundle_binaries)
+    self.assertFalse(bundle.has_flag_counts)
+
+    self.assertTrue(package_models.SantaBundle.UpdateFlagCounts(bundle.key))
+    bundle = bundle.key.get()
+    self.assertEqual(1, bundle.flagged_binary_count)
+    self.assertEqual(2, bundle.flagged_cert_count)
+
+    # Counting again shouldn't change anything.
+    self.assertFalse(package_models.SantaBundle.UpdateFlagCounts(bundle.key))
+
+  def testUpdateFlagCounts_ChangedWhileCounting(self):
+    blockable = test_utils.CreateSantaBlockable()
+    bundle = test_utils.CreateSantaBundle(bundle_binaries=[blockable])
+    count_flagged = package_models.SantaBundle._CountFlaggedBinaries
+
+    # Flag the binary once the first count is done, as a concurrent vote would.
+    def _CountAndFlag(bundle):
+      count = count_flagged(bundle)
+      if not blockable.flagged:
+        blockable.flagged = True
+        blockable.put()
+        bundle.key.get().put()
+      return count
+
+    mock_count = self.Patch(
+        package_models.SantaBundle, '_CountFlaggedBinaries', autospec=True,
+        side_effect=_CountAndFlag)
+
+    self.assertTrue(package_models.SantaBundle.UpdateFlagCounts(bundle.key))
+
+    self.assertEqual(2, mock_count.call_count)
+    self.assertEqual(1, bundle.key.get().flagged_binary_count)
+
+  def testUpdateFlagCounts_Conflict(self):
+    bundle = test_utils.CreateSantaBundle(
+        bundle_binaries=test_utils.CreateSantaBlockables(1))
+
+    def _CountAndPut(bundle):
+      bundle.key.get().put()
+      return 0
+
+    self.Patch(
+        package_models.SantaBundle, '_CountFlaggedBinaries', autospec=True,
+        side_effect=_CountAndPut)
+
+    with self.assertRaises(package_models.FlagCountConflictError):
+      package_models.SantaBundle.UpdateFlagCounts(bundle.key)
+
+    self.assertFalse(bundle.key.get().has_flag_counts)
+
+  def testGetMemberCountsByBundle(self):
+    cert = test_utils.CreateSantaCertificate()
+    blockable = test_utils.CreateSantaBlockable(cert_key=cert.key)
+    other = test_utils.CreateSantaBlockable(cert_key=cert.key)
+    bundle_1 = test_utils.CreateSantaBundle(bundle_binaries=[blockable, other])
+    bundle_2 = test_utils.CreateSantaBundle(bundle_binaries=[blockable])
+    test_utils.CreateSantaBundle(bundle_binaries=[other])
+
+    self.assertDictEqual(
+        {bundle_1.key: 1, bundle_2.key: 1},
+        package_models.SantaBundle.GetMemberCountsByBundle(
+            blockable_key=blockable.key))
+    self.assertEqual(
+        4,
+        sum(package_models.SantaBundle.GetMemberCountsByBundle(
+            cert_key=cert.key).values()))
+
   def testIsInstance(self):
     bundle = test_utils.CreateSantaBundle()
     self.assertTrue(bundle.IsInstance('Blockable'))
@@ -88,17 +173,6 @@ class SantaBundleTest(basetest.UpvoteTestCase):
     self.assertTrue(bundle.IsInstance('SantaBundle'))
     self.assertFalse(bundle.IsInstance('SomethingElse'))
 
-  def testIgnoreCalculateScoreBeforeUpload(self):
-    bundle = test_utils.CreateSantaBundle(uploaded_dt=None)
-    test_utils.CreateVote(bundle)
-
-    # Trigger the SantaBundle.score ComputedProperty calculation.
-    bundle.put()
-
-    # The score should have not reflected the real score until the bundle is
-    # uploaded.
-    self.assertEqual(0, bundle.key.get().score)
-
   def testToDict(self):
     bundle = test_utils.CreateSantaBundle()
     with self.LoggedInUser():
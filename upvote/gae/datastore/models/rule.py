@@ -134,3 +134,60 @@ class SantaRule(mixin.Santa, Rule):
   policy = ndb.StringProperty(
       choices=constants.RULE_POLICY.SET_SANTA, required=True)
   custom_msg = ndb.StringProperty(default='', indexed=False)
+
+
+class ArchivedRule(ndb.Model):
+  """A disabled Rule which has been moved out of the Rule kind.
+
+  Disabled Rules are never read by voting or rule syncing, so once they're old
+  enough they're moved here by gae/cron/rule_retention.py, which keeps the Rule
+  kind and its composite indexes from growing without bound. None of these
+  properties are indexed.
+
+  key = Key(Blockable, sha256) -> Key(ArchivedRule, <ID of the original Rule>)
+
+  Attributes:
+    rule_class: str, The class of the original Rule, e.g. 'SantaRule'.
+    rule_type: str, The rule_type of the original Rule.
+    policy: str, The policy of the original Rule.
+    host_id: str, The host_id of the original Rule.
+    user_key: Key, The user_key of the original Rule.
+    recorded_dt: datetime, When the original Rule was created.
+    updated_dt: datetime, When the original Rule was last updated.
+    archived_dt: datetime, When the original Rule was archived.
+    details: dict, The client-specific properties of the original Rule.
+  """
+  rule_class = ndb.StringProperty(indexed=False)
+  rule_type = ndb.StringProperty(indexed=False)
+  policy = ndb.StringProperty(indexed=False)
+  host_id = ndb.StringProperty(indexed=False)
+  user_key = ndb.KeyProperty(indexed=False)
+  recorded_dt = ndb.DateTimeProperty(indexed=False)
+  updated_dt = ndb.DateTimeProperty(indexed=False)
+  archived_dt = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+  details = ndb.JsonProperty(compressed=True)
+
+  @classmethod
+  def FromRule(cls, rule):
+    """Creates an unsaved ArchivedRule from a Rule.
+
+    The ArchivedRule is keyed by the Rule's ID, so archiving the same Rule more
+    than once just overwrites the earlier copy.
+
+    Args:
+      rule: Rule, The Rule to archive.
+
+    Returns:
+      The new ArchivedRule.
+    """
+    common_properties = set(Rule._properties)  # pylint: disable=protected-access
+    details = {
+        name: value
+        for name, value in rule.to_dict(exclude=common_properties).iteritems()
+        if isinstance(value, (basestring, bool, int, long, float))}
+    return cls(
+        parent=rule.key.parent(), id=rule.key.id(),
+        rule_class=rule.__class__.__name__, rule_type=rule.rule_type,
+        policy=rule.policy, host_id=rule.host_id, user_key=rule.user_key,
+        recorded_dt=rule.recorded_dt, updated_dt=rule.updated_dt,
+        details=details)
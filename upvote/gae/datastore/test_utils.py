@@ -353,6 +353,13 @@ def CreateVote(blockable, **kwargs):
   vote.key = vote_models.Vote.GetKey(
       blockable.key, ndb.Key(user_models.User, defaults['user_email']))
   vote.put()
+
+  # Keep the Blockable's score consistent with its Votes, as voting would.
+  stored_blockable = blockable.key.get()
+  stored_blockable.score += vote.effective_weight
+  stored_blockable.put()
+  blockable.score = stored_blockable.score
+
   return vote
 
 
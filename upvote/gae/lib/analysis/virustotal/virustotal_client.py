@@ -59,7 +59,8 @@ def _OnlyCacheAnalyzed(unused_call_args, unused_call_kwargs, call_return):
     key_name='VirusTotalLookup',
     create_key_func=_CreateLookupCacheKey,
     expire_time=_RESULT_CACHE_TIMEOUT,
-    cache_predicate=_OnlyCacheAnalyzed)
+    cache_predicate=_OnlyCacheAnalyzed,
+    single_flight=True)
 def Lookup(binary_hash):
   """Queries VirusTotal for the given binary hash.
 
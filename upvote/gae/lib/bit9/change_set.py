@@ -14,8 +14,14 @@
 
 """Module for committing Upvote Rules to the Bit9 database."""
 
+import collections
 import datetime
+import functools
+import itertools
 import logging
+import operator
+
+from concurrent import futures
 
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
@@ -32,57 +38,124 @@ from upvote.shared import constants
 
 _COMMIT_RETRIES = 3
 
+# The maximum number of computer IDs to OR together in a single fileInstance
+# query. Keeps request URLs to a reasonable length for large local fan-outs.
+_FILE_INSTANCE_QUERY_BATCH_SIZE = 50
+
+# The maximum number of fileInstance state changes to issue to Bit9 at once.
+_MAX_CONCURRENT_STATE_CHANGES = 10
+
 # The amount of time since last sync for which a Computer is considered active.
 _ACTIVITY_WINDOW = datetime.timedelta(days=1)
 
 
-def ChangeLocalState(blockable, local_rule, new_state):
-  """Handles requests for changing local approval state."""
+def _GetFileInstances(file_catalog_id, host_ids):
+  """Retrieves the fileInstances of a fileCatalog across a number of hosts.
+
+  Rather than issuing one query per host, the computer IDs are OR'd together
+  into a single filter, in batches to keep the request URLs reasonably sized.
+
+  Args:
+    file_catalog_id: int, The ID of the fileCatalog.
+    host_ids: list<int>, The IDs of the computers to query for.
+
+  Returns:
+    A dict mapping each computer ID to a list of its matching fileInstances.
+  """
+  instances_by_host = collections.defaultdict(list)
+
+  for i in xrange(0, len(host_ids), _FILE_INSTANCE_QUERY_BATCH_SIZE):
+    batch = host_ids[i:i + _FILE_INSTANCE_QUERY_BATCH_SIZE]
+    host_filter = functools.reduce(
+        operator.or_,
+        (api.FileInstance.computer_id == host_id for host_id in batch))
+
+    query = api.FileInstance.query()
+    query = query.filter(host_filter)
+    query = query.filter(api.FileInstance.file_catalog_id == file_catalog_id)
+    file_instances = query.execute(bit9_utils.CONTEXT)
+    logging.info(
+        'Retrieved %d matching fileInstance(s) across %d host(s)',
+        len(file_instances), len(batch))
+
+    for instance in file_instances:
+      instances_by_host[instance.computer_id].append(instance)
+
+  return instances_by_host
+
+
+def _ChangeFileInstanceState(instance, new_state):
+  logging.info('Attempting state change on fileInstance %s', instance.id)
+
+  # NOTE: Even if the local_state is in the desired state, we
+  # should try to update it because the local_state value doesn't
+  # necessarily reflect the prescribed state. Changes are only visible on
+  # the fileInstance once the host has checked into Bit9.
+  instance.local_state = new_state
+  return instance.put(bit9_utils.CONTEXT)
+
+
+def ChangeLocalStates(blockable, local_rules, new_state):
+  """Handles requests for changing local approval state on many hosts.
+
+  Args:
+    blockable: Bit9Binary, The blockable whose local state should change.
+    local_rules: list<Bit9Rule>, The local rules to be fulfilled.
+    new_state: bit9_constants.APPROVAL_STATE, The desired local state.
+  """
+  if not local_rules:
+    return
 
   file_catalog_id = int(blockable.file_catalog_id)
-  host_id = int(local_rule.host_id)
+  host_ids = sorted(set(int(rule.host_id) for rule in local_rules))
   new_state_str = bit9_constants.APPROVAL_STATE.MAP_TO_STR[new_state]
 
   logging.info(
-      'Locally marking %s as %s on host %s', blockable.key.id(), new_state_str,
-      local_rule.host_id)
-
-  # Query Bit9 for all matching fileInstances on the given host.
-  query = api.FileInstance.query()
-  query = query.filter(api.FileInstance.computer_id == host_id)
-  query = query.filter(api.FileInstance.file_catalog_id == file_catalog_id)
-  file_instances = query.execute(bit9_utils.CONTEXT)
-  logging.info('Retrieved %s matching fileInstance(s)', len(file_instances))
-
-  # If none are found, update the Rule and bail.
-  if not file_instances:
-    monitoring.file_instances_missing.Increment()
-    logging.info('Local rule could not be fulfilled')
-    local_rule.is_fulfilled = False
-    local_rule.put()
-    local_rule.InsertBigQueryRow(comment='Missing fileInstance')
-    return
+      'Locally marking %s as %s on %d host(s)', blockable.key.id(),
+      new_state_str, len(host_ids))
+
+  # Query Bit9 for all matching fileInstances on the given hosts.
+  instances_by_host = _GetFileInstances(file_catalog_id, host_ids)
+
+  # Make the desired state change on each fileInstance retrieved. If any of
+  # these fail, let the Exception escape so the change set can be retried.
+  file_instances = list(itertools.chain.from_iterable(
+      instances_by_host.itervalues()))
+  if file_instances:
+    max_workers = min(len(file_instances), _MAX_CONCURRENT_STATE_CHANGES)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      running_futures = [
+          executor.submit(_ChangeFileInstanceState, instance, new_state)
+          for instance in file_instances]
+      for done_future in futures.as_completed(running_futures):
+        done_future.result()
+
+  # Update each Rule.is_fulfilled to reflect whether the local state change
+  # was successfully propagated to Bit9. If no fileInstance exists on a host,
+  # the rule can't be fulfilled until the blockable runs there.
+  for local_rule in local_rules:
+    if instances_by_host.get(int(local_rule.host_id)):
+      logging.info(
+          'Local rule was successfully fulfilled on host %s',
+          local_rule.host_id)
+      local_rule.is_fulfilled = True
 
-  # Make the desired state change on each fileInstance retrieved.
-  for instance in file_instances:
-    logging.info('Attempting state change on fileInstance %s', instance.id)
+      # Insert a special BigQuery Rule row indicating when/if this rule
+      # ultimately gets fulfilled.
+      local_rule.InsertBigQueryRow(comment='Fulfilled in Bit9')
+    else:
+      monitoring.file_instances_missing.Increment()
+      logging.info(
+          'Local rule could not be fulfilled on host %s', local_rule.host_id)
+      local_rule.is_fulfilled = False
+      local_rule.InsertBigQueryRow(comment='Missing fileInstance')
 
-    # NOTE: Even if the local_state is in the desired state, we
-    # should try to update it because the local_state value doesn't
-    # necessarily reflect the prescribed state. Changes are only visible on
-    # the fileInstance once the host has checked into Bit9.
-    instance.local_state = new_state
-    instance.put(bit9_utils.CONTEXT)
+  ndb.put_multi(local_rules)
 
-    # Update the Rule.is_fulfilled to reflect whether the local state change
-    # was successfully propagated to Bit9.
-    logging.info('Local rule was successfully fulfilled')
-    local_rule.is_fulfilled = True
-    local_rule.put()
 
-    # Insert a special BigQuery Rule row indicating when/if this rule ultimately
-    # gets fulfilled.
-    local_rule.InsertBigQueryRow(comment='Fulfilled in Bit9')
+def ChangeLocalState(blockable, local_rule, new_state):
+  """Handles requests for changing local approval state."""
+  ChangeLocalStates(blockable, [local_rule], new_state)
 
 
 def _ChangeLocalStates(blockable, local_rules, new_state):
@@ -91,8 +164,7 @@ def _ChangeLocalStates(blockable, local_rules, new_state):
     logging.warning('Cannot change local state for certificates in Bit9')
     return
 
-  for local_rule in local_rules:
-    ChangeLocalState(blockable, local_rule, new_state)
+  ChangeLocalStates(blockable, local_rules, new_state)
 
 
 def _ChangeGlobalState(blockable, new_state):
@@ -168,10 +168,97 @@ class ChangeLocalStateTest(bit9test.Bit9TestCase):
     self.assertBigQueryInsertion(constants.BIGQUERY_TABLE.RULE)
 
 
-class ChangeLocalStatesTest(basetest.UpvoteTestCase):
+class ChangeLocalStatesTest(bit9test.Bit9TestCase):
 
-  @mock.patch.object(change_set, 'ChangeLocalState')
-  def testSuccess(self, mock_change_local_state):
+  def testMultipleHosts(self):
+
+    binary = test_utils.CreateBit9Binary(file_catalog_id='1111')
+    user = test_utils.CreateUser()
+    rule_1 = test_utils.CreateBit9Rule(
+        binary.key, host_id='2222', user_key=user.key,
+        policy=constants.RULE_POLICY.WHITELIST, is_fulfilled=False)
+    rule_2 = test_utils.CreateBit9Rule(
+        binary.key, host_id='3333', user_key=user.key,
+        policy=constants.RULE_POLICY.WHITELIST, is_fulfilled=False)
+    rule_3 = test_utils.CreateBit9Rule(
+        binary.key, host_id='4444', user_key=user.key,
+        policy=constants.RULE_POLICY.WHITELIST, is_fulfilled=False)
+
+    # Only the first two hosts have a fileInstance.
+    fi_1 = api.FileInstance(
+        id=5555, file_catalog_id=1111, computer_id=2222,
+        local_state=bit9_constants.APPROVAL_STATE.UNAPPROVED)
+    fi_2 = api.FileInstance(
+        id=6666, file_catalog_id=1111, computer_id=3333,
+        local_state=bit9_constants.APPROVAL_STATE.UNAPPROVED)
+    self.PatchApiRequests([fi_1, fi_2], fi_1, fi_2)
+
+    change_set.ChangeLocalStates(
+        binary, [rule_1, rule_2, rule_3],
+        bit9_constants.APPROVAL_STATE.APPROVED)
+
+    # All hosts should be covered by a single fileInstance query.
+    self.mock_ctx.ExecuteRequest.assert_any_call(
+        'GET', api_route='fileInstance',
+        query_args=['q=computerId:2222|3333|4444', 'q=fileCatalogId:1111'])
+    self.mock_ctx.ExecuteRequest.assert_has_calls([
+        mock.call(
+            'POST', api_route='fileInstance',
+            data={'id': 5555,
+                  'localState': 2,
+                  'fileCatalogId': 1111,
+                  'computerId': 2222},
+            query_args=None),
+        mock.call(
+            'POST', api_route='fileInstance',
+            data={'id': 6666,
+                  'localState': 2,
+                  'fileCatalogId': 1111,
+                  'computerId': 3333},
+            query_args=None)], any_order=True)
+    self.assertEqual(3, self.mock_ctx.ExecuteRequest.call_count)
+
+    self.assertTrue(rule_1.key.get().is_fulfilled)
+    self.assertTrue(rule_2.key.get().is_fulfilled)
+    self.assertFalse(rule_3.key.get().is_fulfilled)
+    self.assertBigQueryInsertions([constants.BIGQUERY_TABLE.RULE] * 3)
+
+  @mock.patch.object(change_set, '_FILE_INSTANCE_QUERY_BATCH_SIZE', 2)
+  def testQueryBatching(self):
+
+    binary = test_utils.CreateBit9Binary(file_catalog_id='1111')
+    local_rules = [
+        test_utils.CreateBit9Rule(binary.key, host_id=str(host_id))
+        for host_id in (1, 2, 3)]
+    self.PatchApiRequests([], [])
+
+    change_set.ChangeLocalStates(
+        binary, local_rules, bit9_constants.APPROVAL_STATE.APPROVED)
+
+    self.mock_ctx.ExecuteRequest.assert_has_calls([
+        mock.call(
+            'GET', api_route='fileInstance',
+            query_args=['q=computerId:1|2', 'q=fileCatalogId:1111']),
+        mock.call(
+            'GET', api_route='fileInstance',
+            query_args=['q=computerId:3', 'q=fileCatalogId:1111'])])
+    for local_rule in local_rules:
+      self.assertFalse(local_rule.key.get().is_fulfilled)
+    self.assertBigQueryInsertions([constants.BIGQUERY_TABLE.RULE] * 3)
+
+  @mock.patch.object(change_set, 'ChangeLocalStates')
+  def testCertificate(self, mock_change_local_states):
+
+    cert = test_utils.CreateBit9Certificate()
+    local_rules = test_utils.CreateBit9Rules(cert.key, 3)
+
+    change_set._ChangeLocalStates(
+        cert, local_rules, bit9_constants.APPROVAL_STATE.APPROVED)
+
+    self.assertFalse(mock_change_local_states.called)
+
+  @mock.patch.object(change_set, 'ChangeLocalStates')
+  def testSuccess(self, mock_change_local_states):
 
     binary = test_utils.CreateBit9Binary(file_catalog_id='1111')
     rule_count = 11
@@ -180,7 +267,8 @@ class ChangeLocalStatesTest(basetest.UpvoteTestCase):
     change_set._ChangeLocalStates(
         binary, local_rules, bit9_constants.APPROVAL_STATE.APPROVED)
 
-    self.assertEqual(rule_count, mock_change_local_state.call_count)
+    mock_change_local_states.assert_called_once_with(
+        binary, local_rules, bit9_constants.APPROVAL_STATE.APPROVED)
 
 
 class CommitBlockableChangeSetTest(bit9test.Bit9TestCase):
@@ -323,14 +411,15 @@ class CommitBlockableChangeSetTest(bit9test.Bit9TestCase):
         local_state=bit9_constants.APPROVAL_STATE.UNAPPROVED)
     rule = api.FileRule(
         file_catalog_id=1234, file_state=bit9_constants.APPROVAL_STATE.APPROVED)
-    self.PatchApiRequests([fi1], fi1, [fi2], fi2, rule)
+    self.PatchApiRequests([fi1, fi2], fi1, fi2, rule)
 
     change_set._CommitBlockableChangeSet(self.binary.key)
 
     self.mock_ctx.ExecuteRequest.assert_has_calls([
         mock.call(
             'GET', api_route='fileInstance',
-            query_args=[r'q=computerId:5678', 'q=fileCatalogId:1234']),
+            query_args=[r'q=computerId:5678|9012', 'q=fileCatalogId:1234'])])
+    self.mock_ctx.ExecuteRequest.assert_has_calls([
         mock.call(
             'POST', api_route='fileInstance',
             data={'id': 9012,
@@ -338,20 +427,18 @@ class CommitBlockableChangeSetTest(bit9test.Bit9TestCase):
                   'fileCatalogId': 1234,
                   'computerId': 5678},
             query_args=None),
-        mock.call(
-            'GET', api_route='fileInstance',
-            query_args=[r'q=computerId:9012', 'q=fileCatalogId:1234']),
         mock.call(
             'POST', api_route='fileInstance',
             data={'id': 9012,
                   'localState': 2,
                   'fileCatalogId': 1234,
                   'computerId': 9012},
-            query_args=None),
+            query_args=None)], any_order=True)
+    self.assertEqual(
         mock.call(
             'POST', api_route='fileRule',
             data={'fileCatalogId': 1234, 'fileState': 2}, query_args=None),
-    ])
+        self.mock_ctx.ExecuteRequest.call_args)
 
     self.assertTrue(self.local_rule.key.get().is_fulfilled)
     self.assertTrue(self.local_rule.key.get().is_committed)
@@ -421,14 +508,15 @@ class CommitBlockableChangeSetTest(bit9test.Bit9TestCase):
         local_state=bit9_constants.APPROVAL_STATE.APPROVED)
     rule = api.FileRule(
         file_catalog_id=1234, file_state=bit9_constants.APPROVAL_STATE.APPROVED)
-    self.PatchApiRequests([fi1], fi1, [fi2], fi2, rule)
+    self.PatchApiRequests([fi1, fi2], fi1, fi2, rule)
 
     change_set._CommitBlockableChangeSet(self.binary.key)
 
     self.mock_ctx.ExecuteRequest.assert_has_calls([
         mock.call(
             'GET', api_route='fileInstance',
-            query_args=[r'q=computerId:5678', 'q=fileCatalogId:1234']),
+            query_args=[r'q=computerId:5678|9012', 'q=fileCatalogId:1234'])])
+    self.mock_ctx.ExecuteRequest.assert_has_calls([
         mock.call(
             'POST', api_route='fileInstance',
             data={'id': 9012,
@@ -436,20 +524,18 @@ class CommitBlockableChangeSetTest(bit9test.Bit9TestCase):
                   'fileCatalogId': 1234,
                   'computerId': 5678},
             query_args=None),
-        mock.call(
-            'GET', api_route='fileInstance',
-            query_args=[r'q=computerId:9012', 'q=fileCatalogId:1234']),
         mock.call(
             'POST', api_route='fileInstance',
             data={'id': 9012,
                   'localState': 1,
                   'fileCatalogId': 1234,
                   'computerId': 9012},
-            query_args=None),
+            query_args=None)], any_order=True)
+    self.assertEqual(
         mock.call(
             'POST', api_route='fileRule',
             data={'fileCatalogId': 1234, 'fileState': 1}, query_args=None),
-    ])
+        self.mock_ctx.ExecuteRequest.call_args)
 
     self.assertTrue(self.local_rule.key.get().is_fulfilled)
     self.assertTrue(self.local_rule.key.get().is_committed)
@@ -122,16 +122,24 @@ class BaseContext(six.with_metaclass(abc.ABCMeta)):
 
 
 class Context(BaseContext):
-  """Defines the configuration for communication with the API."""
+  """Defines the configuration for communication with the API.
+
+  Requests are always made over HTTPS, since they carry the API token, unless
+  allow_http is set and the server address is an http:// URL. This is only
+  meant for local stand-ins such as fake_server.
+  """
 
   def __init__(self,  # pylint: disable=super-init-not-called
                server_address,
                api_token,
                request_timeout,
-               version=constants.VERSION.V1):
+               version=constants.VERSION.V1,
+               allow_http=False):
     if not server_address.startswith('http'):
       server_address = 'https://' + server_address
     addr = six.moves.urllib.parse.urlsplit(server_address)
+    self.server_scheme = (
+        'http' if allow_http and addr.scheme == 'http' else 'https')
     self.server_loc = addr.netloc
     self.server_path = addr.path.rstrip('/')
 
@@ -151,7 +159,7 @@ class Context(BaseContext):
     api_path = '{}/api/bit9platform/{}'.format(self.server_path, self.version)
     path = '{}/{}'.format(api_path, api_route) if api_route else api_path
     return six.moves.urllib.parse.urlunsplit(
-        ['https', self.server_loc, path, '&'.join(query_args), ''])
+        [self.server_scheme, self.server_loc, path, '&'.join(query_args), ''])
 
   def _GetApiHeaders(self):
     return {
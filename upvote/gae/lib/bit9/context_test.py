@@ -72,6 +72,23 @@ class ContextTest(absltest.TestCase):
         'GET', 'https://foo.corn/api/bit9platform/v1/abc', headers=mock.ANY,
         json=None, verify=mock.ANY, timeout=mock.ANY)
 
+  def testHttpSchema(self, mock_req):
+    ctx = context.Context('http://localhost:8080', 'foo', 1)
+    ctx.ExecuteRequest('GET', api_route='abc')
+
+    # The API token shouldn't be sent in plaintext unless explicitly allowed.
+    mock_req.assert_called_once_with(
+        'GET', 'https://localhost:8080/api/bit9platform/v1/abc',
+        headers=mock.ANY, json=None, verify=mock.ANY, timeout=mock.ANY)
+
+  def testHttpSchema_Allowed(self, mock_req):
+    ctx = context.Context('http://localhost:8080', 'foo', 1, allow_http=True)
+    ctx.ExecuteRequest('GET', api_route='abc')
+
+    mock_req.assert_called_once_with(
+        'GET', 'http://localhost:8080/api/bit9platform/v1/abc',
+        headers=mock.ANY, json=None, verify=mock.ANY, timeout=mock.ANY)
+
   def testHeaders(self, mock_req):
     ctx = context.Context('foo.corn', 'foo', 1)
     ctx.ExecuteRequest('GET')
@@ -0,0 +1,402 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An offline, in-memory stand-in for the Bit9 REST API.
+
+This is intended for exercising the Bit9 syncing pipeline end to end without a
+real Bit9 server, e.g. for benchmarking. It understands the subset of the REST
+API produced by query.Query and model.Model: GET/POST/DELETE on
+/api/bit9platform/v1/<route>[/<id>], ':', '!', '>' and '<' filters with
+'|'-separated values, a single sort, offset, limit (including the limit=-1
+count convention) and expand.
+
+FakeBit9 can be used in-process via FakeContext, or served over HTTP via
+scripts/run_fake_bit9.py and reached with an api.Context created with
+allow_http=True.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import six
+from six.moves import range
+import six.moves.http_client
+import six.moves.urllib.parse
+
+from upvote.gae import settings
+from upvote.gae.lib.bit9 import api
+from upvote.gae.lib.bit9 import constants as bit9_constants
+from upvote.gae.lib.bit9 import model
+from upvote.gae.lib.bit9 import test_utils
+
+
+API_PATH = '/api/bit9platform/v1'
+
+_FILTER_RE = re.compile(r'^(?P<name>\w+)(?P<operator>[:!<>])(?P<value>.*)$')
+
+# Maps API routes to their corresponding Model classes, for the routes used by
+# Upvote.
+_ROUTE_MAP = {
+    model_cls.ROUTE: model_cls
+    for model_cls in (
+        api.Certificate, api.Computer, api.Event, api.FileCatalog,
+        api.FileInstance, api.FileRule, api.Policy)
+}
+
+
+def _GetProperty(model_cls, name):
+  for prop in six.itervalues(model_cls._PROPERTIES):  # pylint: disable=protected-access
+    if prop.name == name:
+      return prop
+  return None
+
+
+def _ParseValue(prop, raw):
+  """Converts a raw (string) query value into a comparable Python value."""
+  if raw == '':
+    return None
+  elif isinstance(prop, model.BooleanProperty):
+    return raw.lower() == 'true'
+  elif isinstance(prop, model._IntegerProperty):  # pylint: disable=protected-access
+    return int(raw)
+  elif isinstance(prop, (model.DoubleProperty, model.DecimalProperty)):
+    return float(raw)
+  elif isinstance(prop, model.DateTimeProperty):
+    return prop.raw_to_value(raw)
+  return raw
+
+
+def _NormalizeValue(prop, stored):
+  if stored is not None and isinstance(prop, model.DateTimeProperty):
+    return prop.raw_to_value(stored)
+  return stored
+
+
+class _Filter(object):
+  """A single parsed 'q=' query argument."""
+
+  def __init__(self, model_cls, filter_str):
+    match = _FILTER_RE.match(filter_str)
+    if match is None:
+      raise ValueError('Malformed filter: %s' % filter_str)
+    self.name = match.group('name')
+    self.operator = match.group('operator')
+    self.prop = _GetProperty(model_cls, self.name)
+    if self.prop is None:
+      raise ValueError('Unknown property: %s' % self.name)
+    self.values = [
+        _ParseValue(self.prop, value)
+        for value in match.group('value').split('|')]
+
+  def Matches(self, obj):
+    stored = _NormalizeValue(self.prop, obj.get(self.name))
+    if self.operator == ':':
+      return stored in self.values
+    elif self.operator == '!':
+      return stored not in self.values
+    elif stored is None:
+      return False
+    elif self.operator == '>':
+      return any(stored > value for value in self.values)
+    else:
+      return any(stored < value for value in self.values)
+
+
+_FakeResponse = collections.namedtuple('_FakeResponse', ['status_code', 'text'])
+
+
+class FakeBit9(object):
+  """An in-memory Bit9 server with configurable latency and error injection.
+
+  Attributes:
+    latency: float, The base number of seconds each request takes.
+    latency_jitter: float, The maximum number of additional seconds, chosen
+        uniformly at random, each request takes.
+    error_rate: float, The probability in [0, 1] that a request fails with a
+        503 before being handled.
+    request_counts: Counter, The number of requests handled, keyed by
+        (method, route) tuples.
+    error_counts: Counter, The number of injected errors, keyed likewise.
+  """
+
+  def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+               seed=None):
+    self.latency = latency
+    self.latency_jitter = latency_jitter
+    self.error_rate = error_rate
+    self.request_counts = collections.Counter()
+    self.error_counts = collections.Counter()
+
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._objects = collections.defaultdict(dict)
+    self._next_ids = collections.defaultdict(lambda: 1)
+
+  def Put(self, obj):
+    """Stores an api.Model instance, assigning it an ID if it lacks one."""
+    with self._lock:
+      return self._Put(obj.ROUTE, obj.to_raw_dict())
+
+  def _Put(self, route, raw):
+    raw = dict(raw)
+    if raw.get('id') is None:
+      raw['id'] = self._next_ids[route]
+    self._next_ids[route] = max(self._next_ids[route], raw['id'] + 1)
+    self._objects[route].setdefault(raw['id'], {}).update(raw)
+    return dict(self._objects[route][raw['id']])
+
+  def Count(self, route):
+    with self._lock:
+      return len(self._objects[route])
+
+  def ResetStats(self):
+    with self._lock:
+      self.request_counts.clear()
+      self.error_counts.clear()
+
+  def GetStats(self):
+    """Returns a JSON-friendly summary of the requests handled so far."""
+    with self._lock:
+      return {
+          'requests': {
+              '%s %s' % key: count
+              for key, count in six.iteritems(self.request_counts)},
+          'errors': {
+              '%s %s' % key: count
+              for key, count in six.iteritems(self.error_counts)},
+      }
+
+  def HandleRequest(self, method, api_route=None, query_args=None, data=None):
+    """Handles a single API request.
+
+    Args:
+      method: str, The HTTP method.
+      api_route: str, The route following the API path e.g. 'event/123'.
+      query_args: list<str>, Query args of the form 'name=value'.
+      data: dict, The JSON body of the request, if any.
+
+    Returns:
+      A (status code, JSON-serializable response body) tuple.
+    """
+    route, _, id_ = (api_route or '').partition('/')
+    key = (method, route)
+
+    delay = self.latency + self._random.uniform(0, self.latency_jitter)
+    if delay:
+      time.sleep(delay)
+
+    with self._lock:
+      self.request_counts[key] += 1
+      if self._random.random() < self.error_rate:
+        self.error_counts[key] += 1
+        return six.moves.http_client.SERVICE_UNAVAILABLE, 'Injected error'
+
+      model_cls = _ROUTE_MAP.get(route)
+      if model_cls is None:
+        return six.moves.http_client.NOT_FOUND, 'Unknown route: %s' % route
+
+      try:
+        if method == bit9_constants.METHOD.GET and id_:
+          return self._Get(route, int(id_))
+        elif method == bit9_constants.METHOD.GET:
+          return self._Query(model_cls, query_args or [])
+        elif method == bit9_constants.METHOD.POST:
+          return six.moves.http_client.OK, self._Put(route, data or {})
+        elif method == bit9_constants.METHOD.DELETE and id_:
+          return self._Delete(route, int(id_))
+      except ValueError as e:
+        return six.moves.http_client.BAD_REQUEST, str(e)
+
+      return six.moves.http_client.BAD_REQUEST, 'Unsupported request'
+
+  def _Get(self, route, id_):
+    obj = self._objects[route].get(id_)
+    if obj is None:
+      return six.moves.http_client.NOT_FOUND, 'Object not found'
+    return six.moves.http_client.OK, dict(obj)
+
+  def _Delete(self, route, id_):
+    obj = self._objects[route].pop(id_, None)
+    if obj is None:
+      return six.moves.http_client.NOT_FOUND, 'Object not found'
+    return six.moves.http_client.OK, obj
+
+  def _Query(self, model_cls, query_args):
+    filters, expands = [], []
+    sort, offset, limit = None, 0, None
+    for arg in query_args:
+      name, _, value = arg.partition('=')
+      if name == 'q':
+        filters.append(_Filter(model_cls, value))
+      elif name == 'expand':
+        expands.append(value)
+      elif name == 'sort':
+        sort = value.split(' ')
+      elif name == 'offset':
+        offset = int(value)
+      elif name == 'limit':
+        limit = int(value)
+
+    results = [
+        obj for obj in six.itervalues(self._objects[model_cls.ROUTE])
+        if all(filter_.Matches(obj) for filter_ in filters)]
+
+    if limit == -1:
+      return six.moves.http_client.OK, {'count': len(results)}
+
+    sort_name, sort_dir = sort if sort else ('id', 'ASC')
+    sort_prop = _GetProperty(model_cls, sort_name)
+    results.sort(
+        key=lambda obj: _NormalizeValue(sort_prop, obj.get(sort_name)),
+        reverse=(sort_dir == 'DESC'))
+    results = results[offset:]
+    if limit:
+      results = results[:limit]
+
+    return six.moves.http_client.OK, [
+        self._Expand(model_cls, obj, expands) for obj in results]
+
+  def _Expand(self, model_cls, obj, expands):
+    expanded = dict(obj)
+    for name in expands:
+      prop = _GetProperty(model_cls, name)
+      if prop is None or not prop.expandable:
+        raise ValueError('Cannot expand %s' % name)
+      target_cls = model.Model._KIND_MAP[prop.expands_to]  # pylint: disable=protected-access
+      target = self._objects[target_cls.ROUTE].get(obj.get(name))
+      for target_name, target_value in six.iteritems(target or {}):
+        expanded['%s_%s' % (name, target_name)] = target_value
+    return expanded
+
+
+class FakeContext(api.BaseContext):
+  """An api.Context which sends requests straight to a FakeBit9 instance."""
+
+  def __init__(self, fake):  # pylint: disable=super-init-not-called
+    self.fake = fake
+
+  def ExecuteRequest(self, method, api_route=None, query_args=None, data=None):
+    status_code, body = self.fake.HandleRequest(
+        method, api_route=api_route, query_args=query_args, data=data)
+    return self._UnwrapResponse(_FakeResponse(status_code, json.dumps(body)))
+
+
+def _FormatDateTime(dt):
+  return dt.strftime(model.DateTimeProperty._DATETIME_FORMAT_USEC)  # pylint: disable=protected-access
+
+
+def _FakeSha256(seed):
+  return hashlib.sha256(str(seed)).hexdigest()
+
+
+def SeedEvents(fake, event_count, host_count=10, binary_count=50,
+               signed_ratio=0.5, seed=None):
+  """Populates a FakeBit9 with a synthetic stream of block events.
+
+  Each event is a block of one of binary_count binaries on one of host_count
+  hosts. A fileInstance is created for every (binary, host) pair that appears,
+  so that local state changes can be committed against them. Signed binaries
+  share a small number of two-certificate signing chains.
+
+  Args:
+    fake: FakeBit9, The instance to populate.
+    event_count: int, The number of events to create.
+    host_count: int, The number of distinct computers.
+    binary_count: int, The number of distinct fileCatalogs.
+    signed_ratio: float, The fraction of binaries which have a signing chain.
+    seed: int, An optional seed for the random choices made.
+
+  Returns:
+    The list of created fileCatalog IDs.
+  """
+  rand = random.Random(seed)
+  now = datetime.datetime.utcnow()
+
+  policy = fake.Put(test_utils.CreatePolicy())
+
+  computer_ids = []
+  for i in range(host_count):
+    computer = fake.Put(test_utils.CreateComputer(
+        id=None, name='%s\\host-%d' % (settings.AD_DOMAIN, i),
+        policy_id=policy['id']))
+    computer_ids.append(computer['id'])
+
+  leaf_cert_ids = []
+  for i in range(max(1, binary_count // 10)):
+    root = fake.Put(test_utils.CreateCertificate(
+        id=None, thumbprint=_FakeSha256('root-%d' % i)[:40]))
+    leaf = fake.Put(test_utils.CreateCertificate(
+        id=None, thumbprint=_FakeSha256('leaf-%d' % i)[:40],
+        parent_certificate_id=root['id']))
+    leaf_cert_ids.append(leaf['id'])
+
+  file_catalog_ids = []
+  for i in range(binary_count):
+    cert_id = (
+        rand.choice(leaf_cert_ids) if rand.random() < signed_ratio else 0)
+    file_catalog = fake.Put(test_utils.CreateFileCatalog(
+        id=None, sha256=_FakeSha256('binary-%d' % i),
+        file_name='binary-%d.exe' % i, certificate_id=cert_id))
+    file_catalog_ids.append(file_catalog['id'])
+
+  subtypes = sorted(bit9_constants.SUBTYPE.SET_ALL)
+  file_instances = set()
+  for i in range(event_count):
+    computer_id = rand.choice(computer_ids)
+    file_catalog_id = rand.choice(file_catalog_ids)
+    timestamp = _FormatDateTime(
+        now - datetime.timedelta(seconds=event_count - i))
+    fake.Put(test_utils.CreateEvent(
+        id=None, computer_id=computer_id, file_catalog_id=file_catalog_id,
+        subtype=rand.choice(subtypes), policy_id=policy['id'],
+        timestamp=timestamp, received_timestamp=timestamp))
+
+    if (file_catalog_id, computer_id) not in file_instances:
+      file_instances.add((file_catalog_id, computer_id))
+      fake.Put(api.FileInstance(
+          file_catalog_id=file_catalog_id, computer_id=computer_id,
+          local_state=bit9_constants.APPROVAL_STATE.UNAPPROVED))
+
+  return file_catalog_ids
+
+
+def ParseRequestPath(path):
+  """Splits an HTTP request path into an API route and query args.
+
+  Args:
+    path: str, The path of the request, including any query string.
+
+  Returns:
+    An (api_route, query_args) tuple, or (None, None) if the path isn't under
+    the API path.
+  """
+  split = six.moves.urllib.parse.urlsplit(path)
+  if not split.path.startswith(API_PATH):
+    return None, None
+  api_route = split.path[len(API_PATH):].strip('/')
+  query_args = [
+      '%s=%s' % pair
+      for pair in six.moves.urllib.parse.parse_qsl(
+          split.query, keep_blank_values=True)]
+  return api_route, query_args
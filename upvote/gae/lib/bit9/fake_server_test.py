@@ -0,0 +1,156 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for fake_server.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+
+from upvote.gae.lib.bit9 import api
+from upvote.gae.lib.bit9 import constants as bit9_constants
+from upvote.gae.lib.bit9 import fake_server
+from upvote.gae.lib.bit9 import test_utils
+from absl.testing import absltest
+
+
+class FakeBit9Test(absltest.TestCase):
+
+  def setUp(self):
+    super(FakeBit9Test, self).setUp()
+    self.fake = fake_server.FakeBit9(seed=0)
+    self.ctx = fake_server.FakeContext(self.fake)
+
+  def testGetAndPut(self):
+    self.fake.Put(test_utils.CreateComputer(id=123, policy_id=1))
+
+    computer = api.Computer.get(123, self.ctx)
+    computer.policy_id = 2
+    computer.put(self.ctx)
+
+    self.assertEqual(2, api.Computer.get(123, self.ctx).policy_id)
+    self.assertEqual(2, self.fake.request_counts[('GET', 'computer')])
+    self.assertEqual(1, self.fake.request_counts[('POST', 'computer')])
+
+  def testGet_NotFound(self):
+    with self.assertRaises(api.NotFoundError):
+      api.Computer.get(123, self.ctx)
+
+  def testPut_AssignsId(self):
+    self.assertEqual(1, self.fake.Put(test_utils.CreatePolicy(id=None))['id'])
+    self.assertEqual(2, self.fake.Put(test_utils.CreatePolicy(id=None))['id'])
+
+  def testQuery(self):
+    for id_ in range(1, 6):
+      self.fake.Put(test_utils.CreateEvent(
+          id=id_, subtype=bit9_constants.SUBTYPE.UNAPPROVED if id_ % 2 else 1))
+
+    events = (
+        api.Event.query()
+        .filter(api.Event.id > 1)
+        .filter(api.Event.subtype == bit9_constants.SUBTYPE.UNAPPROVED)
+        .order(-api.Event.id)
+        .limit(1)
+        .execute(self.ctx))
+
+    self.assertEqual([5], [event.id for event in events])
+
+  def testQuery_OrFilter(self):
+    for id_ in range(1, 6):
+      self.fake.Put(test_utils.CreateEvent(id=id_))
+
+    events = (
+        api.Event.query()
+        .filter((api.Event.id == 2) | (api.Event.id == 4))
+        .execute(self.ctx))
+
+    self.assertEqual([2, 4], [event.id for event in events])
+
+  def testQuery_DateTimeFilter(self):
+    self.fake.Put(test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-01T00:00:00Z'))
+    self.fake.Put(test_utils.CreatePolicy(
+        id=2, date_modified='2018-01-03T00:00:00.000000Z'))
+
+    policies = (
+        api.Policy.query()
+        .filter(api.Policy.date_modified > datetime.datetime(2018, 1, 2))
+        .execute(self.ctx))
+
+    self.assertEqual([2], [policy.id for policy in policies])
+
+  def testCount(self):
+    for id_ in range(1, 6):
+      self.fake.Put(test_utils.CreateEvent(id=id_))
+
+    self.assertEqual(
+        3, api.Event.query().filter(api.Event.id > 2).count(self.ctx))
+
+  def testExpand(self):
+    computer = test_utils.CreateComputer(id=456)
+    self.fake.Put(computer)
+    self.fake.Put(test_utils.CreateEvent(id=1, computer_id=456))
+
+    events = (
+        api.Event.query().expand(api.Event.computer_id).execute(self.ctx))
+
+    self.assertEqual(computer, events[0].get_expand(api.Event.computer_id))
+
+  def testErrorInjection(self):
+    self.fake.error_rate = 1.0
+
+    with self.assertRaises(api.RequestError):
+      api.Event.query().execute(self.ctx)
+    self.assertEqual(1, self.fake.error_counts[('GET', 'event')])
+
+
+class SeedEventsTest(absltest.TestCase):
+
+  def testSeed(self):
+    fake = fake_server.FakeBit9()
+    ctx = fake_server.FakeContext(fake)
+
+    fake_server.SeedEvents(fake, 20, host_count=3, binary_count=5, seed=0)
+
+    self.assertEqual(20, fake.Count('event'))
+    self.assertEqual(3, fake.Count('computer'))
+    self.assertEqual(5, fake.Count('fileCatalog'))
+
+    # Every event should be fully expandable.
+    events = (
+        api.Event.query()
+        .expand(api.Event.file_catalog_id)
+        .expand(api.Event.computer_id)
+        .execute(ctx))
+    for event in events:
+      self.assertIsNotNone(event.get_expand(api.Event.file_catalog_id))
+      self.assertIsNotNone(event.get_expand(api.Event.computer_id))
+
+
+class ParseRequestPathTest(absltest.TestCase):
+
+  def testSuccess(self):
+    self.assertEqual(
+        ('event', ['q=id>5', 'q=subtype:801|802', 'limit=10']),
+        fake_server.ParseRequestPath(
+            '/api/bit9platform/v1/event?q=id>5&q=subtype:801|802&limit=10'))
+
+  def testUnknownPath(self):
+    self.assertEqual((None, None), fake_server.ParseRequestPath('/foo'))
+
+
+if __name__ == '__main__':
+  absltest.main()
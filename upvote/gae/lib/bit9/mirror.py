@@ -0,0 +1,263 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local mirror of low-churn Bit9 metadata.
+
+Certificates change rarely relative to how often they are looked up while
+processing events. This module keeps copies of them in Datastore (and in a
+small per-instance cache in front of that) so that these lookups don't need to
+go to the Bit9 REST API every time.
+
+Policies and certificates expose a dateModified field, so their mirrors are
+kept up to date incrementally by Sync(), which also reports which policies
+have changed since the last sync. Since the sync picks up from the newest
+mirrored object, anything derived from the changes has to be written before
+they're mirrored, which Sync()'s callback is for.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+
+from google.appengine.ext import ndb
+
+from upvote.gae.lib.bit9 import api
+from upvote.gae.lib.bit9 import utils as bit9_utils
+
+
+# The number of objects to request from Bit9 per Sync() query.
+_SYNC_BATCH_SIZE = 500
+
+# The maximum number of Sync() queries issued per call, so that an initial sync
+# of a large object type is spread across several cron runs. Because the sync
+# watermark is derived from the mirrored objects themselves, each run picks up
+# where the last one left off.
+_MAX_SYNC_BATCHES = 20
+
+# Objects whose dateModified is within this window of the newest mirrored
+# object are re-requested, so that objects sharing a timestamp with the one at
+# the end of a batch aren't skipped.
+_SYNC_OVERLAP = datetime.timedelta(seconds=1)
+
+# The amount of time an object is held in the per-instance cache before being
+# re-read from Datastore.
+_IN_MEMORY_TTL = datetime.timedelta(minutes=5)
+
+# Models that can be synced incrementally on their dateModified property.
+_SYNCABLE_MODELS = (api.Policy, api.Certificate)
+
+
+class _MirroredObject(ndb.Model):
+  """A local copy of a single Bit9 API object.
+
+  key = '<ROUTE>/<id>' of the Bit9 object, e.g. 'policy/12'
+
+  Attributes:
+    route: str, The API route of the object's model.
+    bit9_id: int, The ID of the object in Bit9.
+    raw: dict, The raw API representation of the object.
+    date_modified: datetime, The object's dateModified value in Bit9, if any.
+    mirrored_dt: datetime, The last time the object was written locally.
+  """
+  route = ndb.StringProperty()
+  bit9_id = ndb.IntegerProperty()
+  raw = ndb.JsonProperty()
+  date_modified = ndb.DateTimeProperty()
+  mirrored_dt = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def GetKey(cls, model_cls, id_):
+    return ndb.Key(cls, '%s/%s' % (model_cls.ROUTE, id_))
+
+  @classmethod
+  def FromApiObject(cls, obj):
+    return cls(
+        key=cls.GetKey(obj.__class__, obj.id),
+        route=obj.ROUTE,
+        bit9_id=obj.id,
+        raw=obj.to_raw_dict(),
+        date_modified=getattr(obj, 'date_modified', None))
+
+
+# Maps (ROUTE, id) to a (API object, cached datetime) tuple.
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def ClearCache():
+  """Drops all objects from the per-instance cache."""
+  with _cache_lock:
+    _cache.clear()
+
+
+def _GetFromCache(model_cls, id_):
+  with _cache_lock:
+    entry = _cache.get((model_cls.ROUTE, id_))
+  if entry is None:
+    return None
+  obj, cached_dt = entry
+  if datetime.datetime.utcnow() - cached_dt > _IN_MEMORY_TTL:
+    return None
+  return obj
+
+
+def _AddToCache(objs):
+  now = datetime.datetime.utcnow()
+  with _cache_lock:
+    for obj in objs:
+      _cache[(obj.ROUTE, obj.id)] = (obj, now)
+
+
+def _Store(objs):
+  """Writes API objects to the mirror.
+
+  Objects which can't be serialized (e.g. a Certificate belonging to an
+  "embedded signer" comes back with empty fields) are skipped so that a later
+  lookup will re-request them.
+
+  Args:
+    objs: list<model.Model>, The API objects to mirror.
+
+  Returns:
+    The list of objects that were mirrored.
+  """
+  entities = []
+  stored = []
+  for obj in objs:
+    try:
+      entities.append(_MirroredObject.FromApiObject(obj))
+    except Exception:  # pylint: disable=broad-except
+      logging.warning(
+          'Not mirroring unparseable %s %s', obj.__class__.__name__, obj.id)
+    else:
+      stored.append(obj)
+
+  ndb.put_multi(entities)
+  _AddToCache(stored)
+  return stored
+
+
+def _Get(model_cls, id_):
+  """Looks up a mirrored object, falling back to the Bit9 API when absent.
+
+  Args:
+    model_cls: type, The api.Model subclass of the object.
+    id_: int, The ID of the object in Bit9.
+
+  Returns:
+    The api.Model instance.
+  """
+  id_ = int(id_)
+
+  obj = _GetFromCache(model_cls, id_)
+  if obj is not None:
+    return obj
+
+  entity = _MirroredObject.GetKey(model_cls, id_).get()
+  if entity is not None:
+    obj = model_cls.from_dict(entity.raw)
+    _AddToCache([obj])
+    return obj
+
+  logging.info('%s %s not mirrored locally', model_cls.__name__, id_)
+  obj = model_cls.get(id_, bit9_utils.CONTEXT)
+  _Store([obj])
+  return obj
+
+
+def GetCertificate(cert_id):
+  """Returns the api.Certificate with the given ID."""
+  return _Get(api.Certificate, cert_id)
+
+
+def _FilterUnchanged(objs):
+  """Drops objects which are no newer than their mirrored copies.
+
+  Args:
+    objs: list<model.Model>, API objects returned by a Sync() query.
+
+  Returns:
+    The objects which are new or have been modified since they were mirrored,
+    de-duplicated by ID.
+  """
+  objs = collections.OrderedDict((obj.id, obj) for obj in objs).values()
+  entities = ndb.get_multi(
+      [_MirroredObject.GetKey(obj.__class__, obj.id) for obj in objs])
+  return [
+      obj for obj, entity in zip(objs, entities)
+      if entity is None or entity.date_modified is None or
+      obj.date_modified is None or obj.date_modified > entity.date_modified]
+
+
+def _GetWatermark(model_cls):
+  """Returns the newest dateModified among the mirrored objects of a model."""
+  newest = (
+      _MirroredObject.query(_MirroredObject.route == model_cls.ROUTE)
+      .order(-_MirroredObject.date_modified)
+      .get())
+  return newest.date_modified if newest is not None else None
+
+
+def Sync(model_cls, callback=None):
+  """Mirrors all objects of a model modified in Bit9 since the last sync.
+
+  Args:
+    model_cls: type, One of the api.Model subclasses in _SYNCABLE_MODELS.
+    callback: func(list<model.Model>), Called with each batch of new or
+        modified objects before they're mirrored. If it raises, the batch is
+        left unmirrored, so that the next sync returns it again.
+
+  Returns:
+    The list of newly-synced objects.
+
+  Raises:
+    ValueError: if the model can't be synced incrementally.
+  """
+  if model_cls not in _SYNCABLE_MODELS:
+    raise ValueError('%s cannot be synced' % model_cls.__name__)
+
+  watermark = _GetWatermark(model_cls)
+  logging.info(
+      'Syncing %s objects modified since %s', model_cls.__name__, watermark)
+
+  synced = []
+  for _ in xrange(_MAX_SYNC_BATCHES):
+    query = model_cls.query()
+    if watermark is not None:
+      query = query.filter(
+          model_cls.date_modified > watermark - _SYNC_OVERLAP)
+    query = query.order(model_cls.date_modified).limit(_SYNC_BATCH_SIZE)
+    objs = query.execute(bit9_utils.CONTEXT)
+
+    # Objects within the overlap have usually been mirrored already.
+    changed = _FilterUnchanged(objs)
+    if callback is not None and changed:
+      callback(changed)
+    synced.extend(_Store(changed))
+    if len(objs) < _SYNC_BATCH_SIZE:
+      break
+
+    # If the whole batch shares a single timestamp, the watermark can't be
+    # advanced any further with the API's strict inequality filters.
+    new_watermark = max(obj.date_modified for obj in objs)
+    if new_watermark is None or (
+        watermark is not None and new_watermark - _SYNC_OVERLAP <= watermark):
+      logging.warning(
+          'Unable to advance %s sync past %s', model_cls.__name__, watermark)
+      break
+    watermark = new_watermark
+
+  logging.info('Synced %d %s object(s)', len(synced), model_cls.__name__)
+  return synced
@@ -0,0 +1,172 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for mirror.py."""
+
+import mock
+
+from upvote.gae.lib.bit9 import api
+from upvote.gae.lib.bit9 import mirror
+from upvote.gae.lib.bit9 import test_utils as bit9_test_utils
+from upvote.gae.lib.testing import bit9test
+from absl.testing import absltest
+
+
+class GetTest(bit9test.Bit9TestCase):
+
+  def testNotMirrored(self):
+    cert = bit9_test_utils.CreateCertificate(id=123)
+    self.PatchApiRequests(cert)
+
+    self.assertEqual(cert, mirror.GetCertificate(123))
+    self.mock_ctx.ExecuteRequest.assert_called_once_with(
+        'GET', api_route='certificate/123')
+    self.assertEqual(1, mirror._MirroredObject.query().count())
+
+  def testInMemory(self):
+    cert = bit9_test_utils.CreateCertificate(id=123)
+    self.PatchApiRequests(cert)
+
+    mirror.GetCertificate(123)
+    self.assertEqual(cert, mirror.GetCertificate(123))
+
+    self.assertEqual(1, self.mock_ctx.ExecuteRequest.call_count)
+
+  def testInDatastore(self):
+    cert = bit9_test_utils.CreateCertificate(id=123)
+    self.PatchApiRequests(cert)
+
+    mirror.GetCertificate(123)
+    mirror.ClearCache()
+    self.assertEqual(cert, mirror.GetCertificate(123))
+
+    self.assertEqual(1, self.mock_ctx.ExecuteRequest.call_count)
+
+  def testUnparseable(self):
+    bad_cert = bit9_test_utils.CreateCertificate(
+        id=123, thumbprint=None, valid_to=None)
+    good_cert = bit9_test_utils.CreateCertificate(id=123)
+    self.PatchApiRequests(bad_cert, good_cert)
+
+    # The unparseable cert should be returned but not mirrored, so the next
+    # lookup requests it again.
+    mirror.GetCertificate(123)
+    self.assertEqual(0, mirror._MirroredObject.query().count())
+    self.assertEqual(good_cert, mirror.GetCertificate(123))
+
+    self.assertEqual(2, self.mock_ctx.ExecuteRequest.call_count)
+    self.assertEqual(1, mirror._MirroredObject.query().count())
+
+
+class SyncTest(bit9test.Bit9TestCase):
+
+  def testUnsupportedModel(self):
+    with self.assertRaises(ValueError):
+      mirror.Sync(api.Computer)
+
+  def testInitialSync(self):
+    policy_1 = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-01T00:00:00Z')
+    policy_2 = bit9_test_utils.CreatePolicy(
+        id=2, date_modified='2018-01-02T00:00:00Z')
+    self.PatchApiRequests([policy_1, policy_2])
+
+    synced = mirror.Sync(api.Policy)
+
+    self.assertListEqual([policy_1, policy_2], synced)
+    self.mock_ctx.ExecuteRequest.assert_called_once_with(
+        'GET', api_route='policy',
+        query_args=['sort=dateModified ASC', 'limit=500'])
+
+    # Synced policies should be mirrored.
+    self.assertEqual(2, mirror._MirroredObject.query().count())
+
+  def testIncrementalSync(self):
+    policy = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-02T00:00:00Z')
+    self.PatchApiRequests([policy], [policy])
+
+    mirror.Sync(api.Policy)
+
+    # The overlapping policy is returned again, but hasn't changed.
+    self.assertListEqual([], mirror.Sync(api.Policy))
+
+    self.mock_ctx.ExecuteRequest.assert_called_with(
+        'GET', api_route='policy',
+        query_args=[
+            'q=dateModified>2018-01-01T23:59:59.000000Z',
+            'sort=dateModified ASC', 'limit=500'])
+
+  def testIncrementalSync_Modified(self):
+    policy = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-02T00:00:00Z')
+    modified_policy = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-03T00:00:00Z')
+    self.PatchApiRequests([policy], [modified_policy])
+
+    mirror.Sync(api.Policy)
+
+    self.assertListEqual([modified_policy], mirror.Sync(api.Policy))
+
+  def testCallback(self):
+    policy = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-01T00:00:00Z')
+    self.PatchApiRequests([policy], [policy], [policy])
+    callback = mock.Mock(side_effect=[Exception, None])
+
+    with self.assertRaises(Exception):
+      mirror.Sync(api.Policy, callback=callback)
+
+    # The policy shouldn't be mirrored until the callback succeeds.
+    self.assertEqual(0, mirror._MirroredObject.query().count())
+    self.assertListEqual([policy], mirror.Sync(api.Policy, callback=callback))
+    self.assertEqual(1, mirror._MirroredObject.query().count())
+
+    # Once mirrored, the unchanged policy isn't passed to the callback again.
+    mirror.Sync(api.Policy, callback=callback)
+    callback.assert_has_calls([mock.call([policy]), mock.call([policy])])
+    self.assertEqual(2, callback.call_count)
+
+  @mock.patch.object(mirror, '_SYNC_BATCH_SIZE', 2)
+  def testMultipleBatches(self):
+    policy_1 = bit9_test_utils.CreatePolicy(
+        id=1, date_modified='2018-01-01T00:00:00Z')
+    policy_2 = bit9_test_utils.CreatePolicy(
+        id=2, date_modified='2018-01-02T00:00:00Z')
+    policy_3 = bit9_test_utils.CreatePolicy(
+        id=3, date_modified='2018-01-03T00:00:00Z')
+    self.PatchApiRequests([policy_1, policy_2], [policy_2, policy_3], [])
+
+    synced = mirror.Sync(api.Policy)
+
+    self.assertListEqual([policy_1, policy_2, policy_3], synced)
+    self.assertEqual(3, self.mock_ctx.ExecuteRequest.call_count)
+    self.assertEqual(3, mirror._MirroredObject.query().count())
+
+  @mock.patch.object(mirror, '_SYNC_BATCH_SIZE', 2)
+  def testMultipleBatches_SameTimestamp(self):
+    policies = [
+        bit9_test_utils.CreatePolicy(
+            id=id_, date_modified='2018-01-01T00:00:00Z')
+        for id_ in xrange(2)]
+    self.PatchApiRequests(policies, policies)
+
+    mirror.Sync(api.Policy)
+
+    # The second batch can't advance the watermark so syncing should stop.
+    self.assertEqual(2, self.mock_ctx.ExecuteRequest.call_count)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,125 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serves a seeded, in-memory stand-in for the Bit9 REST API over HTTP.
+
+Point a dev_appserver at it by setting BIT9_REST_URL to e.g.
+http://localhost:8090. Request counts are available as JSON from /stats, and
+can be reset with a POST to /stats/reset.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from upvote.gae.lib.bit9 import fake_server
+from absl import app
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('port', 8090, 'The port on which to serve.')
+flags.DEFINE_integer('events', 1000, 'The number of events to seed.')
+flags.DEFINE_integer('hosts', 10, 'The number of computers to seed.')
+flags.DEFINE_integer('binaries', 50, 'The number of fileCatalogs to seed.')
+flags.DEFINE_float(
+    'signed_ratio', 0.5, 'The fraction of binaries with a signing chain.')
+flags.DEFINE_float('latency_ms', 0, 'The base latency of each request.')
+flags.DEFINE_float(
+    'latency_jitter_ms', 0, 'The maximum random latency added to requests.')
+flags.DEFINE_float(
+    'error_rate', 0, 'The fraction of requests which should fail with a 503.')
+flags.DEFINE_integer('seed', None, 'A seed for all random choices.')
+
+
+class _ThreadedHTTPServer(
+    socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def _CreateHandler(fake):
+  """Returns a request handler class bound to the given FakeBit9."""
+
+  class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _Respond(self, status_code, body):
+      payload = json.dumps(body)
+      self.send_response(status_code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def _Handle(self, method):
+      if self.path == '/stats':
+        self._Respond(200, fake.GetStats())
+        return
+      elif self.path == '/stats/reset':
+        fake.ResetStats()
+        self._Respond(200, {})
+        return
+
+      api_route, query_args = fake_server.ParseRequestPath(self.path)
+      if api_route is None:
+        self._Respond(404, 'Unknown path: %s' % self.path)
+        return
+
+      data = None
+      length = int(self.headers.get('Content-Length') or 0)
+      if length:
+        data = json.loads(self.rfile.read(length))
+
+      self._Respond(*fake.HandleRequest(
+          method, api_route=api_route, query_args=query_args, data=data))
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      self._Handle('GET')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+      self._Handle('POST')
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+      self._Handle('DELETE')
+
+    def log_message(self, format_, *args):  # pylint: disable=arguments-differ
+      logging.debug(format_, *args)
+
+  return _Handler
+
+
+def main(argv):
+  del argv  # Unused.
+
+  fake = fake_server.FakeBit9(
+      latency=FLAGS.latency_ms / 1000.0,
+      latency_jitter=FLAGS.latency_jitter_ms / 1000.0,
+      error_rate=FLAGS.error_rate, seed=FLAGS.seed)
+  fake_server.SeedEvents(
+      fake, FLAGS.events, host_count=FLAGS.hosts, binary_count=FLAGS.binaries,
+      signed_ratio=FLAGS.signed_ratio, seed=FLAGS.seed)
+  logging.info('Seeded %d events', fake.Count('event'))
+
+  server = _ThreadedHTTPServer(('localhost', FLAGS.port), _CreateHandler(fake))
+  logging.info('Serving on http://localhost:%d', FLAGS.port)
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  app.run(main)
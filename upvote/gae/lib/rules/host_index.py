@@ -0,0 +1,316 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A materialized index of the local Rules in effect on each host.
+
+Working out which local Rules apply to a host otherwise takes a query on
+Rule.host_id, which is eventually consistent and runs on every Santa rule
+download and every Bit9 block event. Instead, the local Rules in effect on a
+host are listed in a few sharded _HostRuleIndexShard entities, which are read
+with a strongly-consistent (and memcached) get.
+
+Rule writers call Update() with the Rules they've put. The index is brought up
+to date by a task which re-reads those Rules, so updates can be applied in any
+order. A host's index is only complete once it has been built by Rebuild(),
+which readers schedule the first time they find it missing. Until then they
+get None back and should fall back to querying for the Rules. Updates to a host
+which hasn't been built are still recorded in partial shards, which Rebuild()
+merges with the results of its query, so that Rules too recent for the query to
+return aren't lost.
+"""
+
+import collections
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from upvote.gae.datastore.models import binary as binary_models
+from upvote.gae.datastore.models import rule as rule_models
+from upvote.shared import constants
+
+
+# The number of entities the index of a single host is spread over.
+_SHARD_COUNT = 4
+
+# How long, in seconds, to wait before building a missing index, so that the
+# Rule query it's built from has had a chance to catch up with recent writes.
+_REBUILD_DELAY = 60
+
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+
+class IndexEntry(
+    collections.namedtuple(
+        'IndexEntry', ['sha256', 'rule_id', 'policy', 'updated_dt'])):
+  """A local Rule in effect on a host.
+
+  Attributes:
+    sha256: str, The ID of the Blockable the Rule belongs to.
+    rule_id: int, The ID of the Rule.
+    policy: str, The policy of the Rule.
+    updated_dt: datetime, When the Rule was last updated.
+  """
+  __slots__ = ()
+
+  @property
+  def rule_key(self):
+    return ndb.Key(
+        binary_models.Blockable, self.sha256, rule_models.Rule, self.rule_id)
+
+
+class _HostRuleIndexShard(ndb.Model):
+  """A shard of the local Rules in effect on a host.
+
+  key = Key(_HostRuleIndexShard, '<host_id>/<shard_index>')
+
+  Attributes:
+    entries: list, The sorted [sha256, rule_id, policy, updated_usec] of each
+        Rule in this shard.
+    partial: bool, Whether the shard only holds the updates made before the
+        index was built.
+    removed: list, The sorted [sha256, rule_id] of each Rule which a partial
+        shard has seen go out of effect.
+  """
+  entries = ndb.JsonProperty(compressed=True)
+  partial = ndb.BooleanProperty(default=False, indexed=False)
+  removed = ndb.JsonProperty(compressed=True)
+
+
+def _GetShardIndex(sha256):
+  digest = hashlib.md5(sha256.encode('utf-8')).hexdigest()
+  return int(digest, 16) % _SHARD_COUNT
+
+
+def _GetShardKey(host_id, shard_index):
+  return ndb.Key(_HostRuleIndexShard, '%s/%d' % (host_id, shard_index))
+
+
+def _GetShardKeys(host_id):
+  return [_GetShardKey(host_id, index) for index in xrange(_SHARD_COUNT)]
+
+
+def _ToUsec(dt):
+  delta = dt - _EPOCH
+  return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def _ToEntry(rule):
+  # The Rule's own update time is kept, rather than when it was indexed, so
+  # that rebuilding the index doesn't make every Rule look new.
+  return [
+      rule.key.parent().id(), rule.key.id(), rule.policy,
+      _ToUsec(rule.updated_dt)]
+
+
+def _IsIndexed(rule, host_id):
+  return rule is not None and rule.in_effect and rule.host_id == host_id
+
+
+def Update(rules):
+  """Schedules an update of the index for each host with one of the Rules.
+
+  Must be called once the Rules have been put. If called in a transaction, the
+  update only happens if the transaction commits.
+
+  Args:
+    rules: list<Rule>, Rules which have been created or modified.
+  """
+  rule_refs = sorted({
+      (rule.host_id, rule.key.urlsafe()) for rule in rules if rule.host_id})
+  if not rule_refs:
+    return
+  deferred.defer(
+      _ApplyUpdate, rule_refs, _queue=constants.TASK_QUEUE.HOST_RULE_INDEX,
+      _transactional=ndb.in_transaction())
+
+
+@ndb.transactional_tasklet
+def _UpdateShardAsync(shard_key, host_id, rules):
+  shard = yield shard_key.get_async()
+  if shard is None:
+    # The index hasn't been built yet, but Rebuild() may not see these Rules,
+    # so keep track of them until it is.
+    shard = _HostRuleIndexShard(
+        key=shard_key, entries=[], partial=True, removed=[])
+
+  entries = {(entry[0], entry[1]): entry for entry in shard.entries}
+  removed = {tuple(entry_id) for entry_id in shard.removed or []}
+  for rule_key, rule in rules:
+    entry_id = (rule_key.parent().id(), rule_key.id())
+    if _IsIndexed(rule, host_id):
+      entries[entry_id] = _ToEntry(rule)
+      removed.discard(entry_id)
+    else:
+      entries.pop(entry_id, None)
+      if shard.partial:
+        removed.add(entry_id)
+  shard.entries = sorted(entries.itervalues())
+  if shard.partial:
+    shard.removed = sorted(list(entry_id) for entry_id in removed)
+  yield shard.put_async()
+
+
+def _ApplyUpdate(rule_refs):
+  """Brings the index entries for the given Rules up to date.
+
+  The current state of each Rule is re-read, so it doesn't matter if updates
+  are applied out of order. Updates to hosts whose index hasn't been built are
+  recorded in partial shards.
+
+  Args:
+    rule_refs: list<(str, str)>, The host ID and urlsafe key of each Rule.
+  """
+  rule_keys = [ndb.Key(urlsafe=urlsafe_key) for _, urlsafe_key in rule_refs]
+  rules = ndb.get_multi(rule_keys)
+
+  shard_updates = collections.defaultdict(list)
+  for (host_id, _), rule_key, rule in zip(rule_refs, rule_keys, rules):
+    shard_key = _GetShardKey(host_id, _GetShardIndex(rule_key.parent().id()))
+    shard_updates[(shard_key, host_id)].append((rule_key, rule))
+
+  futures = [
+      _UpdateShardAsync(shard_key, host_id, shard_rules)
+      for (shard_key, host_id), shard_rules in shard_updates.iteritems()]
+  ndb.Future.wait_all(futures)
+  for future in futures:
+    future.check_success()
+
+
+@ndb.transactional_tasklet
+def _BuildShardAsync(shard_key, entries):
+  """Builds a shard from queried entries, unless it's been built already.
+
+  Args:
+    shard_key: Key, The key of the shard.
+    entries: dict, The queried entry of each Rule, keyed by (sha256, rule_id).
+
+  Returns:
+    A Future resolving to whether the shard was built.
+  """
+  shard = yield shard_key.get_async()
+  if shard is not None and not shard.partial:
+    raise ndb.Return(False)
+
+  # Anything updated since the index was found missing is more recent than
+  # what the query returned.
+  if shard is not None:
+    for entry_id in shard.removed or []:
+      entries.pop(tuple(entry_id), None)
+    for entry in shard.entries:
+      entries[(entry[0], entry[1])] = entry
+
+  yield _HostRuleIndexShard(
+      key=shard_key, entries=sorted(entries.itervalues())).put_async()
+  raise ndb.Return(True)
+
+
+def Rebuild(host_id):
+  """Builds the index of a host.
+
+  Shards which have already been built are left alone, since they've been kept
+  up to date since and the query may be behind them.
+
+  Args:
+    host_id: str, The ID of the host.
+  """
+  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+  rules = rule_models.Rule.query(
+      rule_models.Rule.host_id == host_id,
+      rule_models.Rule.in_effect == True).fetch()
+  # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+
+  shard_entries = [{} for _ in xrange(_SHARD_COUNT)]
+  for rule in rules:
+    sha256 = rule.key.parent().id()
+    shard_entries[_GetShardIndex(sha256)][(sha256, rule.key.id())] = _ToEntry(
+        rule)
+
+  futures = [
+      _BuildShardAsync(shard_key, entries)
+      for shard_key, entries in zip(_GetShardKeys(host_id), shard_entries)]
+  ndb.Future.wait_all(futures)
+  built_count = sum(future.get_result() for future in futures)
+
+  logging.info(
+      'Built %d index shard(s) from %d local Rule(s) for host %s', built_count,
+      len(rules), host_id)
+
+
+def _ScheduleRebuild(host_id):
+  # Only build each missing index once in a while, no matter how often it's
+  # read in the meantime.
+  window = int(time.time()) // 3600
+  task_name = 'rebuild-%s-%d' % (host_id, window)
+  try:
+    deferred.defer(
+        Rebuild, host_id, _name=task_name, _countdown=_REBUILD_DELAY,
+        _queue=constants.TASK_QUEUE.HOST_RULE_INDEX)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _ToIndexEntry(entry):
+  sha256, rule_id, policy, updated_usec = entry
+  updated_dt = _EPOCH + datetime.timedelta(microseconds=updated_usec)
+  return IndexEntry(sha256, rule_id, policy, updated_dt)
+
+
+@ndb.tasklet
+def GetEntriesAsync(host_id):
+  """Returns the local Rules in effect on a host, according to its index.
+
+  Args:
+    host_id: str, The ID of the host.
+
+  Returns:
+    A Future resolving to a list of IndexEntry, sorted by sha256, or None if
+    the index of the host hasn't been built yet.
+  """
+  shards = yield ndb.get_multi_async(_GetShardKeys(host_id))
+  if any(shard is None or shard.partial for shard in shards):
+    _ScheduleRebuild(host_id)
+    raise ndb.Return(None)
+
+  entries = sorted(entry for shard in shards for entry in shard.entries)
+  raise ndb.Return([_ToIndexEntry(entry) for entry in entries])
+
+
+def GetEntries(host_id):
+  return GetEntriesAsync(host_id).get_result()
+
+
+def GetRuleKeys(host_id, sha256):
+  """Returns the keys of the local Rules in effect for a Blockable on a host.
+
+  Args:
+    host_id: str, The ID of the host.
+    sha256: str, The ID of the Blockable.
+
+  Returns:
+    A list of Rule keys, or None if the index of the host hasn't been built.
+  """
+  shard_key = _GetShardKey(host_id, _GetShardIndex(sha256))
+  shard = shard_key.get()
+  if shard is None or shard.partial:
+    _ScheduleRebuild(host_id)
+    return None
+
+  return [
+      _ToIndexEntry(entry).rule_key
+      for entry in shard.entries if entry[0] == sha256]
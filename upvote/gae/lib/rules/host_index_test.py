@@ -0,0 +1,160 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for host_index.py."""
+
+from google.appengine.ext import ndb
+
+from upvote.gae.datastore import test_utils
+from upvote.gae.lib.rules import host_index
+from upvote.gae.lib.testing import basetest
+from upvote.shared import constants
+
+
+class HostIndexTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(HostIndexTest, self).setUp()
+    self.blockable = test_utils.CreateSantaBlockable()
+
+  def _CreateLocalRule(self, host_id='host', **kwargs):
+    return test_utils.CreateSantaRule(
+        self.blockable.key, host_id=host_id,
+        policy=constants.RULE_POLICY.WHITELIST, **kwargs)
+
+  def _Update(self, rules):
+    host_index.Update(rules)
+    self.DrainTaskQueue(constants.TASK_QUEUE.HOST_RULE_INDEX)
+
+  def testGetEntries_NotBuilt(self):
+    self._CreateLocalRule()
+
+    self.assertIsNone(host_index.GetEntries('host'))
+    self.assertIsNone(host_index.GetRuleKeys('host', self.blockable.key.id()))
+    self.assertTaskCount(constants.TASK_QUEUE.HOST_RULE_INDEX, 1)
+
+    self.DrainTaskQueue(constants.TASK_QUEUE.HOST_RULE_INDEX)
+
+    entries = host_index.GetEntries('host')
+    self.assertLen(entries, 1)
+
+  def testRebuild(self):
+    rule = self._CreateLocalRule()
+    self._CreateLocalRule(in_effect=False)
+    self._CreateLocalRule(host_id='other_host')
+    test_utils.CreateSantaRule(self.blockable.key)
+
+    host_index.Rebuild('host')
+
+    entries = host_index.GetEntries('host')
+    self.assertLen(entries, 1)
+    self.assertEqual(self.blockable.key.id(), entries[0].sha256)
+    self.assertEqual(rule.key, entries[0].rule_key)
+    self.assertEqual(constants.RULE_POLICY.WHITELIST, entries[0].policy)
+    self.assertEqual(rule.updated_dt, entries[0].updated_dt)
+    self.assertEqual(
+        [rule.key], host_index.GetRuleKeys('host', self.blockable.key.id()))
+    self.assertEqual([], host_index.GetRuleKeys('host', 'other_sha256'))
+
+  def testUpdate(self):
+    host_index.Rebuild('host')
+    rule = self._CreateLocalRule()
+
+    self._Update([rule])
+    self.assertEqual(
+        [rule.key], host_index.GetRuleKeys('host', self.blockable.key.id()))
+
+    rule.MarkDisabled()
+    rule.put()
+    self._Update([rule])
+    self.assertEqual([], host_index.GetEntries('host'))
+
+  def testUpdate_OutOfOrder(self):
+    host_index.Rebuild('host')
+    rule = self._CreateLocalRule()
+    host_index.Update([rule])
+    rule.MarkDisabled()
+    rule.put()
+
+    # The update scheduled when the rule was created should see the rule as it
+    # is now.
+    self.DrainTaskQueue(constants.TASK_QUEUE.HOST_RULE_INDEX)
+    self.assertEqual([], host_index.GetEntries('host'))
+
+  def testUpdate_NotBuilt(self):
+    rule = self._CreateLocalRule()
+
+    self._Update([rule])
+
+    self.assertIsNone(host_index.GetRuleKeys('host', self.blockable.key.id()))
+
+  def testUpdate_NotBuilt_MergedByRebuild(self):
+    rule = self._CreateLocalRule()
+    self._Update([rule])
+
+    # Even if the Rule query hasn't caught up with the update yet, the rebuilt
+    # index should include it.
+    mock_query = self.Patch(host_index.rule_models.Rule, 'query')
+    mock_query.return_value.fetch.return_value = []
+    host_index.Rebuild('host')
+
+    self.assertEqual(
+        [rule.key], host_index.GetRuleKeys('host', self.blockable.key.id()))
+
+  def testUpdate_NotBuilt_RemovalMergedByRebuild(self):
+    rule = self._CreateLocalRule()
+    stale_rule = rule.key.get(use_cache=False)
+    rule.MarkDisabled()
+    rule.put()
+    self._Update([rule])
+
+    mock_query = self.Patch(host_index.rule_models.Rule, 'query')
+    mock_query.return_value.fetch.return_value = [stale_rule]
+    host_index.Rebuild('host')
+
+    self.assertEqual([], host_index.GetEntries('host'))
+
+  def testRebuild_AlreadyBuilt(self):
+    host_index.Rebuild('host')
+    rule = self._CreateLocalRule()
+    self._Update([rule])
+
+    mock_query = self.Patch(host_index.rule_models.Rule, 'query')
+    mock_query.return_value.fetch.return_value = []
+    host_index.Rebuild('host')
+
+    self.assertEqual(
+        [rule.key], host_index.GetRuleKeys('host', self.blockable.key.id()))
+
+  def testUpdate_GlobalRule(self):
+    host_index.Update([test_utils.CreateSantaRule(self.blockable.key)])
+
+    self.assertTaskCount(constants.TASK_QUEUE.HOST_RULE_INDEX, 0)
+
+  def testUpdate_Transactional(self):
+    host_index.Rebuild('host')
+    rule = self._CreateLocalRule()
+
+    @ndb.transactional
+    def _UpdateAndFail():
+      host_index.Update([rule])
+      raise ValueError
+
+    with self.assertRaises(ValueError):
+      _UpdateAndFail()
+    self.assertTaskCount(constants.TASK_QUEUE.HOST_RULE_INDEX, 0)
+
+
+if __name__ == '__main__':
+  basetest.main()
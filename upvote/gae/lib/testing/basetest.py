@@ -90,7 +90,9 @@ class UpvoteTestCase(basetest.AppEngineTestCase):
     # UnknownEnvironmentError unless we've already patched the environment
     # detection.
     self._env_patcher = None
-    self.PatchEnv(settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=True)
+    self.PatchEnv(
+        settings.ProdEnv, ENABLE_BIGQUERY_STREAMING=True,
+        ANALYTICS_FILE_PATH=None)
 
     # Patch out the call that streams to BigQuery so it can be verified in
     # assertBigQueryInsertions() below.
@@ -202,25 +204,27 @@ class UpvoteTestCase(basetest.AppEngineTestCase):
 
     expected_insertions = sorted(table_names)
 
-    # Examine the task queue and note which insertions were actually queued.
-    tasks = self.UnpackTaskQueue(
-        queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING, flush=False)
-    queued_insertions = sorted(task[1][0].name for task in tasks)
+    # Examine the row buffer and note which insertions were actually queued.
+    # Rows which fail validation are never buffered.
+    rows = self.UnpackTaskQueue(
+        queue_name=constants.TASK_QUEUE.BIGQUERY_ROWS, flush=False)
+    queued_insertions = sorted(table_name for table_name, _ in rows)
 
     # Verify that the expected insertions match the queued insertions.
     if expected_insertions != queued_insertions:
       msg_lines = [
           'Expected insertions do not match queued insertions: %s != %s' % (
               expected_insertions, queued_insertions)]
-      if tasks:
+      if rows:
         msg_lines.append('Queued insertions:')
-        msg_lines.extend('%s: %s' % (t[1][0].name, t[2]) for t in tasks)
+        msg_lines.extend('%s: %s' % row for row in rows)
       msg = '\n\n'.join(msg_lines)
       self.assertListEqual(expected_insertions, queued_insertions, msg=msg)
 
-    # Run the deferred insertion tasks. This ensures that they all go through
-    # validation and attempt to call BigQuery.
-    self.DrainTaskQueue(constants.TASK_QUEUE.BIGQUERY_STREAMING)
+    # Flush the buffered rows. This ensures that they all attempt to call
+    # BigQuery. The scheduled flush tasks are then redundant.
+    tables._FlushRows()  # pylint: disable=protected-access
+    self.FlushTaskQueue(queue_name=constants.TASK_QUEUE.BIGQUERY_STREAMING)
 
     # Examine the mock and note which insertions were actually performed.
     # calls = self.mock_send_to_bigquery.call_args_list
@@ -256,7 +260,7 @@ class UpvoteTestCase(basetest.AppEngineTestCase):
     self.assertBigQueryInsertions([table_name], reset_mock=reset_mock)
 
   def GetBigQueryCalls(self, predicate=None, reset_mock=True):
-    """Returns a list of tuples, representing the args of _SendToBigQuery().
+    """Returns a list of tuples, representing the rows sent to BigQuery.
 
     Args:
       predicate: A function to optionally filter the list of tuples with.
@@ -265,11 +269,11 @@ class UpvoteTestCase(basetest.AppEngineTestCase):
           False.
 
     Returns:
-      A list of (str, str, dict) tuples, corresponding to the args send to the
-          tables._SendToBigQuery() mock.
+      A list of (BigQueryTable, dict) tuples, one for each row in each batch
+          sent to the tables._SendToBigQuery() mock.
     """
     calls = self.mock_send_to_bigquery.call_args_list
-    call_args = [(c[0][0], c[0][1]) for c in calls]
+    call_args = [(c[0][0], row) for c in calls for row in c[0][1]]
     if reset_mock:
       self.mock_send_to_bigquery.reset_mock()
     return filter(predicate, call_args)
@@ -17,6 +17,7 @@ import mock
 
 from common import context
 from upvote.gae.datastore.models import singleton
+from upvote.gae.lib.bit9 import mirror
 from upvote.gae.lib.bit9 import utils as bit9_utils
 from upvote.gae.lib.testing import basetest
 from absl.testing import absltest
@@ -53,6 +54,9 @@ class Bit9TestCase(basetest.UpvoteTestCase):
     # cache the mock context and break subsequent tests.
     context.ResetLazyProxies()
 
+    # Likewise, mirrored Bit9 objects shouldn't outlive the test.
+    mirror.ClearCache()
+
   def PatchApiRequests(self, *results):
     requests = []
     for batch in results:
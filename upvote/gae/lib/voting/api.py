@@ -15,8 +15,13 @@
 """Logic associated with voting."""
 
 import abc
+import collections
+import datetime
 import logging
 
+from concurrent import futures
+
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from upvote.gae import settings
@@ -31,6 +36,8 @@ from upvote.gae.datastore.models import user as user_models
 from upvote.gae.datastore.models import vote as vote_models
 from upvote.gae.lib.analysis import metrics
 from upvote.gae.lib.bit9 import change_set
+from upvote.gae.lib.rules import host_index
+from upvote.gae.utils import time_utils
 from upvote.gae.utils import user_utils
 from upvote.shared import constants
 
@@ -147,76 +154,123 @@ def _GetRulesForBlockable(blockable):
   return query.fetch()
 
 
-def _GetVotingProhibitedReason(blockable_key, current_user=None):
-  """Checks if voting is prohibted for the given Blockable.
+# The maximum age of a _VotingEligibility before it's recomputed. Changes to the
+# Blockable itself are detected through its updated_dt, so this only bounds how
+# long changes which don't touch it go unnoticed.
+_ELIGIBILITY_MAX_AGE = datetime.timedelta(minutes=10)
 
-  Args:
-    blockable_key: The NDB Key of the Blockable to check.
-    current_user: The optional User whose voting privileges should be
-        evaluated against this Blockable. If not provided, the current AppEngine
-        user will be used instead.
 
-  Returns:
-    One of constants.VOTING_PROHIBITED_REASONS, or None if voting is allowed.
+class _VotingEligibility(ndb.Model):
+  """The cached, user-independent voting eligibility of a Blockable.
 
-  Raises:
-    BlockableNotFoundError: if the given Blockable cannot be found.
+  The reasons voting is prohibited only depend on the user through their VOTE
+  permission and whether they're an admin, so both outcomes are precomputed
+  and the user is applied in memory. The blacklisted cert check isn't cached,
+  as a new cert Rule doesn't change the Blockable.
+
+  key = Key(_VotingEligibility, blockable_id)
+
+  Attributes:
+    user_reason: str, The reason non-admins may not vote, or None.
+    admin_reason: str, The reason admins may not vote, or None.
+    blockable_updated_dt: datetime, The updated_dt of the Blockable at the time
+        the reasons were computed.
+    computed_dt: datetime, When the reasons were computed.
   """
-  blockable = blockable_key.get()
-  if blockable is None:
-    raise BlockableNotFoundError('ID: %s' % blockable_key.id())
+  user_reason = ndb.StringProperty(indexed=False)
+  admin_reason = ndb.StringProperty(indexed=False)
+  blockable_updated_dt = ndb.DateTimeProperty(indexed=False)
+  computed_dt = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  @classmethod
+  def GetKey(cls, blockable_key):
+    return ndb.Key(cls, blockable_key.id())
+
+  def IsCurrent(self, blockable):
+    """Returns whether the reasons still reflect the Blockable."""
+    if self.computed_dt < datetime.datetime.utcnow() - _ELIGIBILITY_MAX_AGE:
+      return False
+    return self.blockable_updated_dt == blockable.updated_dt
 
-  # If the user can't vote, just stop right here.
-  current_user = current_user or user_models.User.GetOrInsert()
-  if not current_user.HasPermission(constants.PERMISSIONS.VOTE):
-    return constants.VOTING_PROHIBITED_REASONS.INSUFFICIENT_PERMISSION
 
+def _HasBlacklistedCert(blockable):
+  """Returns whether a SantaBlockable is signed by a blacklisted cert."""
+  if not isinstance(blockable, binary_models.SantaBlockable):
+    return False
+  if not blockable.cert_id:
+    return False
+
+  cert_key = ndb.Key(cert_models.SantaCertificate, blockable.cert_id)
+  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+  cert_rules = rule_models.Rule.query(
+      rule_models.Rule.in_effect == True,
+      rule_models.Rule.policy == constants.RULE_POLICY.BLACKLIST,
+      ancestor=cert_key)
+  # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+  return cert_rules.count(limit=1) > 0
+
+
+def _GetBlockableProhibitedReasons(blockable):
+  """Checks the user-independent reasons voting is prohibited for a Blockable.
+
+  The blacklisted cert check is left to _HasBlacklistedCert().
+
+  Args:
+    blockable: The Blockable to check.
+
+  Returns:
+    A (user_reason, admin_reason) tuple, where each reason is one of
+    constants.VOTING_PROHIBITED_REASONS (or None if voting is allowed) for
+    non-admins and admins respectively.
+  """
   # Checks that are specific to SantaBundles.
   if isinstance(blockable, package_models.SantaBundle):
 
     # Even admins can't vote on a Bundle that hasn't been uploaded.
     if not blockable.has_been_uploaded:
-      return constants.VOTING_PROHIBITED_REASONS.UPLOADING_BUNDLE
-
-    # Only perform flagged binary and cert checks if this is called outside of
-    # an NDB transaction. This is due to the fact that HasFlaggedBinary() and
-    # HasFlaggedCert() can touch more than 25 entities.
-    if not ndb.in_transaction():
+      reason = constants.VOTING_PROHIBITED_REASONS.UPLOADING_BUNDLE
+      return reason, reason
+
+    # Until the bundle's flag counts have been initialized, only perform
+    # flagged binary and cert checks if this is called outside of an NDB
+    # transaction. This is due to the fact that HasFlaggedBinary() and
+    # HasFlaggedCert() then have to touch more than 25 entities.
+    if blockable.has_flag_counts or not ndb.in_transaction():
       if blockable.HasFlaggedBinary():
-        return constants.VOTING_PROHIBITED_REASONS.FLAGGED_BINARY
+        reason = constants.VOTING_PROHIBITED_REASONS.FLAGGED_BINARY
+        return reason, reason
       elif blockable.HasFlaggedCert():
-        return constants.VOTING_PROHIBITED_REASONS.FLAGGED_CERT
-
-  # Checks that are specific to SantaBlockables.
-  elif isinstance(blockable, binary_models.SantaBlockable):
-
-    # Voting is not allowed if the binary is signed by a blacklisted cert if the
-    # user is not an admin.
-    if not current_user.is_admin and blockable.cert_id:
-      cert = cert_models.SantaCertificate.get_by_id(blockable.cert_id)
-      # pylint: disable=g-explicit-bool-comparison, singleton-comparison
-      cert_rules = rule_models.Rule.query(
-          rule_models.Rule.in_effect == True,
-          rule_models.Rule.policy == constants.RULE_POLICY.BLACKLIST,
-          ancestor=cert.key)
-      # pylint: enable=g-explicit-bool-comparison, singleton-comparison
-      if cert_rules.count() > 0:
-        return constants.VOTING_PROHIBITED_REASONS.BLACKLISTED_CERT
+        reason = constants.VOTING_PROHIBITED_REASONS.FLAGGED_CERT
+        return reason, reason
 
+  return (
+      _GetStateProhibitedReason(blockable, False),
+      _GetStateProhibitedReason(blockable, True))
+
+
+def _GetStateProhibitedReason(blockable, is_admin):
+  """Checks whether the state of a Blockable prohibits voting.
+
+  Args:
+    blockable: The Blockable to check.
+    is_admin: bool, Whether the prospective voter is an admin.
+
+  Returns:
+    One of constants.VOTING_PROHIBITED_REASONS, or None if voting is allowed.
+  """
   # If the Blockable is in a prohibited state, no one can vote on it.
   if blockable.state in constants.STATE.SET_VOTING_PROHIBITED:
     return constants.VOTING_PROHIBITED_REASONS.PROHIBITED_STATE
 
   # Only admins are allowed to vote when Blockables are in certain states.
   if blockable.state in constants.STATE.SET_VOTING_ALLOWED_ADMIN_ONLY:
-    if current_user.is_admin:
+    if is_admin:
       return None
     else:
       return constants.VOTING_PROHIBITED_REASONS.ADMIN_ONLY
 
   # Only admins can vote on certs.
-  if (isinstance(blockable, cert_models.Certificate)
-      and not current_user.is_admin):
+  if isinstance(blockable, cert_models.Certificate) and not is_admin:
     return constants.VOTING_PROHIBITED_REASONS.ADMIN_ONLY
 
   # The Blockable has to be in a state where voting is allowed.
@@ -227,6 +281,114 @@ def _GetVotingProhibitedReason(blockable_key, current_user=None):
   return None
 
 
+def _GetCachedProhibitedReasons(blockable, eligibility):
+  """Returns the (user_reason, admin_reason) of a Blockable, caching them.
+
+  Args:
+    blockable: The Blockable to check.
+    eligibility: The cached _VotingEligibility of the Blockable, or None.
+
+  Returns:
+    A (user_reason, admin_reason) tuple, as from
+    _GetBlockableProhibitedReasons().
+  """
+  if eligibility is not None and eligibility.IsCurrent(blockable):
+    return eligibility.user_reason, eligibility.admin_reason
+
+  user_reason, admin_reason = _GetBlockableProhibitedReasons(blockable)
+  _VotingEligibility(
+      key=_VotingEligibility.GetKey(blockable.key), user_reason=user_reason,
+      admin_reason=admin_reason,
+      blockable_updated_dt=blockable.updated_dt).put()
+  return user_reason, admin_reason
+
+
+def _UpdateBundleFlagCounts(blockable_key, is_cert):
+  """Recounts the flags of the bundles containing a binary or cert.
+
+  Args:
+    blockable_key: Key, The key of the SantaBlockable or SantaCertificate.
+    is_cert: bool, Whether the key is of a SantaCertificate.
+  """
+  if is_cert:
+    member_counts = package_models.SantaBundle.GetMemberCountsByBundle(
+        cert_key=blockable_key)
+  else:
+    member_counts = package_models.SantaBundle.GetMemberCountsByBundle(
+        blockable_key=blockable_key)
+
+  for bundle_key in member_counts:
+    package_models.SantaBundle.UpdateFlagCounts(bundle_key)
+  logging.info(
+      'Updated the flag counts of %d bundle(s) containing %s',
+      len(member_counts), blockable_key.id())
+
+
+def _DeferBundleFlagCountUpdate(blockable, was_flagged):
+  """Schedules a recount of a Blockable's bundles if its flag changed.
+
+  Must be called in the transaction which changed the flag, so the update is
+  enqueued if and only if the change commits.
+
+  Args:
+    blockable: The Blockable, as it is after the change.
+    was_flagged: bool, Whether the Blockable was flagged before the change.
+  """
+  if blockable.flagged == was_flagged:
+    return
+  is_cert = isinstance(blockable, cert_models.SantaCertificate)
+  if not is_cert and not isinstance(blockable, binary_models.SantaBlockable):
+    return
+  deferred.defer(
+      _UpdateBundleFlagCounts, blockable.key, is_cert, _transactional=True)
+
+
+def _GetVotingProhibitedReason(blockable_key, current_user=None):
+  """Checks if voting is prohibted for the given Blockable.
+
+  Outside of a transaction, the user-independent checks other than the
+  blacklisted cert check are served from a cached _VotingEligibility. Within
+  one, they're always evaluated directly.
+
+  Args:
+    blockable_key: The NDB Key of the Blockable to check.
+    current_user: The optional User whose voting privileges should be
+        evaluated against this Blockable. If not provided, the current AppEngine
+        user will be used instead.
+
+  Returns:
+    One of constants.VOTING_PROHIBITED_REASONS, or None if voting is allowed.
+
+  Raises:
+    BlockableNotFoundError: if the given Blockable cannot be found.
+  """
+  if ndb.in_transaction():
+    blockable, eligibility = blockable_key.get(), None
+  else:
+    blockable, eligibility = ndb.get_multi(
+        [blockable_key, _VotingEligibility.GetKey(blockable_key)])
+  if blockable is None:
+    raise BlockableNotFoundError('ID: %s' % blockable_key.id())
+
+  # If the user can't vote, just stop right here.
+  current_user = current_user or user_models.User.GetOrInsert()
+  if not current_user.HasPermission(constants.PERMISSIONS.VOTE):
+    return constants.VOTING_PROHIBITED_REASONS.INSUFFICIENT_PERMISSION
+
+  # Voting is not allowed if the binary is signed by a blacklisted cert if the
+  # user is not an admin.
+  if not current_user.is_admin and _HasBlacklistedCert(blockable):
+    return constants.VOTING_PROHIBITED_REASONS.BLACKLISTED_CERT
+
+  if ndb.in_transaction():
+    user_reason, admin_reason = _GetBlockableProhibitedReasons(blockable)
+  else:
+    user_reason, admin_reason = _GetCachedProhibitedReasons(
+        blockable, eligibility)
+
+  return admin_reason if current_user.is_admin else user_reason
+
+
 def IsVotingAllowed(blockable_key, current_user=None):
   """Checks if voting is allowed for the given Blockable.
 
@@ -284,12 +446,109 @@ def Vote(user, sha256, upvote, weight):
   return ballot_box.new_vote
 
 
+# The maximum number of votes which can be cast in a single BatchVote() call.
+MAX_BATCH_VOTES = 500
+
+# The maximum number of votes from a batch which are resolved concurrently.
+_MAX_CONCURRENT_VOTES = 10
+
+# The outcome of a single vote cast by BatchVote(). Exactly one of vote and
+# error is populated.
+BatchVoteResult = collections.namedtuple(
+    'BatchVoteResult', ['sha256', 'vote', 'error'])
+
+
+def _CastBatchVote(ballot_box_cls, user, sha256, upvote, weight):
+  ballot_box = ballot_box_cls(sha256)
+  try:
+    ballot_box.Vote(upvote, user, weight)
+  except Error as e:
+    return BatchVoteResult(sha256, None, e)
+  except Exception as e:  # pylint: disable=broad-except
+    logging.exception('Batch vote for %s failed', sha256)
+    return BatchVoteResult(sha256, None, e)
+  return BatchVoteResult(sha256, ballot_box.new_vote, None)
+
+
+def BatchVote(user, votes, weight):
+  """Casts votes for a number of Blockables at once.
+
+  All the Blockables are fetched in a single batch to weed out unknown ones and
+  those from unsupported clients. The remaining votes are grouped by client and
+  each is resolved through the usual BallotBox flow, up to
+  _MAX_CONCURRENT_VOTES at a time. A failure to cast one vote doesn't affect
+  the others.
+
+  Args:
+    user: User entity representing the person casting the votes.
+    votes: list<(str, bool)>, The SHA256 of each Blockable being voted on,
+        along with whether the vote is a 'yes' vote.
+    weight: int, The weight with which the votes will be cast. The weight must
+        be >= 0 (UNTRUSTED_USERs have vote weight 0).
+
+  Returns:
+    A list of BatchVoteResults, in the same order as votes. The error of a
+    failed vote is one of the errors raised by Vote().
+
+  Raises:
+    InvalidVoteWeightError: if the vote weight is less than zero.
+    ValueError: if there are more than MAX_BATCH_VOTES votes.
+  """
+  if weight < 0:
+    raise InvalidVoteWeightError(weight)
+  if len(votes) > MAX_BATCH_VOTES:
+    raise ValueError(
+        'At most %d votes can be cast at once (got %d)' % (
+            MAX_BATCH_VOTES, len(votes)))
+
+  blockables = ndb.get_multi(
+      [ndb.Key(binary_models.Blockable, sha256) for sha256, _ in votes])
+
+  results = [None] * len(votes)
+  votes_by_client = collections.defaultdict(list)
+  seen_sha256s = set()
+
+  for index, ((sha256, upvote), blockable) in enumerate(
+      zip(votes, blockables)):
+    try:
+      if sha256 in seen_sha256s:
+        raise DuplicateVoteError(
+            'Blockable %s appears more than once in the batch' % sha256)
+      seen_sha256s.add(sha256)
+      if blockable is None:
+        raise BlockableNotFoundError('SHA256: %s' % sha256)
+      client = _GetClient(blockable)
+    except Error as e:
+      results[index] = BatchVoteResult(sha256, None, e)
+    else:
+      votes_by_client[client].append((index, sha256, upvote))
+
+  for client, client_votes in sorted(votes_by_client.iteritems()):
+    logging.info(
+        'Casting %d %s vote(s) for %s', len(client_votes), client, user.email)
+    ballot_box_cls = _BALLOT_BOX_MAP[client]
+    max_workers = min(len(client_votes), _MAX_CONCURRENT_VOTES)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      running_futures = {
+          executor.submit(
+              _CastBatchVote, ballot_box_cls, user, sha256, upvote,
+              weight): index
+          for index, sha256, upvote in client_votes}
+      for done_future in futures.as_completed(running_futures):
+        results[running_futures[done_future]] = done_future.result()
+
+  return results
+
+
 def Recount(sha256):
   """Checks votes, state, and rules for the specified Blockable.
 
   Args:
     sha256: The SHA256 of the Blockable to recount.
 
+  Returns:
+    The updated Blockable entity if the recount changed it, otherwise None.
+
   Raises:
     BlockableNotFoundError: if the target blockable ID is not a known Blockable.
     UnsupportedClientError: if the specified Blockable came from an unsupported
@@ -299,7 +558,14 @@ def Recount(sha256):
   client = _GetClient(blockable)
 
   ballot_box = _BALLOT_BOX_MAP[client](sha256)
-  ballot_box.Recount()
+  change_made = ballot_box.Recount()
+
+  if isinstance(blockable, package_models.SantaBundle):
+    change_made = (
+        package_models.SantaBundle.UpdateFlagCounts(blockable.key) or
+        change_made)
+
+  return ballot_box.blockable if change_made else None
 
 
 def Reset(sha256):
@@ -321,6 +587,110 @@ def Reset(sha256):
   ballot_box.Reset()
 
 
+# The maximum number of Votes archived, or Rules disabled, per transaction when
+# resetting a Blockable.
+_RESET_BATCH_SIZE = 100
+
+# The amount of time spent resetting a Blockable in the request which started
+# the reset, before handing off to a task.
+_RESET_INLINE_DURATION = datetime.timedelta(seconds=10)
+
+# The amount of time a reset task runs for before handing off to a new one.
+_RESET_TASK_DURATION = datetime.timedelta(minutes=9)
+
+
+class _ResetProgress(ndb.Model):
+  """The progress of an ongoing reset of a Blockable.
+
+  Only exists while the Blockable is in the RESETTING state.
+
+  key = Key(Blockable, blockable_id) -> Key(_ResetProgress, 1)
+
+  Attributes:
+    was_flagged: bool, Whether the Blockable was flagged before the reset.
+    started_dt: datetime, When the reset was started. Rules recorded after this
+        (i.e. the removal rules generated by the reset) are left in effect.
+    archived_vote_count: int, The number of Votes archived so far.
+    disabled_rule_count: int, The number of Rules disabled so far.
+    removed_host_ids: list<str>, The hosts for which removal rules have been
+        generated so far, with '' standing for a global removal rule.
+  """
+  was_flagged = ndb.BooleanProperty(indexed=False)
+  started_dt = ndb.DateTimeProperty(indexed=False)
+  archived_vote_count = ndb.IntegerProperty(default=0, indexed=False)
+  disabled_rule_count = ndb.IntegerProperty(default=0, indexed=False)
+  removed_host_ids = ndb.StringProperty(repeated=True, indexed=False)
+
+  @classmethod
+  def GetKey(cls, blockable_key):
+    return ndb.Key(cls, 1, parent=blockable_key)
+
+
+def _ResumeReset(blockable_id):
+  """Continues a reset which didn't complete in its previous request."""
+  blockable = _GetBlockable(blockable_id)
+  ballot_box = _BALLOT_BOX_MAP[_GetClient(blockable)](blockable_id)
+  ballot_box._ContinueReset(  # pylint: disable=protected-access
+      _RESET_TASK_DURATION)
+
+
+# The number of users whose local whitelist Rules are created by a single task.
+_LOCAL_WHITELIST_BATCH_SIZE = 20
+
+
+def _GetLocallyWhitelistableBlockable(blockable_id):
+  blockable = binary_models.Blockable.get_by_id(blockable_id)
+  if (blockable is None or
+      blockable.state != constants.STATE.APPROVED_FOR_LOCAL_WHITELISTING):
+    logging.info('No longer locally whitelisting %s', blockable_id)
+    return None
+  return blockable
+
+
+def _FanOutLocalWhitelisting(blockable_id):
+  """Splits the upvoters of a Blockable into local whitelisting tasks.
+
+  Args:
+    blockable_id: str, The ID of the Blockable to locally whitelist.
+  """
+  blockable = _GetLocallyWhitelistableBlockable(blockable_id)
+  if blockable is None:
+    return
+
+  user_ids = sorted(user_key.id() for user_key in _GetUpvoters(blockable))
+  batches = [
+      user_ids[i:i + _LOCAL_WHITELIST_BATCH_SIZE]
+      for i in xrange(0, len(user_ids), _LOCAL_WHITELIST_BATCH_SIZE)]
+  for batch in batches:
+    deferred.defer(
+        _LocallyWhitelistBatch, blockable_id, batch,
+        _queue=constants.TASK_QUEUE.LOCAL_WHITELISTING)
+
+  logging.info(
+      'Locally whitelisting %s for %d user(s) in %d task(s)', blockable_id,
+      len(user_ids), len(batches))
+
+
+def _LocallyWhitelistBatch(blockable_id, user_ids):
+  """Creates local whitelist Rules for a batch of users.
+
+  Safe to retry, since existing Rules are detected within the transaction that
+  creates the missing ones.
+
+  Args:
+    blockable_id: str, The ID of the Blockable to locally whitelist.
+    user_ids: list<str>, The IDs of the users to whitelist it for.
+  """
+  blockable = _GetLocallyWhitelistableBlockable(blockable_id)
+  if blockable is None:
+    return
+
+  ballot_box = _BALLOT_BOX_MAP[_GetClient(blockable)](blockable_id)
+  ballot_box.blockable = blockable
+  ballot_box._LocallyWhitelist(  # pylint: disable=protected-access
+      [ndb.Key(user_models.User, user_id) for user_id in user_ids]).get_result()
+
+
 class BallotBox(object):
   """Class that modifies the voting state of a given Blockable.
 
@@ -341,6 +711,9 @@ class BallotBox(object):
     self.old_vote = None
     self.new_vote = None
 
+    # The hosts for which removal rules have been generated by a reset.
+    self._removed_host_ids = set()
+
   def Vote(self, was_yes_vote, user, vote_weight=None):
     """Resolve votes for or against the target blockable.
 
@@ -378,23 +751,18 @@ class BallotBox(object):
         '(blockable=%s, was_yes_vote=%s, user=%s, weight=%s',
         self.blockable_id, was_yes_vote, self.user.email, vote_weight)
 
+    # The flagged binary and cert checks for bundles can't be performed within
+    # the voting transaction because they can exceed the cross-group
+    # transaction limit, so they're done once up front. All other blockables
+    # are only checked within the transaction.
     self.blockable = _GetBlockable(self.blockable_id)
-    initial_score = self.blockable.score
-    initial_state = self.blockable.state
-
-    # Check is voting is allowed once before calling _TransactionalVoting() in
-    # order to work around the cross-group transaction limitation encountered
-    # by larger macOS bundles.
-    allowed, reason = IsVotingAllowed(
-        self.blockable.key, current_user=self.user)
-    if not allowed:
-      message = 'Voting is not allowed (%s)' % reason
-      raise OperationNotAllowedError(message)
-
-    # Perform the vote.
-    self._TransactionalVoting(self.blockable_id, was_yes_vote, vote_weight)
+    if isinstance(self.blockable, package_models.SantaBundle):
+      self._CheckVotingAllowed()
 
-    self.blockable = _GetBlockable(self.blockable_id)
+    # Perform the vote. Upon return, self.blockable reflects the committed
+    # score and state.
+    initial_score, initial_state = self._TransactionalVoting(
+        self.blockable_id, was_yes_vote, vote_weight)
     new_score = self.blockable.score
     new_state = self.blockable.state
 
@@ -417,22 +785,16 @@ class BallotBox(object):
     # transaction because of its non-ancestor queries on Host entities.
     if new_state == constants.STATE.APPROVED_FOR_LOCAL_WHITELISTING:
 
-      # If it just crossed the local threshold, whitelist for all voters.
+      # If it just crossed the local threshold, whitelist for all voters. There
+      # could be hundreds of them, so this is fanned out to background tasks.
       if initial_state != new_state:
-        self._LocallyWhitelist().get_result()
+        self._DeferLocallyWhitelist()
 
       # Otherwise, the voter was just requesting that they be able to run it
       # too, so only whitelist it for them.
       elif was_yes_vote:
         self._LocallyWhitelist(user_keys=[self.user.key]).get_result()
 
-    # NOTE: Blockable.score is not properly updated by puts executed
-    # within the transaction as the Vote ancestor query in
-    # Blockable._CalculateScore() does not reflect the newly-created Vote
-    # entity. As such, we must 'turn the crank' and force a recount.
-    ndb.transaction(lambda: self.blockable.key.get().put())
-    self.blockable = self.blockable.key.get()
-
     # Record Lookup Metrics for the vote.
     if not isinstance(self.blockable, package_models.Package):
       reason = (
@@ -441,9 +803,20 @@ class BallotBox(object):
           else constants.ANALYSIS_REASON.DOWNVOTE)
       metrics.DeferLookupMetric(self.blockable.key.id(), reason)
 
+  def _CheckVotingAllowed(self):
+    allowed, reason = IsVotingAllowed(
+        self.blockable.key, current_user=self.user)
+    if not allowed:
+      message = 'Voting is not allowed (%s)' % reason
+      raise OperationNotAllowedError(message)
+
   @ndb.transactional(xg=True)
   def _TransactionalVoting(self, blockable_id, was_yes_vote, vote_weight):
-    """Performs part of the voting that should be handled in a transaction."""
+    """Performs part of the voting that should be handled in a transaction.
+
+    Returns:
+      A (score, state) tuple of the blockable prior to the vote.
+    """
 
     # To accommodate transaction retries, re-get the Blockable entity at the
     # start of each transaction. This ensures up-to-date state+score values.
@@ -451,11 +824,7 @@ class BallotBox(object):
 
     # Verify that voting is allowed within a transaction, minus the macOS bundle
     # checks which can exceed the cross-group transaction limit.
-    allowed, reason = IsVotingAllowed(
-        self.blockable.key, current_user=self.user)
-    if not allowed:
-      message = 'Voting is not allowed (%s)' % reason
-      raise OperationNotAllowedError(message)
+    self._CheckVotingAllowed()
 
     if (isinstance(self.blockable, package_models.SantaBundle)
         and not was_yes_vote):
@@ -465,13 +834,20 @@ class BallotBox(object):
     logging.info('Initial blockable state: %s', initial_state)
 
     initial_score = self.blockable.score
+    initial_flagged = self.blockable.flagged
     self._CreateOrUpdateVote(was_yes_vote, vote_weight)
     assert self.new_vote is not None
 
+    # The score is only ever adjusted here, by the change in effective vote
+    # weight, so that puts of the blockable don't need to re-tally its votes.
     new_score = self._GetNewScore(initial_score)
+    self.blockable.score = new_score
     self._UpdateBlockable(new_score)
 
-    return initial_state
+    # Keep the flag counts of any bundles containing the blockable up to date.
+    _DeferBundleFlagCountUpdate(self.blockable, initial_flagged)
+
+    return initial_score, initial_state
 
   def _CreateOrUpdateVote(self, was_yes_vote, vote_weight):
     """Creates a new vote or updates an existing one."""
@@ -546,9 +922,6 @@ class BallotBox(object):
           self.blockable.state not in constants.STATE.SET_BANNED):
         self.blockable.ChangeState(constants.STATE.SUSPECT)
 
-    # NOTE: Blockable.score will not be updated properly for a
-    # newly-cast Vote (i.e. not a changed vote) because the new Vote entity
-    # won't be created until the transaction has been committed.
     self.blockable.put()
 
   @abc.abstractmethod
@@ -568,9 +941,19 @@ class BallotBox(object):
     logging.info('Recount for blockable: %s', self.blockable_id)
 
     self.blockable = binary_models.Blockable.get_by_id(self.blockable_id)
+    was_flagged = self.blockable.flagged
+
+    # Votes and rules are in flux until the reset is complete.
+    if self.blockable.state == constants.STATE.RESETTING:
+      logging.info(
+          'Skipping recount of %s while it is reset', self.blockable_id)
+      return False
+
+    # First repair any drift between the stored score and the votes in effect.
+    change_made = self._AuditBlockableScore()
 
     # Then check to see if the blockable should be flagged and if it is.
-    change_made = _CheckBlockableFlagStatus(self.blockable)
+    change_made = _CheckBlockableFlagStatus(self.blockable) or change_made
 
     # Check that the blockable's state is set correctly.
     change_made = self._AuditBlockableState() or change_made
@@ -584,50 +967,144 @@ class BallotBox(object):
           'Recount changed blockable %s, putting to datastore',
           self.blockable.key.id())
       self.blockable.put()
+      _DeferBundleFlagCountUpdate(self.blockable, was_flagged)
       return True
     else:
       return False
 
   @abc.abstractmethod
   def _GenerateRemoveRules(self, existing_rules):
-    """Creates removal rules to undo all policy for the target blockable."""
+    """Creates removal rules to undo the policy of the given rules.
+
+    Called for each batch of rules disabled by a reset, so removal rules should
+    only be created for hosts not already in self._removed_host_ids, which
+    should be updated accordingly.
+
+    Args:
+      existing_rules: list<Rule>, The rules being disabled.
+    """
 
-  @ndb.transactional
   def Reset(self):
     """Resets all policy (i.e. votes, rules, score) for the target blockable.
 
+    The blockable is put into the RESETTING state, after which its votes are
+    archived and its rules disabled in batches, each in its own transaction, so
+    that a reset isn't bounded by the size of the blockable's history. Batches
+    are run inline for up to _RESET_INLINE_DURATION, after which the reset is
+    continued by a chain of tasks. Calling Reset() on a blockable which is
+    already being reset resumes that reset.
+
     Raises:
       BlockableNotFoundError: The target blockable ID is not a known Blockable.
     """
     logging.info('Resetting blockable: %s', self.blockable_id)
+    self._StartReset()
+    self._ContinueReset(_RESET_INLINE_DURATION)
 
-    self.blockable = binary_models.Blockable.get_by_id(self.blockable_id)
+  @ndb.transactional
+  def _StartReset(self):
+    """Puts the blockable into the RESETTING state."""
+    self.blockable = _GetBlockable(self.blockable_id)
+    progress_key = _ResetProgress.GetKey(self.blockable.key)
+    if progress_key.get() is not None:
+      return
+
+    _ResetProgress(
+        key=progress_key, was_flagged=self.blockable.flagged,
+        started_dt=datetime.datetime.utcnow()).put()
+
+    # The state change is only transient, so it's recorded in BigQuery as part
+    # of the RESET row once the reset completes.
+    self.blockable.state = constants.STATE.RESETTING
+    self.blockable.state_change_dt = datetime.datetime.utcnow()
+    self.blockable.put()
 
-    votes = self.blockable.GetVotes()
+  def _ContinueReset(self, duration):
+    """Runs reset batches until there are none left or duration elapses.
 
-    # Delete existing votes.
-    delete_futures = ndb.delete_multi_async(vote.key for vote in votes)
+    Args:
+      duration: timedelta, How long to run batches for before deferring the
+          rest of the reset to a task. At least one batch is always run.
+    """
+    start_time = time_utils.Now()
+    while self._ResetBatch():
+      if not time_utils.TimeRemains(start_time, duration):
+        logging.info('Deferring the rest of the reset of %s', self.blockable_id)
+        deferred.defer(
+            _ResumeReset, self.blockable_id,
+            _queue=constants.TASK_QUEUE.BLOCKABLE_RESET)
+        return
 
-    # Store old vote entities with a different key indicating that they are
+    self._FinishReset()
+
+  @ndb.transactional
+  def _ResetBatch(self):
+    """Archives a batch of votes or, once there are none left, disables rules.
+
+    Returns:
+      Whether any votes or rules were reset by this batch.
+    """
+    self.blockable = _GetBlockable(self.blockable_id)
+    progress = _ResetProgress.GetKey(self.blockable.key).get()
+    if progress is None:
+      return False
+
+    # Archived votes are stored under a different key, indicating that they're
     # deactivated so they won't be counted towards the blockable's score.
-    archived_votes = votes
-    for vote in archived_votes:
-      vote.key = vote_models.Vote.GetKey(
-          vote.blockable_key, vote.user_key, in_effect=False)
-    ndb.put_multi_async(archived_votes)
-
-    # Disable all existing rules.
-    existing_rules = _GetRulesForBlockable(self.blockable)
-    for rule in existing_rules:
-      rule.MarkDisabled()
-    ndb.put_multi_async(existing_rules)
+    # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+    votes = vote_models.Vote.query(
+        vote_models.Vote.in_effect == True,
+        ancestor=self.blockable.key).fetch(_RESET_BATCH_SIZE)
+    # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+    if votes:
+      ndb.delete_multi(vote.key for vote in votes)
+      for vote in votes:
+        vote.key = vote_models.Vote.GetKey(
+            vote.blockable_key, vote.user_key, in_effect=False)
+      progress.archived_vote_count += len(votes)
+      ndb.put_multi(votes + [progress])
+      return True
+
+    # Disable the next batch of rules, and create REMOVE-type rules for them.
+    # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+    rules = rule_models.Rule.query(
+        rule_models.Rule.in_effect == True,
+        rule_models.Rule.recorded_dt < progress.started_dt,
+        ancestor=self.blockable.key).fetch(_RESET_BATCH_SIZE)
+    # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+    if rules:
+      for rule in rules:
+        rule.MarkDisabled()
+      self._removed_host_ids = set(progress.removed_host_ids)
+      self._GenerateRemoveRules(rules)
+      progress.removed_host_ids = sorted(self._removed_host_ids)
+      progress.disabled_rule_count += len(rules)
+      ndb.put_multi(rules + [progress])
+      host_index.Update(rules)
+      return True
+
+    return False
+
+  @ndb.transactional
+  def _FinishReset(self):
+    """Resets the blockable's state and score once all batches are done."""
+    self.blockable = _GetBlockable(self.blockable_id)
+    progress = _ResetProgress.GetKey(self.blockable.key).get()
+    if progress is None:
+      return
+
+    logging.info(
+        'Reset %s: archived %d vote(s), disabled %d rule(s)',
+        self.blockable_id, progress.archived_vote_count,
+        progress.disabled_rule_count)
 
-    # Create REMOVE-type rules from the existing blockable rules.
-    self._GenerateRemoveRules(existing_rules)
+    # Make sure the removal rules exist even if there were no rules to remove.
+    self._removed_host_ids = set(progress.removed_host_ids)
+    self._GenerateRemoveRules([])
 
-    # Ensure past votes are deleted and then reset the blockable score.
-    ndb.Future.wait_all(delete_futures)
+    progress.key.delete()
     self.blockable.ResetState()
+    _DeferBundleFlagCountUpdate(self.blockable, progress.was_flagged)
 
   def _CheckAndSetBlockableState(self, score):
     """Checks a blockable's score and changes its state if needed."""
@@ -693,6 +1170,7 @@ class BallotBox(object):
 
     # Put all new/modified Rules.
     yield ndb.put_multi_async(changed_rules + [whitelist_rule])
+    host_index.Update(changed_rules)
     raise ndb.Return([whitelist_rule])
 
   @ndb.tasklet
@@ -708,12 +1186,14 @@ class BallotBox(object):
     Returns:
       A list of newly-created Rules.
     """
-    # Query for all active local whitelisting rules for this blockable.
+    # Query for the active local whitelisting rules of just these users, so the
+    # cost of each batch doesn't grow with the total number of voters.
     # pylint: disable=g-explicit-bool-comparison, singleton-comparison
     existing_rule_query = rule_models.Rule.query(
         rule_models.Rule.policy == constants.RULE_POLICY.WHITELIST,
         rule_models.Rule.in_effect == True,
         rule_models.Rule.rule_type == self.blockable.rule_type,
+        rule_models.Rule.user_key.IN(local_rule_dict.keys()),
         ancestor=self.blockable.key)
     # pylint: enable=g-explicit-bool-comparison, singleton-comparison
     existing_rules = yield existing_rule_query.fetch_async()
@@ -753,21 +1233,19 @@ class BallotBox(object):
     logging.info(
         'Creating %d new Rules for %s', len(new_rules), self.blockable.key.id())
     yield ndb.put_multi_async(new_rules)
+    host_index.Update(new_rules)
     raise ndb.Return(new_rules)
 
-  def _LocallyWhitelist(self, user_keys=None):
+  def _LocallyWhitelist(self, user_keys):
     """Locally whitelists a Blockable for the provided users.
 
     Args:
       user_keys: list<Key>, A list of users for whom the Blockable should be
-          locally whitelisted. If not provided, defaults to all prior voters.
+          locally whitelisted.
 
     Returns:
       A Future corresponding to the newly-persisted Rules.
     """
-    # If no users are specified, default to the voters.
-    if not user_keys:
-      user_keys = _GetUpvoters(self.blockable)
     logging.info(
         'Locally whitelisting %s for the following users: %s',
         self.blockable.key.id(),
@@ -785,6 +1263,12 @@ class BallotBox(object):
     return ndb.transaction_async(
         lambda: self._CreateNewLocalWhitelistingRules(local_rule_dict))
 
+  def _DeferLocallyWhitelist(self):
+    """Locally whitelists the Blockable for all upvoters in the background."""
+    deferred.defer(
+        _FanOutLocalWhitelisting, self.blockable.key.id(),
+        _queue=constants.TASK_QUEUE.LOCAL_WHITELISTING)
+
   @abc.abstractmethod
   def _GetHostsToWhitelist(self, user_key):
     """Returns hosts for which whitelist rules should be created for a user.
@@ -821,8 +1305,21 @@ class BallotBox(object):
 
     # Put all new/modified Rules.
     yield ndb.put_multi_async(changed_rules + [blacklist_rule])
+    host_index.Update(changed_rules)
     raise ndb.Return([blacklist_rule])
 
+  def _AuditBlockableScore(self):
+    """Audit the score of a blockable against the votes in effect."""
+    expected_score = self.blockable.CalculateScore()
+    if self.blockable.score == expected_score:
+      return False
+
+    logging.warning(
+        'Blockable %s had score %d, but its votes total %d',
+        self.blockable.key.id(), self.blockable.score, expected_score)
+    self.blockable.score = expected_score
+    return True
+
   def _AuditBlockableState(self):
     """Audit the state of a blockable against past voting."""
     if self.blockable.state == constants.STATE.SUSPECT:
@@ -899,6 +1396,7 @@ class BallotBox(object):
           rule.MarkDisabled()
           modified_rules.append(rule)
     ndb.put_multi(modified_rules)
+    host_index.Update(modified_rules)
 
     # Check to make sure there is at least one appropriate rule created.
     if (self.blockable.state == constants.STATE.GLOBALLY_WHITELISTED and
@@ -948,20 +1446,20 @@ class SantaBallotBox(BallotBox):
         host_models.SantaHost.primary_user == username)
     return {host_key.id() for host_key in query.fetch(keys_only=True)}
 
-  def _LocallyWhitelist(self, user_keys=None):
-    future = super(SantaBallotBox, self)._LocallyWhitelist(user_keys=user_keys)
-    return future
-
   def _GenerateRemoveRules(self, unused_existing_rules):
+    # A single global removal rule undoes all policy for the blockable.
+    if '' in self._removed_host_ids:
+      return
+    self._removed_host_ids.add('')
+
     removal_rule = self._GenerateRule(
         policy=constants.RULE_POLICY.REMOVE,
         in_effect=True)
     removal_rule.put_async()
     removal_rule.InsertBigQueryRow()
 
-  @ndb.transactional
   def Reset(self):
-    self.blockable = binary_models.Blockable.get_by_id(self.blockable_id)
+    self.blockable = _GetBlockable(self.blockable_id)
     if isinstance(self.blockable, package_models.SantaBundle):
       raise OperationNotAllowedError('Resetting not supported for Bundles')
 
@@ -1028,8 +1526,8 @@ class Bit9BallotBox(BallotBox):
     query = host_models.Bit9Host.query(host_models.Bit9Host.users == username)
     return {host_key.id() for host_key in query.fetch(keys_only=True)}
 
-  def _LocallyWhitelist(self, user_keys=None):
-    future = super(Bit9BallotBox, self)._LocallyWhitelist(user_keys=user_keys)
+  def _LocallyWhitelist(self, user_keys):
+    future = super(Bit9BallotBox, self)._LocallyWhitelist(user_keys)
     future.add_callback(
         self._CreateRuleChangeSet, future, constants.RULE_POLICY.WHITELIST)
     return future
@@ -1042,7 +1540,9 @@ class Bit9BallotBox(BallotBox):
 
   def _GenerateRemoveRules(self, existing_rules):
     # Create removal rules on each host for which a rule exists.
-    host_ids = set(rule.host_id for rule in existing_rules)
+    host_ids = (
+        set(rule.host_id for rule in existing_rules) - self._removed_host_ids)
+    self._removed_host_ids |= host_ids
     removal_rules = []
     for host_id in host_ids:
       removal_rule = self._GenerateRule(
@@ -1051,6 +1551,7 @@ class Bit9BallotBox(BallotBox):
       removal_rule.InsertBigQueryRow()
     put_futures = ndb.put_multi_async(removal_rules)
     future = datastore_utils.GetMultiFuture(put_futures)
+    future.add_callback(host_index.Update, removal_rules)
     future.add_callback(
         self._CreateRuleChangeSet, datastore_utils.GetNoOpFuture(removal_rules),
         constants.RULE_POLICY.REMOVE)
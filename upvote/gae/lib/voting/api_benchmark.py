@@ -0,0 +1,204 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of voting and rule generation.
+
+Each scenario is run against both Santa and Bit9 Blockables which already have
+a number of votes and rules, cast by voters who each have a number of hosts.
+The Datastore RPCs issued and the wall time are reported for each, and can be
+appended to a results file to track them over time.
+
+  bazel run //upvote/gae/lib/voting:api_benchmark -- \
+      --benchmark_existing_votes=100 --benchmark_hosts_per_voter=3 \
+      --benchmark_results_file=/tmp/voting_benchmark.jsonl
+"""
+
+import collections
+import datetime
+import json
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+from upvote.gae.datastore import test_utils
+from upvote.gae.lib.testing import basetest
+from upvote.gae.lib.voting import api
+from upvote.gae.utils import user_utils
+from upvote.shared import constants
+from absl import flags
+from absl import logging
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('benchmark_votes', 50, 'The number of votes to cast.')
+flags.DEFINE_integer(
+    'benchmark_blockables', 5,
+    'The number of Blockables to run each non-voting scenario against.')
+flags.DEFINE_integer(
+    'benchmark_existing_votes', 10,
+    'The number of votes already cast for each Blockable.')
+flags.DEFINE_integer(
+    'benchmark_hosts_per_voter', 2, 'The number of hosts each voter has.')
+flags.DEFINE_integer(
+    'benchmark_existing_rules', 10,
+    'The number of rules which already exist for each Blockable.')
+flags.DEFINE_string(
+    'benchmark_results_file', None,
+    'If set, a JSON line per scenario is appended to this file.')
+
+_CLIENTS = (constants.CLIENT.SANTA, constants.CLIENT.BIT9)
+
+
+# pylint: disable=protected-access
+class VotingBenchmark(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(VotingBenchmark, self).setUp()
+
+    self.rpc_counts = collections.Counter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_counter', self._CountRpc, 'datastore_v3')
+
+  def _CountRpc(self, unused_service, call, unused_request, unused_response):
+    self.rpc_counts[call] += 1
+
+  def _CreateVoter(self, client):
+    user = test_utils.CreateUser()
+    username = user_utils.EmailToUsername(user.email)
+    for _ in xrange(FLAGS.benchmark_hosts_per_voter):
+      if client == constants.CLIENT.SANTA:
+        test_utils.CreateSantaHost(primary_user=username)
+      else:
+        test_utils.CreateBit9Host(users=[username])
+    return user
+
+  def _CreateBlockable(self, client):
+    """Creates a Blockable along with its existing votes and rules."""
+    if client == constants.CLIENT.SANTA:
+      blockable = test_utils.CreateSantaBlockable()
+      test_utils.CreateSantaRules(
+          blockable.key, FLAGS.benchmark_existing_rules,
+          policy=constants.RULE_POLICY.WHITELIST, host_id='host')
+    else:
+      blockable = test_utils.CreateBit9Binary()
+      test_utils.CreateBit9Rules(
+          blockable.key, FLAGS.benchmark_existing_rules,
+          policy=constants.RULE_POLICY.WHITELIST, host_id='12345',
+          is_committed=True)
+
+    # Alternate the existing votes so the score stays clear of the thresholds.
+    voters = [
+        self._CreateVoter(client)
+        for _ in xrange(FLAGS.benchmark_existing_votes)]
+    for index, voter in enumerate(voters):
+      test_utils.CreateVote(
+          blockable, user_email=voter.email, was_yes_vote=bool(index % 2))
+
+    return blockable, voters
+
+  def _GetBallotBox(self, client, blockable):
+    ballot_box = api._BALLOT_BOX_MAP[client](blockable.key.id())
+    ballot_box.blockable = blockable
+    return ballot_box
+
+  def _Report(self, scenario, client, operation_count, elapsed):
+    logging.info(
+        '%s (%s): %d operation(s) in %.2fs (%.1f/sec)', scenario, client,
+        operation_count, elapsed, operation_count / elapsed if elapsed else 0)
+    for call, count in sorted(self.rpc_counts.items()):
+      logging.info('  %-20s %.2f/op', call, count / float(operation_count))
+
+    if FLAGS.benchmark_results_file:
+      result = {
+          'timestamp': datetime.datetime.utcnow().isoformat(),
+          'scenario': scenario,
+          'client': client,
+          'existing_votes': FLAGS.benchmark_existing_votes,
+          'hosts_per_voter': FLAGS.benchmark_hosts_per_voter,
+          'existing_rules': FLAGS.benchmark_existing_rules,
+          'operations': operation_count,
+          'seconds': elapsed,
+          'rpcs': dict(self.rpc_counts)}
+      with open(FLAGS.benchmark_results_file, 'a') as results_file:
+        results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+  def _Benchmark(self, scenario, client, operations):
+    """Runs each operation and reports the RPCs issued.
+
+    Args:
+      scenario: str, A name for the operations.
+      client: str, The client of the Blockables being operated on.
+      operations: list<callable>, The operations to run.
+    """
+    self.rpc_counts.clear()
+    start = time.time()
+    for operation in operations:
+      operation()
+    self._Report(scenario, client, len(operations), time.time() - start)
+
+  def _BenchmarkPerBlockable(self, scenario, func):
+    """Runs func(client, blockable, voters) against fresh Blockables."""
+    for client in _CLIENTS:
+      blockables = [
+          self._CreateBlockable(client)
+          for _ in xrange(FLAGS.benchmark_blockables)]
+      self._Benchmark(scenario, client, [
+          lambda b=blockable, v=voters, c=client: func(c, b, v)
+          for blockable, voters in blockables])
+
+  def testVote(self):
+    for client in _CLIENTS:
+      votes = [
+          (self._CreateBlockable(client)[0], self._CreateVoter(client))
+          for _ in xrange(FLAGS.benchmark_votes)]
+      self._Benchmark('Vote', client, [
+          lambda b=blockable, u=user: api.Vote(u, b.key.id(), True, 1)
+          for blockable, user in votes])
+
+      # Each vote should be resolved within a single transaction.
+      self.assertEqual(len(votes), self.rpc_counts['BeginTransaction'])
+
+  def testChangedVotes(self):
+    for client in _CLIENTS:
+      blockable, _ = self._CreateBlockable(client)
+      user = self._CreateVoter(client)
+      self._Benchmark('Changed votes', client, [
+          lambda i=i: api.Vote(user, blockable.key.id(), bool(i % 2), 1)
+          for i in xrange(FLAGS.benchmark_votes)])
+
+  def testRecount(self):
+    self._BenchmarkPerBlockable(
+        'Recount', lambda _, blockable, __: api.Recount(blockable.key.id()))
+
+  def testReset(self):
+    self._BenchmarkPerBlockable(
+        'Reset', lambda _, blockable, __: api.Reset(blockable.key.id()))
+
+  def testGloballyWhitelist(self):
+    self._BenchmarkPerBlockable(
+        'Globally whitelist',
+        lambda client, blockable, _: self._GetBallotBox(
+            client, blockable)._GloballyWhitelist().get_result())
+
+  def testLocallyWhitelist(self):
+    self._BenchmarkPerBlockable(
+        'Locally whitelist',
+        lambda client, blockable, voters: self._GetBallotBox(
+            client, blockable)._LocallyWhitelist(
+                [voter.key for voter in voters]).get_result())
+# pylint: enable=protected-access
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -14,6 +14,8 @@
 
 """Tests for voting logic."""
 
+import datetime
+
 import mock
 
 from google.appengine.ext import ndb
@@ -23,6 +25,7 @@ from upvote.gae.datastore import test_utils
 from upvote.gae.datastore import utils as datastore_utils
 from upvote.gae.datastore.models import binary as binary_models
 from upvote.gae.datastore.models import host as host_models
+from upvote.gae.datastore.models import package as package_models
 from upvote.gae.datastore.models import rule as rule_models
 from upvote.gae.datastore.models import user as user_models
 from upvote.gae.datastore.models import vote as vote_models
@@ -125,9 +128,10 @@ class IsVotingAllowedTest(basetest.UpvoteTestCase):
       allowed, reason = api.IsVotingAllowed(bundle.key)
       self.assertTrue(allowed)
 
-      # Now flag one of the binaries.
+      # Now flag one of the binaries, as voting would.
       blockables[0].flagged = True
       blockables[0].put()
+      api._UpdateBundleFlagCounts(blockables[0].key, False)
 
       allowed, reason = api.IsVotingAllowed(bundle.key)
       self.assertFalse(allowed)
@@ -167,6 +171,7 @@ class IsVotingAllowedTest(basetest.UpvoteTestCase):
 
       santa_certificate.flagged = True
       santa_certificate.put()
+      api._UpdateBundleFlagCounts(santa_certificate.key, True)
 
       allowed, reason = api.IsVotingAllowed(bundle.key)
       self.assertFalse(allowed)
@@ -240,6 +245,175 @@ class IsVotingAllowedTest(basetest.UpvoteTestCase):
       self.assertIsNone(reason)
 
 
+class VotingEligibilityTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(VotingEligibilityTest, self).setUp()
+    self.mock_compute = self.Patch(
+        api, '_GetBlockableProhibitedReasons',
+        wraps=api._GetBlockableProhibitedReasons)
+
+  def testCached(self):
+    blockable = test_utils.CreateSantaBlockable()
+
+    with self.LoggedInUser() as user:
+      self.assertTrue(api.IsVotingAllowed(blockable.key, current_user=user)[0])
+      self.assertTrue(api.IsVotingAllowed(blockable.key, current_user=user)[0])
+
+    self.assertEqual(1, self.mock_compute.call_count)
+
+  def testCached_SharedBetweenUsers(self):
+    blockable = test_utils.CreateBlockable(
+        state=constants.STATE.APPROVED_FOR_LOCAL_WHITELISTING)
+    self.assertIn(
+        blockable.state, constants.STATE.SET_VOTING_ALLOWED_ADMIN_ONLY)
+
+    user = test_utils.CreateUser()
+    admin = test_utils.CreateUser(admin=True)
+    untrusted = test_utils.CreateUser(roles=[USER_ROLE.UNTRUSTED_USER])
+
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.ADMIN_ONLY),
+        api.IsVotingAllowed(blockable.key, current_user=user))
+    self.assertEqual(
+        (True, None), api.IsVotingAllowed(blockable.key, current_user=admin))
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.INSUFFICIENT_PERMISSION),
+        api.IsVotingAllowed(blockable.key, current_user=untrusted))
+    self.assertEqual(1, self.mock_compute.call_count)
+
+  def testStateChange(self):
+    blockable = test_utils.CreateSantaBlockable()
+    user = test_utils.CreateUser()
+    self.assertTrue(api.IsVotingAllowed(blockable.key, current_user=user)[0])
+
+    blockable.ChangeState(constants.STATE.BANNED)
+
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.PROHIBITED_STATE),
+        api.IsVotingAllowed(blockable.key, current_user=user))
+    self.assertEqual(2, self.mock_compute.call_count)
+
+  def testCertChange(self):
+    cert = test_utils.CreateSantaCertificate()
+    blockable = test_utils.CreateSantaBlockable(cert_key=cert.key)
+    user = test_utils.CreateUser()
+    self.assertTrue(api.IsVotingAllowed(blockable.key, current_user=user)[0])
+
+    # The new Rule changes neither the binary nor the cert.
+    test_utils.CreateSantaRule(
+        cert.key, rule_type=constants.RULE_TYPE.CERTIFICATE,
+        policy=constants.RULE_POLICY.BLACKLIST)
+
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.BLACKLISTED_CERT),
+        api.IsVotingAllowed(blockable.key, current_user=user))
+    self.assertEqual(1, self.mock_compute.call_count)
+
+    admin = test_utils.CreateUser(admin=True)
+    self.assertEqual(
+        (True, None), api.IsVotingAllowed(blockable.key, current_user=admin))
+
+  def testInsufficientPermission_NotComputed(self):
+    blockable = test_utils.CreateSantaBlockable()
+    untrusted = test_utils.CreateUser(roles=[USER_ROLE.UNTRUSTED_USER])
+
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.INSUFFICIENT_PERMISSION),
+        api.IsVotingAllowed(blockable.key, current_user=untrusted))
+
+    self.mock_compute.assert_not_called()
+    self.assertIsNone(api._VotingEligibility.GetKey(blockable.key).get())
+
+  def testNotFound_BeforeInsufficientPermission(self):
+    invalid_key = ndb.Key(binary_models.SantaBlockable, '12345')
+    untrusted = test_utils.CreateUser(roles=[USER_ROLE.UNTRUSTED_USER])
+
+    with self.assertRaises(api.BlockableNotFoundError):
+      api.IsVotingAllowed(invalid_key, current_user=untrusted)
+
+  def testExpired(self):
+    blockable = test_utils.CreateSantaBlockable()
+    user = test_utils.CreateUser()
+    api.IsVotingAllowed(blockable.key, current_user=user)
+
+    eligibility = api._VotingEligibility.GetKey(blockable.key).get()
+    self.assertTrue(eligibility.IsCurrent(blockable))
+
+    eligibility.computed_dt -= api._ELIGIBILITY_MAX_AGE
+    self.assertFalse(eligibility.IsCurrent(blockable))
+
+  def testVote_FlaggedBundleBinary(self):
+    blockable = test_utils.CreateSantaBlockable()
+    bundle = test_utils.CreateSantaBundle(bundle_binaries=[blockable])
+    user = test_utils.CreateUser()
+    self.assertTrue(api.IsVotingAllowed(bundle.key, current_user=user)[0])
+
+    api.Vote(user, blockable.key.id(), False, 1)
+    self.DrainTaskQueue(constants.TASK_QUEUE.DEFAULT)
+
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.FLAGGED_BINARY),
+        api.IsVotingAllowed(bundle.key, current_user=user))
+
+  def testVote_FlaggedBundleBinary_Counted(self):
+    blockable = test_utils.CreateSantaBlockable()
+    bundle = test_utils.CreateSantaBundle(bundle_binaries=[blockable])
+    package_models.SantaBundle.UpdateFlagCounts(bundle.key)
+    user = test_utils.CreateUser()
+
+    # The bundle is recounted by a task enqueued with the vote.
+    api.Vote(user, blockable.key.id(), False, 1)
+    self.assertEqual(0, bundle.key.get().flagged_binary_count)
+    self.assertTaskCount(constants.TASK_QUEUE.DEFAULT, 1)
+    self.DrainTaskQueue(constants.TASK_QUEUE.DEFAULT)
+    self.assertEqual(1, bundle.key.get().flagged_binary_count)
+
+    mock_count = self.Patch(
+        package_models.SantaBundle, '_CountFlaggedBinaries')
+    self.assertEqual(
+        (False, VOTING_PROHIBITED_REASONS.FLAGGED_BINARY),
+        api.IsVotingAllowed(bundle.key, current_user=user))
+    mock_count.assert_not_called()
+
+    # An unflagging upvote should clear the count again.
+    api.Vote(test_utils.CreateUser(admin=True), blockable.key.id(), True, 1)
+    self.DrainTaskQueue(constants.TASK_QUEUE.DEFAULT)
+    self.assertEqual(0, bundle.key.get().flagged_binary_count)
+
+  def testVote_FlaggedBundleBinary_ConcurrentDownvotes(self):
+    blockable = test_utils.CreateSantaBlockable()
+    bundle = test_utils.CreateSantaBundle(bundle_binaries=[blockable])
+    package_models.SantaBundle.UpdateFlagCounts(bundle.key)
+    stale_blockable = blockable.key.get(use_cache=False)
+
+    api.Vote(test_utils.CreateUser(), blockable.key.id(), False, 1)
+    self.DrainTaskQueue(constants.TASK_QUEUE.DEFAULT)
+
+    # The second downvote reads the blockable from before the first one
+    # outside of its transaction, so only the transaction sees it as flagged.
+    get_blockable = api._GetBlockable
+    self.Patch(
+        api, '_GetBlockable',
+        side_effect=lambda sha256: (
+            get_blockable(sha256) if ndb.in_transaction() else
+            stale_blockable))
+    api.Vote(test_utils.CreateUser(), blockable.key.id(), False, 1)
+
+    # Only the vote which flagged the binary should recount the bundle.
+    self.assertTaskCount(constants.TASK_QUEUE.DEFAULT, 0)
+    self.assertEqual(1, bundle.key.get().flagged_binary_count)
+
+  def testInTransaction_NotCached(self):
+    blockable = test_utils.CreateSantaBlockable()
+    user = test_utils.CreateUser()
+
+    ndb.transaction(
+        lambda: api.IsVotingAllowed(blockable.key, current_user=user))
+
+    self.assertIsNone(api._VotingEligibility.GetKey(blockable.key).get())
+
+
 class VoteTest(basetest.UpvoteTestCase):
 
   def testInvalidVoteWeightError(self):
@@ -250,6 +424,73 @@ class VoteTest(basetest.UpvoteTestCase):
         api.Vote(user, sha256, True, -1)
 
 
+class BatchVoteTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(BatchVoteTest, self).setUp()
+    self.user = test_utils.CreateUser()
+
+  def testSuccess(self):
+    santa_blockable = test_utils.CreateSantaBlockable()
+    bit9_binary = test_utils.CreateBit9Binary()
+
+    results = api.BatchVote(
+        self.user,
+        [(santa_blockable.key.id(), True), (bit9_binary.key.id(), False)], 1)
+
+    self.assertEqual(
+        [santa_blockable.key.id(), bit9_binary.key.id()],
+        [result.sha256 for result in results])
+    self.assertEqual([None, None], [result.error for result in results])
+    self.assertTrue(results[0].vote.was_yes_vote)
+    self.assertFalse(results[1].vote.was_yes_vote)
+    self.assertEqual(1, santa_blockable.key.get().score)
+    self.assertEqual(-1, bit9_binary.key.get().score)
+
+  def testPartialFailure(self):
+    santa_blockable = test_utils.CreateSantaBlockable()
+    banned_blockable = test_utils.CreateSantaBlockable(
+        state=constants.STATE.BANNED)
+    unknown_sha256 = test_utils.RandomSHA256()
+    unsupported_blockable = test_utils.CreateBlockable()
+
+    results = api.BatchVote(
+        self.user, [
+            (santa_blockable.key.id(), True),
+            (banned_blockable.key.id(), True),
+            (unknown_sha256, True),
+            (unsupported_blockable.key.id(), True),
+            (santa_blockable.key.id(), False)], 1)
+
+    self.assertIsNone(results[0].error)
+    self.assertIsInstance(results[1].error, api.OperationNotAllowedError)
+    self.assertIsInstance(results[2].error, api.BlockableNotFoundError)
+    self.assertIsInstance(results[3].error, api.UnsupportedClientError)
+    self.assertIsInstance(results[4].error, api.DuplicateVoteError)
+
+    # Only the first vote should have been cast.
+    self.assertEntityCount(vote_models.Vote, 1)
+    self.assertEqual(1, santa_blockable.key.get().score)
+
+  def testUnexpectedError(self):
+    santa_blockable = test_utils.CreateSantaBlockable()
+    self.Patch(api.SantaBallotBox, 'Vote', side_effect=RuntimeError)
+
+    results = api.BatchVote(self.user, [(santa_blockable.key.id(), True)], 1)
+
+    self.assertIsInstance(results[0].error, RuntimeError)
+
+  def testInvalidVoteWeightError(self):
+    with self.assertRaises(api.InvalidVoteWeightError):
+      api.BatchVote(self.user, [], -1)
+
+  def testTooManyVotes(self):
+    self.Patch(api, 'MAX_BATCH_VOTES', 1)
+    votes = [(test_utils.RandomSHA256(), True) for _ in xrange(2)]
+    with self.assertRaises(ValueError):
+      api.BatchVote(self.user, votes, 1)
+
+
 class BallotBoxTest(basetest.UpvoteTestCase):
 
   def setUp(self):
@@ -278,6 +519,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     ballot_box = api.Bit9BallotBox(binary.key.id())
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user, vote_weight=self.local_threshold)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     self.assertTaskCount(constants.TASK_QUEUE.BIT9_COMMIT_CHANGE, 1)
 
@@ -300,6 +542,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
 
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user, vote_weight=self.local_threshold)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     # 1 VoteRow, 1 Binary Row for Score Change, 1 Binary Row for State Change
     self.assertBigQueryInsertions([
@@ -319,8 +562,9 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     ballot_box = api.Bit9BallotBox(binary.key.id())
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user, vote_weight=self.local_threshold)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
-    self.assertEqual(self.local_threshold, binary.score)
+    self.assertEqual(self.local_threshold, binary.key.get().score)
 
     rules = api._GetRulesForBlockable(binary)
     self.assertLen(rules, 1)
@@ -347,7 +591,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     with self.LoggedInUser() as user:
       ballot_box.Vote(True, user, vote_weight=self.local_threshold)
 
-    self.assertEqual(self.local_threshold, binary.score)
+    self.assertEqual(self.local_threshold, binary.key.get().score)
     self.assertLen(api._GetRulesForBlockable(binary), 0)
     self.assertEqual(0, rule_models.RuleChangeSet.query().count())
 
@@ -437,6 +681,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     ballot_box = api.SantaBallotBox(self.santa_blockable1.key.id())
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user, vote_weight=new_weight)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     blockable = self.santa_blockable1.key.get()
 
@@ -692,6 +937,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     for user in users:
       test_utils.CreateSantaHost(primary_user=user.nickname)
       ballot_box.Vote(True, user)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     self.assertEqual(
         self.santa_blockable1.key.get().state,
@@ -709,9 +955,10 @@ class BallotBoxTest(basetest.UpvoteTestCase):
 
     users = test_utils.CreateUsers(self.local_threshold)
     with mock.patch.object(
-        ballot_box, '_GetHostsToWhitelist', return_value={'a_host'}):
+        api.SantaBallotBox, '_GetHostsToWhitelist', return_value={'a_host'}):
       for user in users:
         ballot_box.Vote(True, user)
+        self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     # Verify that local whitelist rules were created for the bundle.
     rules = rule_models.SantaRule.query(ancestor=self.santa_bundle.key).fetch()
@@ -862,12 +1109,14 @@ class BallotBoxTest(basetest.UpvoteTestCase):
       with self.LoggedInUser(user=other_user):
         test_utils.CreateSantaHost(primary_user=other_user.nickname)
         ballot_box.Vote(True, other_user)
+        self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     self.assertLen(blockable.GetVotes(), self.local_threshold - 1)
     self.assertEqual(constants.STATE.UNTRUSTED, blockable.state)
 
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     self.assertLen(blockable.GetVotes(), self.local_threshold)
 
@@ -899,6 +1148,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
       with self.LoggedInUser(user=other_user):
         test_utils.CreateSantaHost(primary_user=other_user.nickname)
         ballot_box.Vote(True, other_user)
+        self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     blockable = blockable.key.get()
 
@@ -909,6 +1159,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
 
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     self.assertLen(blockable.GetVotes(), self.local_threshold + 1)
 
@@ -950,9 +1201,11 @@ class BallotBoxTest(basetest.UpvoteTestCase):
     for other_user in other_users:
       with self.LoggedInUser(user=other_user):
         ballot_box.Vote(True, other_user)
+        self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     with self.LoggedInUser(user=user):
       ballot_box.Vote(True, user)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     # Ensure a new rule was created for the existing user's host.
     self.assertEqual(rule_query.count(), len(hosts))
@@ -996,6 +1249,7 @@ class BallotBoxTest(basetest.UpvoteTestCase):
         test_utils.CreateSantaHost(primary_user=voter.nickname)
       with self.LoggedInUser(user=voter):
         ballot_box.Vote(True, voter)
+        self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
     blockable = blockable.key.get()
 
@@ -1019,6 +1273,45 @@ class BallotBoxTest(basetest.UpvoteTestCase):
         [TABLE.BINARY] * (num_voters + 1) +
         [TABLE.RULE] * expected_rule_count)
 
+  @mock.patch.object(api, '_LOCAL_WHITELIST_BATCH_SIZE', 2)
+  def testLocallyWhitelist_Batched(self):
+    blockable = test_utils.CreateSantaBlockable()
+    users = test_utils.CreateUsers(5)
+    for user in users:
+      test_utils.CreateSantaHost(primary_user=user.nickname)
+      test_utils.CreateVote(blockable, user_email=user.email)
+
+    ballot_box = api.SantaBallotBox(blockable.key.id())
+    ballot_box.blockable = blockable
+    blockable.ChangeState(constants.STATE.APPROVED_FOR_LOCAL_WHITELISTING)
+    ballot_box._DeferLocallyWhitelist()
+
+    # The vote itself shouldn't have created any rules.
+    self.assertEntityCount(rule_models.Rule, 0)
+
+    # The fan-out task should split the 5 voters into 3 batches.
+    self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING, limit=1)
+    self.assertTaskCount(constants.TASK_QUEUE.LOCAL_WHITELISTING, 3)
+
+    self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
+    rules = rule_models.Rule.query().fetch()
+    self.assertSameElements(
+        [user.key for user in users], [rule.user_key for rule in rules])
+
+    # Re-running a batch shouldn't create any duplicate rules.
+    api._LocallyWhitelistBatch(blockable.key.id(), [users[0].key.id()])
+    self.assertEntityCount(rule_models.Rule, len(users))
+
+  def testLocallyWhitelist_NoLongerApproved(self):
+    blockable = test_utils.CreateSantaBlockable()
+    user = test_utils.CreateUser()
+    test_utils.CreateSantaHost(primary_user=user.nickname)
+    test_utils.CreateVote(blockable, user_email=user.email)
+
+    api._LocallyWhitelistBatch(blockable.key.id(), [user.key.id()])
+
+    self.assertEntityCount(rule_models.Rule, 0)
+
   def testKeyStructure(self):
     ballot_box = api.SantaBallotBox(self.santa_blockable1.key.id())
 
@@ -1532,14 +1825,27 @@ class RecountTest(basetest.UpvoteTestCase):
   def testSuccess(self):
     """Check that if score is out of sync it actually gets recalculated."""
     santa_blockable = test_utils.CreateSantaBlockable()
-    santa_blockable.put()
     user = test_utils.CreateUser()
     test_utils.CreateVote(
         santa_blockable, user_email=user.email, was_yes_vote=True)
+    santa_blockable.score = 5
+    santa_blockable.put()
+
     api.Recount(santa_blockable.key.id())
+
     santa_blockable = santa_blockable.key.get()
     self.assertEqual(santa_blockable.score, 1)
 
+  def testScoreInSync(self):
+    santa_blockable = test_utils.CreateSantaBlockable()
+    test_utils.CreateVote(santa_blockable)
+
+    ballot_box = api.SantaBallotBox(santa_blockable.key.id())
+    ballot_box.blockable = santa_blockable
+
+    self.assertFalse(ballot_box._AuditBlockableScore())
+    self.assertEqual(1, santa_blockable.score)
+
 
 class ResetTest(basetest.UpvoteTestCase):
 
@@ -1563,6 +1869,7 @@ class ResetTest(basetest.UpvoteTestCase):
     api.Reset(blockable.key.id())
 
     self.assertEqual(constants.STATE.UNTRUSTED, blockable.key.get().state)
+    self.assertEqual(0, blockable.key.get().score)
 
     total_votes = vote_models.Vote.query()
     retrieved_rules = rule_models.Rule.query(ancestor=blockable.key)
@@ -1589,14 +1896,15 @@ class ResetTest(basetest.UpvoteTestCase):
 
     with self.LoggedInUser(user=user):
       api.Vote(user, binary.key.id(), True, self.local_threshold)
+      self.DrainTaskQueue(constants.TASK_QUEUE.LOCAL_WHITELISTING)
 
-    self.assertEqual(self.local_threshold, binary.score)
+    self.assertEqual(self.local_threshold, binary.key.get().score)
     self.assertEntityCount(rule_models.Bit9Rule, 1)
     self.assertEntityCount(rule_models.RuleChangeSet, 1)
 
     api.Reset(binary.key.id())
 
-    self.assertEqual(0, binary.score)
+    self.assertEqual(0, binary.key.get().score)
 
     self.assertEntityCount(rule_models.Bit9Rule, 2)
     self.assertEntityCount(rule_models.RuleChangeSet, 2)
@@ -1617,6 +1925,59 @@ class ResetTest(basetest.UpvoteTestCase):
     self.assertBigQueryInsertions(
         [TABLE.VOTE] + [TABLE.BINARY] * 3 + [TABLE.RULE] * 2)
 
+  @mock.patch.object(api, '_RESET_BATCH_SIZE', 2)
+  @mock.patch.object(api, '_RESET_INLINE_DURATION', datetime.timedelta(0))
+  @mock.patch.object(api, '_RESET_TASK_DURATION', datetime.timedelta(0))
+  def testBatched(self):
+    binary = test_utils.CreateBit9Binary(flagged=True)
+    test_utils.CreateVotes(binary, 5)
+    for host_id in ('1', '1', '2'):
+      test_utils.CreateBit9Rule(
+          binary.key, host_id=host_id, policy=constants.RULE_POLICY.WHITELIST)
+
+    api.Reset(binary.key.id())
+
+    # Only the first batch should have been run.
+    self.assertEqual(constants.STATE.RESETTING, binary.key.get().state)
+    self.assertLen(binary.GetVotes(), 3)
+    self.assertTaskCount(constants.TASK_QUEUE.BLOCKABLE_RESET, 1)
+
+    # Voting and recounting should be held off until the reset is done.
+    with self.assertRaises(api.OperationNotAllowedError):
+      api.Vote(test_utils.CreateUser(), binary.key.id(), True, 1)
+    self.assertIsNone(api.Recount(binary.key.id()))
+
+    self.DrainTaskQueue(constants.TASK_QUEUE.BLOCKABLE_RESET)
+
+    binary = binary.key.get()
+    self.assertEqual(constants.STATE.UNTRUSTED, binary.state)
+    self.assertEqual(0, binary.score)
+    self.assertFalse(binary.flagged)
+    self.assertLen(binary.GetVotes(), 0)
+    self.assertEntityCount(vote_models.Vote, 5)
+    self.assertEntityCount(api._ResetProgress, 0)
+
+    # Only a single removal rule should be created per host.
+    rules = api._GetRulesForBlockable(binary)
+    self.assertSameElements(['1', '2'], [rule.host_id for rule in rules])
+    self.assertSetEqual(
+        {constants.RULE_POLICY.REMOVE}, {rule.policy for rule in rules})
+
+  def testResume(self):
+    blockable = test_utils.CreateSantaBlockable()
+    test_utils.CreateVotes(blockable, 3)
+
+    # Leave the reset hanging after the blockable enters the RESETTING state.
+    with mock.patch.object(api.SantaBallotBox, '_ContinueReset'):
+      api.Reset(blockable.key.id())
+    self.assertEqual(constants.STATE.RESETTING, blockable.key.get().state)
+
+    api.Reset(blockable.key.id())
+
+    self.assertEqual(constants.STATE.UNTRUSTED, blockable.key.get().state)
+    self.assertLen(blockable.GetVotes(), 0)
+    self.assertEntityCount(api._ResetProgress, 0)
+
 
 if __name__ == '__main__':
   basetest.main()
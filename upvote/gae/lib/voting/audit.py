@@ -0,0 +1,302 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fleet-wide auditing of blockable voting state.
+
+An audit runs the same checks as api.Recount() (score, flag, state and rule
+auditing) over every Blockable, e.g. after a change to VOTING_THRESHOLDS. The
+Blockable key space is split into ranges of SHA256 prefixes, each of which is
+walked by its own chain of tasks using a query cursor. Every shard checkpoints
+its cursor alongside the changes found in each page, so a failed or expired
+task resumes where the last one left off.
+"""
+
+import datetime
+import logging
+
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from upvote.gae.datastore.models import binary as binary_models
+from upvote.gae.lib.voting import api
+from upvote.gae.lib.voting import monitoring
+from upvote.gae.utils import time_utils
+from upvote.shared import constants
+
+
+# The default number of shards to split the Blockable key space into.
+_DEFAULT_SHARD_COUNT = 16
+
+# The number of Blockables audited between checkpoints.
+_PAGE_SIZE = 50
+
+# The amount of time a shard task runs for before handing off to a new one.
+_TASK_DURATION = datetime.timedelta(minutes=9)
+
+# The maximum number of changes included in a report.
+_MAX_REPORTED_CHANGES = 1000
+
+
+class _AuditRun(ndb.Model):
+  """A single fleet-wide audit.
+
+  Attributes:
+    shard_count: int, The number of shards the audit was split into.
+    started_dt: datetime, When the audit was started.
+    completed_dt: datetime, When the last shard finished, if it has.
+  """
+  shard_count = ndb.IntegerProperty()
+  started_dt = ndb.DateTimeProperty(auto_now_add=True)
+  completed_dt = ndb.DateTimeProperty()
+
+
+class _AuditShard(ndb.Model):
+  """The progress of a single shard of an audit.
+
+  key = Key(_AuditRun, run_id) -> Key(_AuditShard, shard_index)
+
+  Attributes:
+    lower_bound: str, The inclusive lower Blockable ID bound, if any.
+    upper_bound: str, The exclusive upper Blockable ID bound, if any.
+    cursor: str, The urlsafe query cursor of the last checkpoint.
+    audited_count: int, The number of Blockables audited.
+    changed_count: int, The number of Blockables changed by the audit.
+    skipped_count: int, The number of Blockables with an unsupported client.
+    error_count: int, The number of Blockables that failed to be audited.
+    done: bool, Whether the entire range has been audited.
+    updated_dt: datetime, The time of the last checkpoint.
+  """
+  lower_bound = ndb.StringProperty(indexed=False)
+  upper_bound = ndb.StringProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  audited_count = ndb.IntegerProperty(default=0, indexed=False)
+  changed_count = ndb.IntegerProperty(default=0, indexed=False)
+  skipped_count = ndb.IntegerProperty(default=0, indexed=False)
+  error_count = ndb.IntegerProperty(default=0, indexed=False)
+  done = ndb.BooleanProperty(default=False)
+  updated_dt = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class _AuditChange(ndb.Model):
+  """A Blockable that was changed by an audit.
+
+  Keyed by Blockable ID under the run so that retried pages don't produce
+  duplicate entries.
+
+  key = Key(_AuditRun, run_id) -> Key(_AuditChange, blockable_id)
+  """
+  old_score = ndb.IntegerProperty(indexed=False)
+  new_score = ndb.IntegerProperty(indexed=False)
+  old_state = ndb.StringProperty(indexed=False)
+  new_state = ndb.StringProperty(indexed=False)
+  old_flagged = ndb.BooleanProperty(indexed=False)
+  new_flagged = ndb.BooleanProperty(indexed=False)
+  recorded_dt = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+  def ToDict(self):
+    return {
+        'blockable_id': self.key.id(),
+        'score': [self.old_score, self.new_score],
+        'state': [self.old_state, self.new_state],
+        'flagged': [self.old_flagged, self.new_flagged]}
+
+
+def _GetShardBounds(shard_count):
+  """Splits the SHA256 key space into shard_count contiguous ranges.
+
+  Args:
+    shard_count: int, The number of ranges, between 1 and 256.
+
+  Returns:
+    A list of (lower, upper) ID bound tuples. The first lower bound and the
+    last upper bound are None so that IDs sorting outside of the hex range are
+    still covered.
+  """
+  prefixes = [None] + [
+      '%02x' % (i * 256 // shard_count) for i in xrange(1, shard_count)]
+  return zip(prefixes, prefixes[1:] + [None])
+
+
+def Start(shard_count=None):
+  """Starts auditing all Blockables.
+
+  Args:
+    shard_count: int, The number of shards to audit in parallel. Defaults to
+        _DEFAULT_SHARD_COUNT.
+
+  Returns:
+    The ID of the new audit.
+
+  Raises:
+    ValueError: if shard_count is out of range.
+  """
+  shard_count = shard_count or _DEFAULT_SHARD_COUNT
+  if not 1 <= shard_count <= 256:
+    raise ValueError('Invalid shard count: %s' % shard_count)
+
+  run_key = _AuditRun(shard_count=shard_count).put()
+  shards = [
+      _AuditShard(
+          parent=run_key, id=index + 1, lower_bound=lower, upper_bound=upper)
+      for index, (lower, upper) in enumerate(_GetShardBounds(shard_count))]
+  ndb.put_multi(shards)
+
+  for shard in shards:
+    _DeferShard(shard.key)
+
+  logging.info(
+      'Started audit %s with %d shard(s)', run_key.id(), shard_count)
+  return run_key.id()
+
+
+def _DeferShard(shard_key):
+  deferred.defer(
+      _AuditShardRange, shard_key.parent().id(), shard_key.id(),
+      _queue=constants.TASK_QUEUE.VOTING_AUDIT)
+
+
+def _AuditBlockable(run_key, blockable):
+  """Recounts a single Blockable.
+
+  Args:
+    run_key: Key, The key of the _AuditRun.
+    blockable: Blockable, The entity as it was before the audit.
+
+  Returns:
+    An unsaved _AuditChange if the Blockable was changed, otherwise None.
+  """
+  updated = api.Recount(blockable.key.id())
+  if updated is None:
+    return None
+  return _AuditChange(
+      parent=run_key, id=blockable.key.id(),
+      old_score=blockable.score, new_score=updated.score,
+      old_state=blockable.state, new_state=updated.state,
+      old_flagged=blockable.flagged, new_flagged=updated.flagged)
+
+
+def _AuditShardRange(run_id, shard_index):
+  """Audits the Blockables in a shard's range, resuming from its checkpoint."""
+  run_key = ndb.Key(_AuditRun, run_id)
+  shard = ndb.Key(_AuditShard, shard_index, parent=run_key).get()
+  if shard is None or shard.done:
+    return
+
+  query = binary_models.Blockable.query()
+  if shard.lower_bound is not None:
+    query = query.filter(
+        binary_models.Blockable.key >= ndb.Key(
+            binary_models.Blockable, shard.lower_bound))
+  if shard.upper_bound is not None:
+    query = query.filter(
+        binary_models.Blockable.key < ndb.Key(
+            binary_models.Blockable, shard.upper_bound))
+  query = query.order(binary_models.Blockable.key)
+
+  cursor = (
+      datastore_query.Cursor(urlsafe=shard.cursor) if shard.cursor else None)
+  start_time = time_utils.Now()
+
+  # Always make progress on at least one page, even if the task started late.
+  while True:
+    blockables, cursor, more = query.fetch_page(
+        _PAGE_SIZE, start_cursor=cursor)
+
+    changes = []
+    for blockable in blockables:
+      try:
+        change = _AuditBlockable(run_key, blockable)
+      except api.UnsupportedClientError:
+        shard.skipped_count += 1
+        continue
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Failed to audit %s', blockable.key.id())
+        shard.error_count += 1
+        continue
+      if change is not None:
+        changes.append(change)
+
+    # Checkpoint the shard along with the changes found in this page.
+    shard.audited_count += len(blockables)
+    shard.changed_count += len(changes)
+    shard.cursor = cursor.urlsafe() if cursor else None
+    shard.done = not more
+    ndb.put_multi(changes + [shard])
+
+    monitoring.blockables_audited.IncrementBy(len(blockables))
+    monitoring.blockables_repaired.IncrementBy(len(changes))
+
+    if shard.done or not time_utils.TimeRemains(start_time, _TASK_DURATION):
+      break
+
+  logging.info(
+      'Audit %s shard %s: %d audited, %d changed', run_id, shard_index,
+      shard.audited_count, shard.changed_count)
+
+  if shard.done:
+    _MaybeCompleteRun(run_key)
+  else:
+    _DeferShard(shard.key)
+
+
+@ndb.transactional
+def _MaybeCompleteRun(run_key):
+  run = run_key.get()
+  if run.completed_dt is not None:
+    return
+  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+  incomplete = _AuditShard.query(
+      _AuditShard.done == False, ancestor=run_key).get(keys_only=True)
+  # pylint: enable=g-explicit-bool-comparison, singleton-comparison
+  if incomplete is None:
+    run.completed_dt = time_utils.Now()
+    run.put()
+    logging.info('Audit %s complete', run_key.id())
+
+
+def GetReport(run_id):
+  """Summarizes the progress and findings of an audit.
+
+  Args:
+    run_id: int, The ID returned by Start().
+
+  Returns:
+    A dict describing the audit, or None if no such audit exists.
+  """
+  run_key = ndb.Key(_AuditRun, run_id)
+  run = run_key.get()
+  if run is None:
+    return None
+
+  shards = _AuditShard.query(ancestor=run_key).fetch()
+  changes = _AuditChange.query(ancestor=run_key).fetch(_MAX_REPORTED_CHANGES)
+
+  audited_count = sum(shard.audited_count for shard in shards)
+  end_dt = run.completed_dt or time_utils.Now()
+  elapsed = (end_dt - run.started_dt).total_seconds()
+
+  return {
+      'id': run_id,
+      'started_dt': run.started_dt,
+      'completed_dt': run.completed_dt,
+      'shard_count': run.shard_count,
+      'shards_done': sum(1 for shard in shards if shard.done),
+      'audited_count': audited_count,
+      'changed_count': sum(shard.changed_count for shard in shards),
+      'skipped_count': sum(shard.skipped_count for shard in shards),
+      'error_count': sum(shard.error_count for shard in shards),
+      'blockables_per_second': audited_count / elapsed if elapsed else 0.0,
+      'changes': [change.ToDict() for change in changes],
+  }
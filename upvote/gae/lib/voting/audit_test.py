@@ -0,0 +1,107 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for audit.py."""
+
+import datetime
+
+import mock
+
+from upvote.gae.datastore import test_utils
+from upvote.gae.lib.testing import basetest
+from upvote.gae.lib.voting import audit
+from upvote.shared import constants
+
+
+class GetShardBoundsTest(basetest.UpvoteTestCase):
+
+  def testSingleShard(self):
+    self.assertListEqual([(None, None)], audit._GetShardBounds(1))
+
+  def testMultipleShards(self):
+    self.assertListEqual(
+        [(None, '40'), ('40', '80'), ('80', 'c0'), ('c0', None)],
+        audit._GetShardBounds(4))
+
+
+class AuditTest(basetest.UpvoteTestCase):
+
+  def _RunAudit(self, **kwargs):
+    audit_id = audit.Start(**kwargs)
+    self.DrainTaskQueue(constants.TASK_QUEUE.VOTING_AUDIT)
+    return audit.GetReport(audit_id)
+
+  def testInvalidShardCount(self):
+    with self.assertRaises(ValueError):
+      audit.Start(shard_count=257)
+
+  def testSuccess(self):
+    # Spread the blockables across every shard.
+    blockables = [
+        test_utils.CreateSantaBlockable(id=prefix + test_utils.RandomSHA256()[2:])
+        for prefix in ('00', '3f', '40', 'ff')]
+    test_utils.CreateVote(blockables[0])
+    test_utils.CreateVote(blockables[3])
+
+    # Let the score of one blockable drift.
+    blockables[3].score = 10
+    blockables[3].put()
+
+    report = self._RunAudit(shard_count=4)
+
+    self.assertEqual(4, report['shards_done'])
+    self.assertIsNotNone(report['completed_dt'])
+    self.assertEqual(4, report['audited_count'])
+    self.assertEqual(1, report['changed_count'])
+    self.assertListEqual(
+        [{
+            'blockable_id': blockables[3].key.id(),
+            'score': [10, 1],
+            'state': [constants.STATE.UNTRUSTED, constants.STATE.UNTRUSTED],
+            'flagged': [False, False],
+        }],
+        report['changes'])
+    self.assertEqual(1, blockables[3].key.get().score)
+
+  def testUnsupportedClient(self):
+    test_utils.CreateBlockable()
+
+    report = self._RunAudit(shard_count=1)
+
+    self.assertEqual(1, report['skipped_count'])
+    self.assertEqual(0, report['changed_count'])
+
+  @mock.patch.object(audit, '_PAGE_SIZE', 1)
+  @mock.patch.object(audit, '_TASK_DURATION', datetime.timedelta(0))
+  def testCheckpointing(self):
+    test_utils.CreateSantaBlockables(3)
+
+    audit_id = audit.Start(shard_count=1)
+
+    # Each task should only get through a single page before handing off.
+    self.DrainTaskQueue(constants.TASK_QUEUE.VOTING_AUDIT, limit=1)
+    self.assertEqual(1, audit.GetReport(audit_id)['audited_count'])
+    self.assertTaskCount(constants.TASK_QUEUE.VOTING_AUDIT, 1)
+
+    self.DrainTaskQueue(constants.TASK_QUEUE.VOTING_AUDIT)
+    report = audit.GetReport(audit_id)
+    self.assertEqual(3, report['audited_count'])
+    self.assertIsNotNone(report['completed_dt'])
+
+  def testGetReport_NotFound(self):
+    self.assertIsNone(audit.GetReport(12345))
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -0,0 +1,281 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queued voting for Blockables under heavy voting load.
+
+Every vote cast through api.Vote() is resolved in a transaction on the
+Blockable's entity group, so hundreds of users voting on the same Blockable
+within minutes contend with one another. QueueVote() instead records each vote
+as a _PendingVote, sharded across entity groups by user, and leaves applier
+tasks to fold them into the Blockable through the regular BallotBox.
+
+Applier tasks are named after the Blockable and a short time window, so a burst
+of votes is applied by one task per window. A vote which could move the
+Blockable across a voting threshold is applied right away instead. Either way,
+appliers hold a lock on the Blockable, so its votes are applied serially.
+"""
+
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from common import datastore_locks
+
+from upvote.gae import settings
+from upvote.gae.datastore.models import user as user_models
+from upvote.gae.datastore.models import vote as vote_models
+from upvote.gae.lib.voting import api
+from upvote.shared import constants
+
+
+# The number of entity groups the pending votes of a Blockable are spread over.
+_SHARD_COUNT = 16
+
+# The window, in seconds, over which pending votes are coalesced into a single
+# applier task.
+_APPLY_INTERVAL = 5
+
+# The maximum number of pending votes applied by a single task.
+_APPLY_BATCH_SIZE = 100
+
+# The applier lock is held for just over the 10 minute task deadline, so that
+# it isn't released while a task is still running. A task which can't acquire
+# it is retried.
+_APPLY_LOCK_TIMEOUT = int(
+    datetime.timedelta(minutes=10, seconds=30).total_seconds())
+_APPLY_LOCK_MAX_ACQUIRE_ATTEMPTS = 5
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class ApplyError(Error):
+  """Raised when some pending votes could not be applied."""
+
+
+class _PendingVoteShard(ndb.Model):
+  """The parent of a shard of pending votes. Never actually stored.
+
+  key = Key(_PendingVoteShard, '<blockable_id>/<shard_index>')
+  """
+
+
+class _PendingVote(ndb.Model):
+  """A vote which has been accepted but not yet applied to its Blockable.
+
+  Each user has at most one pending vote per Blockable, so a later vote
+  replaces an earlier one which hasn't been applied yet.
+
+  key = Key(_PendingVoteShard, ...) -> Key(_PendingVote, user_email)
+
+  Attributes:
+    blockable_id: str, The ID of the Blockable being voted on.
+    user_email: str, The email of the voter.
+    was_yes_vote: bool, Whether the vote was a 'yes' vote.
+    weight: int, The weight with which the vote is cast.
+    recorded_dt: datetime, When the vote was cast.
+  """
+  blockable_id = ndb.StringProperty(indexed=False)
+  user_email = ndb.StringProperty(indexed=False)
+  was_yes_vote = ndb.BooleanProperty(indexed=False)
+  weight = ndb.IntegerProperty(indexed=False)
+  recorded_dt = ndb.DateTimeProperty()
+
+  @classmethod
+  def GetKey(cls, blockable_id, user_email):
+    return ndb.Key(cls, user_email, parent=_GetShardKey(
+        blockable_id, _GetShardIndex(user_email)))
+
+
+def _GetShardIndex(user_email):
+  digest = hashlib.md5(user_email.encode('utf-8')).hexdigest()
+  return int(digest, 16) % _SHARD_COUNT
+
+
+def _GetShardKey(blockable_id, shard_index):
+  return ndb.Key(_PendingVoteShard, '%s/%d' % (blockable_id, shard_index))
+
+
+def _CrossesThreshold(old_score, new_score):
+  """Returns whether a change in score could change a Blockable's state."""
+  if old_score == new_score:
+    return False
+  low, high = min(old_score, new_score), max(old_score, new_score)
+  return any(
+      low <= threshold <= high
+      for threshold in settings.VOTING_THRESHOLDS.itervalues())
+
+
+def QueueVote(user, sha256, upvote, weight):
+  """Accepts a vote for the specified Blockable, to be applied asynchronously.
+
+  The checks which can be made without touching the Blockable's entity group
+  are made up front, so that the common failures are still reported to the
+  voter. Those that can't are repeated when the vote is applied, and a vote
+  which fails them then is logged and dropped.
+
+  Args:
+    user: User entity representing the person casting the vote.
+    sha256: The SHA256 of the Blockable being voted on.
+    upvote: bool, whether the vote was a 'yes' vote.
+    weight: int, The weight with which the vote will be cast. The weight must
+        be >= 0 (UNTRUSTED_USERs have vote weight 0).
+
+  Returns:
+    The newly-created _PendingVote entity.
+
+  Raises:
+    BlockableNotFoundError: if the target blockable ID is not a known Blockable.
+    UnsupportedClientError: if the specified Blockable came from an unsupported
+        client.
+    InvalidVoteWeightError: if the vote weight is less than zero.
+    DuplicateVoteError: if the user has already cast the same vote.
+    OperationNotAllowedError: if the user may not vote on the Blockable.
+  """
+  blockable = api._GetBlockable(sha256)  # pylint: disable=protected-access
+  api._GetClient(blockable)  # pylint: disable=protected-access
+  if weight < 0:
+    raise api.InvalidVoteWeightError(weight)
+
+  allowed, reason = api.IsVotingAllowed(blockable.key, current_user=user)
+  if not allowed:
+    raise api.OperationNotAllowedError('Voting is not allowed (%s)' % reason)
+
+  existing_vote = vote_models.Vote.GetKey(blockable.key, user.key).get()
+  if existing_vote is not None and existing_vote.was_yes_vote == upvote:
+    raise api.DuplicateVoteError(
+        'The user %s has already cast a %s vote for blockable %s' % (
+            user.email, upvote, sha256))
+
+  pending_vote = _PendingVote(
+      key=_PendingVote.GetKey(blockable.key.id(), user.email),
+      blockable_id=blockable.key.id(), user_email=user.email,
+      was_yes_vote=upvote, weight=weight,
+      recorded_dt=datetime.datetime.utcnow())
+  pending_vote.put()
+
+  # Project the score as if this were the only pending vote, and apply it right
+  # away if that could change the state of the Blockable.
+  new_score = blockable.score + (weight if upvote else -weight)
+  if existing_vote is not None:
+    new_score -= existing_vote.effective_weight
+  _ScheduleApply(
+      blockable.key.id(),
+      immediately=_CrossesThreshold(blockable.score, new_score))
+
+  return pending_vote
+
+
+def _ScheduleApply(blockable_id, immediately=False):
+  """Ensures an applier task is scheduled for a Blockable.
+
+  Args:
+    blockable_id: str, The ID of the Blockable.
+    immediately: bool, Whether to apply pending votes now rather than at the
+        end of the current window.
+  """
+  if immediately:
+    deferred.defer(
+        _ApplyPendingVotes, blockable_id,
+        _queue=constants.TASK_QUEUE.VOTE_APPLY)
+    return
+
+  window = int(time.time()) // _APPLY_INTERVAL
+  task_name = 'apply-%s-%d' % (blockable_id, window)
+  try:
+    deferred.defer(
+        _ApplyPendingVotes, blockable_id, _name=task_name,
+        _countdown=_APPLY_INTERVAL, _queue=constants.TASK_QUEUE.VOTE_APPLY)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _GetPendingVotes(blockable_id):
+  """Returns the oldest pending votes for a Blockable across all shards."""
+  futures = [
+      _PendingVote.query(ancestor=_GetShardKey(blockable_id, index)).order(
+          _PendingVote.recorded_dt).fetch_async(_APPLY_BATCH_SIZE)
+      for index in xrange(_SHARD_COUNT)]
+  pending_votes = [
+      pending_vote for future in futures for pending_vote in future.get_result()]
+  pending_votes.sort(key=lambda pending_vote: pending_vote.recorded_dt)
+  return pending_votes[:_APPLY_BATCH_SIZE]
+
+
+@ndb.transactional
+def _DeletePendingVote(pending_vote):
+  # If the user voted again in the meantime, leave the newer vote for the next
+  # pass of the applier.
+  current = pending_vote.key.get()
+  if current is not None and current.recorded_dt == pending_vote.recorded_dt:
+    current.key.delete()
+
+
+def _ApplyPendingVotes(blockable_id):
+  """Applies the pending votes of a Blockable, oldest first.
+
+  Args:
+    blockable_id: str, The ID of the Blockable.
+
+  Raises:
+    ApplyError: if any pending votes failed to be applied, so that the task is
+        retried.
+    datastore_locks.AcquireLockError: if another task is applying votes to the
+        Blockable, so that the task is retried once it's done.
+  """
+  with datastore_locks.DatastoreLock(
+      'vote-apply-%s' % blockable_id, default_timeout=_APPLY_LOCK_TIMEOUT,
+      default_max_acquire_attempts=_APPLY_LOCK_MAX_ACQUIRE_ATTEMPTS):
+    pending_votes = _GetPendingVotes(blockable_id)
+    failure_count = 0
+
+    for pending_vote in pending_votes:
+      user = user_models.User.GetById(pending_vote.user_email)
+      try:
+        if user is None:
+          raise api.OperationNotAllowedError(
+              'Unknown user: %s' % pending_vote.user_email)
+        api.Vote(
+            user, blockable_id, pending_vote.was_yes_vote, pending_vote.weight)
+      except api.Error as e:
+        # These won't succeed on a retry, e.g. the Blockable is no longer in a
+        # state which can be voted on.
+        logging.warning(
+            'Dropping vote by %s for %s: %s', pending_vote.user_email,
+            blockable_id, e)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception(
+            'Failed to apply vote by %s for %s', pending_vote.user_email,
+            blockable_id)
+        failure_count += 1
+        continue
+      _DeletePendingVote(pending_vote)
+
+  logging.info(
+      'Applied %d of %d pending vote(s) for %s',
+      len(pending_votes) - failure_count, len(pending_votes), blockable_id)
+
+  if failure_count:
+    raise ApplyError(
+        '%d vote(s) for %s failed to apply' % (failure_count, blockable_id))
+
+  # Keep going if this pass didn't get through all of them.
+  if len(pending_votes) == _APPLY_BATCH_SIZE:
+    _ScheduleApply(blockable_id, immediately=True)
@@ -0,0 +1,179 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for ingestion.py."""
+
+import mock
+
+from common import datastore_locks
+
+from upvote.gae.datastore import test_utils
+from upvote.gae.datastore.models import vote as vote_models
+from upvote.gae.lib.testing import basetest
+from upvote.gae.lib.voting import api
+from upvote.gae.lib.voting import ingestion
+from upvote.shared import constants
+
+
+# Keep every vote in a test within the same applier window.
+@mock.patch.object(ingestion, '_APPLY_INTERVAL', 10 ** 9)
+class QueueVoteTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(QueueVoteTest, self).setUp()
+    self.blockable = test_utils.CreateSantaBlockable()
+    self.user = test_utils.CreateUser()
+
+  def _Apply(self):
+    self.DrainTaskQueue(constants.TASK_QUEUE.VOTE_APPLY)
+
+  def testQueueVote(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+
+    self.assertEntityCount(ingestion._PendingVote, 1)
+    self.assertEntityCount(vote_models.Vote, 0)
+    self.assertEqual(0, self.blockable.key.get().score)
+
+    self._Apply()
+
+    self.assertEntityCount(ingestion._PendingVote, 0)
+    self.assertEntityCount(vote_models.Vote, 1)
+    self.assertEqual(1, self.blockable.key.get().score)
+
+  def testQueueVote_Coalesced(self):
+    for user in test_utils.CreateUsers(3):
+      ingestion.QueueVote(user, self.blockable.key.id(), True, 1)
+
+    self.assertEntityCount(ingestion._PendingVote, 3)
+    self.assertTaskCount(constants.TASK_QUEUE.VOTE_APPLY, 1)
+
+    self._Apply()
+
+    self.assertEntityCount(vote_models.Vote, 3)
+    self.assertEqual(3, self.blockable.key.get().score)
+
+  def testQueueVote_CrossesThreshold(self):
+    self.blockable.score = 4
+    self.blockable.put()
+    ingestion.QueueVote(test_utils.CreateUser(), self.blockable.key.id(), True, 1)
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+
+    # The windowed task and the immediate one.
+    self.assertTaskCount(constants.TASK_QUEUE.VOTE_APPLY, 2)
+
+  def testQueueVote_ChangedVote(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    ingestion.QueueVote(self.user, self.blockable.key.id(), False, 1)
+
+    # The later vote replaces the earlier one.
+    self.assertEntityCount(ingestion._PendingVote, 1)
+
+    self._Apply()
+
+    self.assertFalse(
+        vote_models.Vote.GetKey(self.blockable.key, self.user.key).get()
+        .was_yes_vote)
+    self.assertEqual(-1, self.blockable.key.get().score)
+
+  def testQueueVote_Duplicate(self):
+    api.Vote(self.user, self.blockable.key.id(), True, 1)
+
+    with self.assertRaises(api.DuplicateVoteError):
+      ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    self.assertEntityCount(ingestion._PendingVote, 0)
+
+  def testQueueVote_NotAllowed(self):
+    self.blockable.state = constants.STATE.BANNED
+    self.blockable.put()
+
+    with self.assertRaises(api.OperationNotAllowedError):
+      ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    self.assertEntityCount(ingestion._PendingVote, 0)
+
+  def testQueueVote_BlockableNotFound(self):
+    with self.assertRaises(api.BlockableNotFoundError):
+      ingestion.QueueVote(self.user, test_utils.RandomSHA256(), True, 1)
+
+  def testQueueVote_InvalidWeight(self):
+    with self.assertRaises(api.InvalidVoteWeightError):
+      ingestion.QueueVote(self.user, self.blockable.key.id(), True, -1)
+
+
+class ApplyPendingVotesTest(basetest.UpvoteTestCase):
+
+  def setUp(self):
+    super(ApplyPendingVotesTest, self).setUp()
+    self.blockable = test_utils.CreateSantaBlockable()
+    self.user = test_utils.CreateUser()
+
+  def testNoLongerAllowed(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    self.blockable.state = constants.STATE.BANNED
+    self.blockable.put()
+
+    ingestion._ApplyPendingVotes(self.blockable.key.id())
+
+    # The vote should be dropped rather than retried.
+    self.assertEntityCount(ingestion._PendingVote, 0)
+    self.assertEntityCount(vote_models.Vote, 0)
+
+  def testTransientFailure(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    self.Patch(api, 'Vote', side_effect=RuntimeError)
+
+    with self.assertRaises(ingestion.ApplyError):
+      ingestion._ApplyPendingVotes(self.blockable.key.id())
+    self.assertEntityCount(ingestion._PendingVote, 1)
+
+  def testNewerVoteKept(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    pending_vote = ingestion._PendingVote.query().get()
+    ingestion.QueueVote(self.user, self.blockable.key.id(), False, 1)
+
+    ingestion._DeletePendingVote(pending_vote)
+
+    self.assertFalse(ingestion._PendingVote.query().get().was_yes_vote)
+
+  def testLocked(self):
+    ingestion.QueueVote(self.user, self.blockable.key.id(), True, 1)
+    self.Patch(ingestion, '_APPLY_LOCK_MAX_ACQUIRE_ATTEMPTS', 1)
+
+    lock = datastore_locks.DatastoreLock(
+        'vote-apply-%s' % self.blockable.key.id())
+    lock.Acquire()
+    self.addCleanup(lock.Release)
+
+    # Another applier is running, so this one should be retried later.
+    with self.assertRaises(datastore_locks.AcquireLockError):
+      ingestion._ApplyPendingVotes(self.blockable.key.id())
+    self.assertEntityCount(ingestion._PendingVote, 1)
+
+  @mock.patch.object(ingestion, '_APPLY_BATCH_SIZE', 2)
+  def testFullBatch(self):
+    for user in test_utils.CreateUsers(3):
+      ingestion.QueueVote(user, self.blockable.key.id(), True, 1)
+
+    ingestion._ApplyPendingVotes(self.blockable.key.id())
+
+    self.assertEntityCount(ingestion._PendingVote, 1)
+    self.assertEqual(2, self.blockable.key.get().score)
+
+    self.DrainTaskQueue(constants.TASK_QUEUE.VOTE_APPLY)
+
+    self.assertEntityCount(ingestion._PendingVote, 0)
+    self.assertEqual(3, self.blockable.key.get().score)
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -0,0 +1,24 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Monitoring metrics for voting."""
+
+from upvote.gae.utils import monitoring_utils
+from upvote.monitoring import metrics
+
+
+blockables_audited = monitoring_utils.Counter(
+    metrics.VOTING.BLOCKABLES_AUDITED)
+blockables_repaired = monitoring_utils.Counter(
+    metrics.VOTING.BLOCKABLES_REPAIRED)
@@ -24,7 +24,9 @@ import zlib
 import webapp2
 from webapp2_extras import routes
 
+from google.appengine.api import datastore_errors
 from google.appengine.datastore import datastore_query
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from upvote.gae import settings
@@ -39,6 +41,7 @@ from upvote.gae.datastore.models import rule as rule_models
 from upvote.gae.datastore.models import user as user_models
 from upvote.gae.datastore.models import utils as model_utils
 from upvote.gae.lib.analysis import metrics
+from upvote.gae.lib.rules import host_index
 from upvote.gae.modules.upvote_app.api.santa import auth
 from upvote.gae.modules.upvote_app.api.santa import monitoring
 from upvote.gae.shared.common import big_red
@@ -79,6 +82,12 @@ _RULE_DOWNLOAD = constants.LowercaseNamespace([
     'SHA256', 'FILE_BUNDLE_HASH', 'FILE_BUNDLE_BINARY_COUNT',])
 
 
+# Rule download cursors for hosts with a rule index are prefixed, and hold the
+# position of the last rule sent along with a cursor into the global rules.
+# Unprefixed cursors belong to downloads which began before the index was built.
+_INDEXED_CURSOR_PREFIX = 'indexed:'
+
+
 # Keys that can appear in the postflight JSON payload.
 _POSTFLIGHT = constants.LowercaseNamespace(['BACKOFF'])
 
@@ -197,25 +206,35 @@ def _CopyLocalRules(user_key, dest_host_id):
   else:
     logging.info('Copying local rules from %s', src_host.key.id())
 
-  # Query for all SantaRules for the given user on the chosen host.
-  query = rule_models.SantaRule.query(
-      rule_models.SantaRule.host_id == src_host.key.id(),
-      rule_models.SantaRule.user_key == user_key)
+  # Look up the local rules in effect on the chosen host, falling back to a
+  # query for the user's SantaRules on it if the host hasn't been indexed yet.
+  entries = host_index.GetEntries(src_host.key.id())
+  if entries is None:
+    query = rule_models.SantaRule.query(
+        rule_models.SantaRule.host_id == src_host.key.id(),
+        rule_models.SantaRule.user_key == user_key,
+        rule_models.SantaRule.in_effect == True)  # pylint: disable=g-explicit-bool-comparison, singleton-comparison
+    src_rules = itertools.chain.from_iterable(datastore_utils.Paginate(query))
+  else:
+    src_rules = [
+        rule for rule in ndb.get_multi(entry.rule_key for entry in entries)
+        if rule is not None and rule.in_effect and rule.user_key == user_key]
 
   # Copy the local rules to the new host.
   new_rules = []
-  for src_rules in datastore_utils.Paginate(query):
-    for src_rule in src_rules:
-      logging.info('Copying local rule for %s', src_rule.key.parent().id())
-      new_rule = datastore_utils.CopyEntity(
-          src_rule, new_parent=src_rule.key.parent(), host_id=dest_host_id,
-          user_key=user_key)
-      new_rules.append(new_rule)
-      new_rule.InsertBigQueryRow()
+  for src_rule in src_rules:
+    logging.info('Copying local rule for %s', src_rule.key.parent().id())
+    new_rule = datastore_utils.CopyEntity(
+        src_rule, new_parent=src_rule.key.parent(), host_id=dest_host_id,
+        user_key=user_key)
+    new_rules.append(new_rule)
+    new_rule.InsertBigQueryRow()
 
   logging.info('Copying %d rule(s) to host %s', len(new_rules), dest_host_id)
   futures = ndb.put_multi_async(new_rules)
-  return datastore_utils.GetMultiFuture(futures)
+  future = datastore_utils.GetMultiFuture(futures)
+  future.add_callback(host_index.Update, new_rules)
+  return future
 
 
 class PreflightHandler(SantaRequestHandler):
@@ -747,6 +766,12 @@ class EventUploadHandler(SantaRequestHandler):
     if total_uploaded == bundle.binary_count:
       bundle.uploaded_dt = datetime.datetime.utcnow()
       yield bundle.put_async()
+
+      # Count any contents that were flagged before the upload finished. From
+      # here on, the counts are maintained as their flags change.
+      deferred.defer(
+          package_models.SantaBundle.UpdateFlagCounts, bundle_key,
+          _transactional=True)
       metrics.DeferLookupMetric(
           bundle.key.id(), constants.ANALYSIS_REASON.NEW_BLOCKABLE)
 
@@ -896,6 +921,43 @@ class EventUploadHandler(SantaRequestHandler):
     self.respond_json(response_dict)
 
 
+def _GetRuleDicts(rule):
+  """Returns the rule download payloads for a SantaRule."""
+  epoch = datetime.datetime.utcfromtimestamp(0)
+  creation_timestamp = (rule.updated_dt - epoch).total_seconds()
+  rule_dict = {
+      _RULE_DOWNLOAD.SHA256: rule.key.parent().id(),
+      _RULE_DOWNLOAD.RULE_TYPE: rule.rule_type,
+      _RULE_DOWNLOAD.POLICY: rule.policy,
+      _RULE_DOWNLOAD.CUSTOM_MSG: rule.custom_msg,
+      _RULE_DOWNLOAD.CREATION_TIME: creation_timestamp}
+
+  if rule.rule_type != constants.RULE_TYPE.PACKAGE:
+    return [rule_dict]
+
+  # For Bundles, each binary member should have a separate rule generated
+  # with a policy type matching that of the PACKAGE rule.
+  binary_ids = model_utils.GetBundleBinaryIdsForRule(rule)
+  binary_count = len(binary_ids)
+  logging.info('Syncing %s bundle rules', binary_ids)
+  rule_dicts = []
+  for id_ in binary_ids:
+    dict_ = rule_dict.copy()
+    dict_.update({
+        _RULE_DOWNLOAD.SHA256: id_,
+        _RULE_DOWNLOAD.RULE_TYPE: constants.RULE_TYPE.BINARY,
+        _RULE_DOWNLOAD.FILE_BUNDLE_BINARY_COUNT: binary_count,
+        _RULE_DOWNLOAD.FILE_BUNDLE_HASH: rule.key.parent().id()
+    })
+    rule_dicts.append(dict_)
+  return rule_dicts
+
+
+def _GetRulePosition(updated_dt, sha256, rule_id):
+  """Returns where a rule falls in the order rules are downloaded in."""
+  return [updated_dt.strftime('%Y-%m-%dT%H:%M:%S.%f'), sha256, rule_id]
+
+
 class RuleDownloadHandler(SantaRequestHandler):
   """Rule download handler sends new rules to clients."""
 
@@ -903,61 +965,170 @@ class RuleDownloadHandler(SantaRequestHandler):
   def RequestCounter(self):
     return monitoring.rule_download_requests
 
-  @handler_utils.RecordRequest
-  def post(self, uuid):
-    # Prepare the query
-    cursor = self.parsed_json.get(_RULE_DOWNLOAD.CURSOR)
+  def _GetRuleQuery(self, host_ids):
+    """Returns a query for the in-effect rules for the given host IDs.
 
-    if self.host.rule_sync_dt is None:
-      logging.info('%s clean rule sync', 'Continuing' if cursor else 'Starting')
+    Santa applies rules in the order it receives them, so they're sent in the
+    order they were written.
 
+    Args:
+      host_ids: list<str>, The host IDs of the rules, '' for global rules.
+    """
     # pylint:disable=g-explicit-bool-comparison, singleton-comparison
-    query = rule_models.SantaRule.query(
+    return rule_models.SantaRule.query(
         rule_models.SantaRule.in_effect == True,
         rule_models.SantaRule.updated_dt >= self.host.rule_sync_dt,
-        rule_models.SantaRule.host_id.IN(['', uuid])
+        rule_models.SantaRule.host_id.IN(host_ids)
     ).order(rule_models.SantaRule.updated_dt, rule_models.SantaRule.key)
     # pylint:enable=g-explicit-bool-comparison, singleton-comparison
 
-    # Fetch
-    rules, next_cursor, more = query.fetch_page(
-        settings.SANTA_RULE_BATCH_SIZE,
-        start_cursor=datastore_query.Cursor(urlsafe=cursor))
+  def _QueryRules(self, host_ids, cursor, count):
+    """Fetches a page of the in-effect rules for the given host IDs.
+
+    Args:
+      host_ids: list<str>, The host IDs of the rules, '' for global rules.
+      cursor: str, The urlsafe cursor to continue from, if any.
+      count: int, The maximum number of rules to fetch.
+
+    Returns:
+      A (rules, next_cursor) tuple, where next_cursor is None if there are no
+      more rules.
+    """
+    rules, next_cursor, more = self._GetRuleQuery(host_ids).fetch_page(
+        count, start_cursor=datastore_query.Cursor(urlsafe=cursor or None))
+    return rules, next_cursor.urlsafe() if more else None
+
+  def _ParseIndexedCursor(self, cursor):
+    """Parses the cursor of a download for a host with a rule index.
+
+    Args:
+      cursor: str, The prefixed cursor sent by the client, if any.
+
+    Returns:
+      A (position, global_cursor) tuple of the last rule sent and the Cursor
+      after the last global rule sent. Either is None if the download should
+      start from the beginning.
+    """
+    if not cursor:
+      return None, None
+
+    try:
+      state = json.loads(cursor[len(_INDEXED_CURSOR_PREFIX):])
+      position = state['position']
+      if position is not None and len(position) != 3:
+        raise ValueError('Invalid position: %r' % position)
+      global_cursor = state['global']
+      if global_cursor is not None:
+        global_cursor = datastore_query.Cursor(urlsafe=global_cursor)
+    except (ValueError, TypeError, KeyError, datastore_errors.BadValueError):
+      logging.warning('Restarting rule download from invalid cursor %r', cursor)
+      return None, None
+
+    return position, global_cursor
+
+  def _GetIndexedRules(self, entries, position, global_cursor, count):
+    """Fetches a page of the host's local and global rules in download order.
+
+    The local rules are read from the host's rule index and merged with the
+    global rules by when they were written.
+
+    Args:
+      entries: list<host_index.IndexEntry>, The host's rule index.
+      position: list, The position of the last rule already sent, if any.
+      global_cursor: Cursor, The cursor after the last global rule already
+          sent, if any.
+      count: int, The maximum number of rules to fetch.
+
+    Returns:
+      A (rules, next_cursor) tuple, where next_cursor is None if there are no
+      more rules.
+    """
+    sync_dt = self.host.rule_sync_dt
+    local_candidates = [
+        (_GetRulePosition(entry.updated_dt, entry.sha256, entry.rule_id),
+         entry, None)
+        for entry in entries
+        if sync_dt is None or entry.updated_dt >= sync_dt]
+    local_candidates.sort(key=lambda candidate: candidate[0])
+    if position is not None:
+      local_candidates = [
+          candidate for candidate in local_candidates
+          if candidate[0] > position]
+
+    # Fetch one more global rule than needed, to tell if there are any more.
+    global_candidates = []
+    rule_iter = self._GetRuleQuery(['']).iter(
+        start_cursor=global_cursor, produce_cursors=True, limit=count + 1)
+    for rule in rule_iter:
+      global_candidates.append((
+          _GetRulePosition(
+              rule.updated_dt, rule.key.parent().id(), rule.key.id()),
+          rule, rule_iter.cursor_after()))
+
+    page = sorted(
+        local_candidates[:count] + global_candidates, key=lambda c: c[0])
+    page = page[:count]
+
+    # Local rules are read from the index as it stands, which may briefly lag
+    # behind rules being disabled.
+    local_keys = [
+        rule_or_entry.rule_key for _, rule_or_entry, cursor in page
+        if cursor is None]
+    local_rules = iter(ndb.get_multi(local_keys))
+    rules = []
+    for _, rule_or_entry, cursor in page:
+      rule = next(local_rules) if cursor is None else rule_or_entry
+      if rule is not None and rule.in_effect:
+        rules.append(rule)
+
+    global_sent = sum(1 for _, _, cursor in page if cursor is not None)
+    more = (
+        len(local_candidates) > len(page) - global_sent or
+        len(global_candidates) > global_sent)
+    if not more:
+      return rules, None
+
+    for _, _, cursor in page:
+      if cursor is not None:
+        global_cursor = cursor
+    next_state = {
+        'position': page[-1][0],
+        'global': global_cursor.urlsafe() if global_cursor else None}
+    return rules, _INDEXED_CURSOR_PREFIX + json.dumps(next_state)
+
+  @handler_utils.RecordRequest
+  def post(self, uuid):
+    cursor = self.parsed_json.get(_RULE_DOWNLOAD.CURSOR)
+    batch_size = settings.SANTA_RULE_BATCH_SIZE
+
+    if self.host.rule_sync_dt is None:
+      logging.info('%s clean rule sync', 'Continuing' if cursor else 'Starting')
+
+    entries = None
+    if not cursor or cursor.startswith(_INDEXED_CURSOR_PREFIX):
+      entries = host_index.GetEntries(uuid)
+
+    if entries is not None:
+      position, global_cursor = self._ParseIndexedCursor(cursor)
+      rules, next_cursor = self._GetIndexedRules(
+          entries, position, global_cursor, batch_size)
+
+    # The host hasn't been indexed yet (or the download began before it was),
+    # so query for its local and global rules together.
+    else:
+      if cursor and cursor.startswith(_INDEXED_CURSOR_PREFIX):
+        cursor = None
+      rules, next_cursor = self._QueryRules(['', uuid], cursor, batch_size)
 
     # Process the received rules.
     response_rules = []
     for rule in rules:
-      epoch = datetime.datetime.utcfromtimestamp(0)
-      creation_timestamp = (rule.updated_dt - epoch).total_seconds()
-      rule_dict = {
-          _RULE_DOWNLOAD.SHA256: rule.key.parent().id(),
-          _RULE_DOWNLOAD.RULE_TYPE: rule.rule_type,
-          _RULE_DOWNLOAD.POLICY: rule.policy,
-          _RULE_DOWNLOAD.CUSTOM_MSG: rule.custom_msg,
-          _RULE_DOWNLOAD.CREATION_TIME: creation_timestamp}
-
-      if rule.rule_type == constants.RULE_TYPE.PACKAGE:
-        # For Bundles, each binary member should have a separate rule generated
-        # with a policy type matching that of the PACKAGE rule.
-        binary_ids = model_utils.GetBundleBinaryIdsForRule(rule)
-        binary_count = len(binary_ids)
-        logging.info('Syncing %s bundle rules', binary_ids)
-        for id_ in binary_ids:
-          dict_ = rule_dict.copy()
-          dict_.update({
-              _RULE_DOWNLOAD.SHA256: id_,
-              _RULE_DOWNLOAD.RULE_TYPE: constants.RULE_TYPE.BINARY,
-              _RULE_DOWNLOAD.FILE_BUNDLE_BINARY_COUNT: binary_count,
-              _RULE_DOWNLOAD.FILE_BUNDLE_HASH: rule.key.parent().id()
-          })
-          response_rules.append(dict_)
-      else:
-        response_rules.append(rule_dict)
+      response_rules.extend(_GetRuleDicts(rule))
 
     # Prepare the response, include the cursor if there are more rules.
     response = {_RULE_DOWNLOAD.RULES: response_rules}
-    if more:
-      response[_RULE_DOWNLOAD.CURSOR] = next_cursor.urlsafe()
+    if next_cursor is not None:
+      response[_RULE_DOWNLOAD.CURSOR] = next_cursor
 
     self.respond_json(response)
 
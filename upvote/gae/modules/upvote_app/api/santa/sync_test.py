@@ -34,6 +34,7 @@ from upvote.gae.datastore.models import host as host_models
 from upvote.gae.datastore.models import package as package_models
 from upvote.gae.datastore.models import rule as rule_models
 from upvote.gae.datastore.models import user as user_models
+from upvote.gae.lib.rules import host_index
 from upvote.gae.lib.testing import basetest
 from upvote.gae.modules.upvote_app.api.santa import auth
 from upvote.gae.modules.upvote_app.api.santa import sync
@@ -289,6 +290,41 @@ class CopyLocalRulesTest(SantaApiTestCase):
 
     self.assertBigQueryInsertions([TABLE.RULE] * blockable_count)
 
+  def _CreateRulesToCopy(self, indexed):
+    user = test_utils.CreateUser()
+    now = datetime.datetime.utcnow()
+    src_host = test_utils.CreateSantaHost(
+        id='1111', primary_user=user.nickname, last_postflight_dt=now)
+    blockables = test_utils.CreateSantaBlockables(2)
+    rule = test_utils.CreateSantaRule(
+        blockables[0].key, host_id=src_host.key.id(), user_key=user.key,
+        in_effect=True)
+    test_utils.CreateSantaRule(
+        blockables[1].key, host_id=src_host.key.id(), user_key=user.key,
+        in_effect=False)
+    if indexed:
+      host_index.Rebuild(src_host.key.id())
+    return user, rule
+
+  def _GetCopiedRules(self, user, host_id):
+    sync._CopyLocalRules(user.key, host_id).get_result()
+    return rule_models.SantaRule.query(
+        rule_models.SantaRule.host_id == host_id).fetch()
+
+  def testOnlyInEffect_Indexed(self):
+    user, rule = self._CreateRulesToCopy(True)
+
+    rules = self._GetCopiedRules(user, '2222')
+
+    self.assertEqual([rule.key.parent()], [r.key.parent() for r in rules])
+
+  def testOnlyInEffect_NotIndexed(self):
+    user, rule = self._CreateRulesToCopy(False)
+
+    rules = self._GetCopiedRules(user, '2222')
+
+    self.assertEqual([rule.key.parent()], [r.key.parent() for r in rules])
+
 
 class PreflightHandlerTest(SantaApiTestCase):
 
@@ -1500,6 +1536,100 @@ class RuleDownloadHandlerTest(SantaApiTestCase):
 
     self.VerifyIncrementCalls(self.mock_request_metric, httplib.OK, httplib.OK)
 
+  def testIndexedLocalRules(self):
+    local_rule = test_utils.CreateSantaRule(
+        test_utils.CreateSantaBlockable().key, host_id='my-uuid')
+    test_utils.CreateSantaRule(
+        test_utils.CreateSantaBlockable().key, host_id='my-other-uuid')
+    host_index.Rebuild('my-uuid')
+
+    response = self.testapp.post_json('/my-uuid', {})
+
+    # The global rule was written first, so it's sent first.
+    self.assertEqual(
+        [self.blockable.key.id(), local_rule.key.parent().id()],
+        [rule[RULE_DOWNLOAD.SHA256] for rule in response.json[
+            RULE_DOWNLOAD.RULES]])
+    self.assertFalse(RULE_DOWNLOAD.CURSOR in response.json)
+    self.VerifyIncrementCalls(self.mock_request_metric, httplib.OK)
+
+  def _DownloadAll(self, uuid):
+    """Downloads every page of rules, returning the sha256 and policy of each."""
+    downloaded = []
+    cursor = None
+    while True:
+      response = self.testapp.post_json(
+          '/' + uuid, {RULE_DOWNLOAD.CURSOR: cursor} if cursor else {})
+      downloaded.extend(
+          (rule[RULE_DOWNLOAD.SHA256], rule[RULE_DOWNLOAD.POLICY])
+          for rule in response.json[RULE_DOWNLOAD.RULES])
+      cursor = response.json.get(RULE_DOWNLOAD.CURSOR)
+      if cursor is None:
+        return downloaded
+
+  def testIndexedCursor(self):
+    local_rules = test_utils.CreateSantaRules(
+        test_utils.CreateSantaBlockable().key, 2, host_id='my-uuid')
+    host_index.Rebuild('my-uuid')
+    self.PatchSetting('SANTA_RULE_BATCH_SIZE', 1)
+
+    downloaded = self._DownloadAll('my-uuid')
+
+    self.assertEqual(
+        [self.blockable.key.id()] + [local_rules[0].key.parent().id()] * 2,
+        [sha256 for sha256, _ in downloaded])
+
+  def testIndexedCursor_Interleaved(self):
+    blockable = test_utils.CreateSantaBlockable()
+    host_index.Rebuild('my-uuid')
+
+    # A global removal followed by a newer local whitelist, as after a reset.
+    global_rule = test_utils.CreateSantaRule(
+        blockable.key, policy=constants.RULE_POLICY.REMOVE)
+    local_rule = test_utils.CreateSantaRule(
+        blockable.key, host_id='my-uuid',
+        policy=constants.RULE_POLICY.WHITELIST)
+    host_index.Update([local_rule])
+    self.DrainTaskQueue(constants.TASK_QUEUE.HOST_RULE_INDEX)
+    newer_global_rule = test_utils.CreateSantaRule(
+        test_utils.CreateSantaBlockable().key)
+
+    for batch_size in (1, 2, 10):
+      self.PatchSetting('SANTA_RULE_BATCH_SIZE', batch_size)
+
+      downloaded = self._DownloadAll('my-uuid')
+
+      expected = [
+          (self.blockable.key.id(), constants.RULE_POLICY.WHITELIST),
+          (blockable.key.id(), global_rule.policy),
+          (blockable.key.id(), local_rule.policy),
+          (newer_global_rule.key.parent().id(), newer_global_rule.policy)]
+      self.assertEqual(expected, downloaded)
+
+  def testIndexedCursor_Invalid(self):
+    host_index.Rebuild('my-uuid')
+
+    for cursor in ('indexed:notjson', 'indexed:[]', 'indexed:{}',
+                   'indexed:{"position": null, "global": "notacursor"}'):
+      response = self.testapp.post_json(
+          '/my-uuid', {RULE_DOWNLOAD.CURSOR: cursor})
+
+      # The download should start over.
+      self.assertEqual(httplib.OK, response.status_int)
+      self.assertLen(response.json[RULE_DOWNLOAD.RULES], 1)
+
+  def testIndexedLocalRules_Disabled(self):
+    local_rule = test_utils.CreateSantaRule(
+        test_utils.CreateSantaBlockable().key, host_id='my-uuid')
+    host_index.Rebuild('my-uuid')
+    local_rule.MarkDisabled()
+    local_rule.put()
+
+    response = self.testapp.post_json('/my-uuid', {})
+
+    # Only the global rule should be sent, even if the index lags behind.
+    self.assertLen(response.json[RULE_DOWNLOAD.RULES], 1)
+
 
 class PostflightHandlerTest(SantaApiTestCase):
 
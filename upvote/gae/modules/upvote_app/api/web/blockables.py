@@ -31,6 +31,7 @@ from upvote.gae.datastore.models import package as package_models
 from upvote.gae.datastore.models import rule as rule_models
 from upvote.gae.lib.bit9 import change_set
 from upvote.gae.lib.voting import api as voting_api
+from upvote.gae.lib.voting import audit as voting_audit
 from upvote.gae.modules.upvote_app.api.web import monitoring
 from upvote.gae.utils import handler_utils
 from upvote.gae.utils import xsrf_utils
@@ -180,7 +181,8 @@ class BlockableHandler(handler_utils.UserFacingHandler):
 
     # Augment the response dict with related voting data.
     blockable_dict = blockable.to_dict()
-    allowed, reason = voting_api.IsVotingAllowed(blockable.key)
+    allowed, reason = voting_api.IsVotingAllowed(
+        blockable.key, current_user=self.user)
     blockable_dict['is_voting_allowed'] = allowed
     blockable_dict['voting_prohibited_reason'] = reason
 
@@ -442,8 +444,37 @@ class SetInstallerStateHandler(handler_utils.UserFacingHandler):
     self.respond_json(new_installer_state)
 
 
+class BlockableAuditHandler(handler_utils.UserFacingHandler):
+  """Handler for fleet-wide audits of blockable voting state."""
+
+  @handler_utils.RequirePermission(constants.PERMISSIONS.RUN_BATCH_JOB)
+  def get(self, audit_id):  # pylint: disable=g-bad-name
+    report = voting_audit.GetReport(int(audit_id))
+    if report is None:
+      self.abort(httplib.NOT_FOUND, explanation='Audit not found')
+    self.respond_json(report)
+
+  @xsrf_utils.RequireToken
+  @handler_utils.RequirePermission(constants.PERMISSIONS.RUN_BATCH_JOB)
+  def post(self):  # pylint: disable=g-bad-name
+    shards = self.request.get('shards')
+    try:
+      audit_id = voting_audit.Start(
+          shard_count=int(shards) if shards else None)
+    except ValueError as e:
+      self.abort(httplib.BAD_REQUEST, explanation=str(e))
+    else:
+      self.respond_json(voting_audit.GetReport(audit_id))
+
+
 # The Webapp2 routes defined for these handlers.
 ROUTES = routes.PathPrefixRoute('/blockables', [
+    webapp2.Route(
+        '/audits',
+        handler=BlockableAuditHandler),
+    webapp2.Route(
+        '/audits/<audit_id:\d+>',
+        handler=BlockableAuditHandler),
     webapp2.Route(
         '/<package_id>/contents',
         handler=PackageContentsHandler),
@@ -873,5 +873,39 @@ class SetInstallerStateHandlerTest(BlockablesTest):
     self.assertBigQueryInsertion(constants.BIGQUERY_TABLE.BINARY)
 
 
+class BlockableAuditHandlerTest(BlockablesTest):
+
+  ROUTE = '/blockables/audits'
+
+  def testPost(self):
+    with self.LoggedInUser(admin=True):
+      response = self.testapp.post(self.ROUTE, {'shards': 2})
+
+    self.assertEqual(2, response.json['shardCount'])
+    self.assertTaskCount(constants.TASK_QUEUE.VOTING_AUDIT, 2)
+
+  def testPost_InvalidShardCount(self):
+    with self.LoggedInUser(admin=True):
+      self.testapp.post(
+          self.ROUTE, {'shards': 'lots'}, status=httplib.BAD_REQUEST)
+
+  def testPost_Forbidden(self):
+    with self.LoggedInUser():
+      self.testapp.post(self.ROUTE, status=httplib.FORBIDDEN)
+
+  def testGet(self):
+    with self.LoggedInUser(admin=True):
+      audit_id = self.testapp.post(self.ROUTE).json['id']
+      self.DrainTaskQueue(constants.TASK_QUEUE.VOTING_AUDIT)
+      response = self.testapp.get('%s/%d' % (self.ROUTE, audit_id))
+
+    self.assertIsNotNone(response.json['completedDt'])
+    self.assertEqual(5, response.json['auditedCount'])
+
+  def testGet_NotFound(self):
+    with self.LoggedInUser(admin=True):
+      self.testapp.get(self.ROUTE + '/12345', status=httplib.NOT_FOUND)
+
+
 if __name__ == '__main__':
   basetest.main()
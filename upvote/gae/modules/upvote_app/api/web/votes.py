@@ -15,6 +15,7 @@
 """Views related to votes."""
 import datetime
 import httplib
+import json
 import logging
 
 import webapp2
@@ -27,6 +28,7 @@ from upvote.gae.datastore import utils as datastore_utils
 from upvote.gae.datastore.models import binary as binary_models
 from upvote.gae.datastore.models import vote as vote_models
 from upvote.gae.lib.voting import api as voting_api
+from upvote.gae.lib.voting import ingestion as voting_ingestion
 from upvote.gae.modules.upvote_app.api.web import monitoring
 from upvote.gae.utils import handler_utils
 from upvote.gae.utils import xsrf_utils
@@ -89,8 +91,8 @@ class VoteHandler(handler_utils.UserFacingHandler):
       self.abort(httplib.NOT_FOUND, explanation='Vote not found.')
 
 
-class VoteCastHandler(handler_utils.UserFacingHandler):
-  """Handler for casting votes."""
+class _BaseVoteCastHandler(handler_utils.UserFacingHandler):
+  """Base class for handlers which cast votes."""
 
   def _GetVoteWeight(self, role):
     if not role:
@@ -112,6 +114,10 @@ class VoteCastHandler(handler_utils.UserFacingHandler):
 
     return vote_weight
 
+
+class VoteCastHandler(_BaseVoteCastHandler):
+  """Handler for casting votes."""
+
   @xsrf_utils.RequireToken
   def post(self, blockable_id):
     """Handle votes from users."""
@@ -125,8 +131,14 @@ class VoteCastHandler(handler_utils.UserFacingHandler):
         self.user.nickname, role, '+' if was_yes_vote else '-', vote_weight,
         blockable_id)
 
+    # When queued, the vote is only applied to the blockable in the background.
+    if settings.QUEUED_VOTING_ENABLED:
+      vote_func = voting_ingestion.QueueVote
+    else:
+      vote_func = voting_api.Vote
+
     try:
-      vote = voting_api.Vote(self.user, blockable_id, was_yes_vote, vote_weight)
+      vote = vote_func(self.user, blockable_id, was_yes_vote, vote_weight)
     except voting_api.BlockableNotFoundError:
       self.abort(httplib.NOT_FOUND, explanation='Application not found')
     except voting_api.UnsupportedClientError:
@@ -148,11 +160,25 @@ class VoteCastHandler(handler_utils.UserFacingHandler):
       # Augment the response dict with related voting data.
       blockable = binary_models.Blockable.get_by_id(blockable_id)
       blockable_dict = blockable.to_dict()
-      allowed, reason = voting_api.IsVotingAllowed(blockable.key)
+      allowed, reason = voting_api.IsVotingAllowed(
+          blockable.key, current_user=self.user)
       blockable_dict['is_voting_allowed'] = allowed
       blockable_dict['voting_prohibited_reason'] = reason
 
-      self.respond_json({'blockable': blockable_dict, 'vote': vote})
+      # A queued vote is reported as the Vote it will become once applied, so
+      # the response has the same shape either way.
+      is_pending = settings.QUEUED_VOTING_ENABLED
+      if is_pending:
+        vote = vote_models.Vote(
+            key=vote_models.Vote.GetKey(blockable.key, self.user.key),
+            user_email=vote.user_email,
+            was_yes_vote=vote.was_yes_vote,
+            weight=vote.weight,
+            candidate_type=blockable.rule_type,
+            recorded_dt=vote.recorded_dt)
+
+      self.respond_json({
+          'blockable': blockable_dict, 'vote': vote, 'is_pending': is_pending})
 
   def get(self, blockable_id):
     """Gets user's vote for the given blockable."""
@@ -167,8 +193,84 @@ class VoteCastHandler(handler_utils.UserFacingHandler):
     self.respond_json(vote)
 
 
+# The HTTP status reported for each error that can be raised by casting a vote.
+_BATCH_VOTE_ERROR_STATUSES = {
+    voting_api.BlockableNotFoundError: httplib.NOT_FOUND,
+    voting_api.UnsupportedClientError: httplib.BAD_REQUEST,
+    voting_api.DuplicateVoteError: httplib.CONFLICT,
+    voting_api.OperationNotAllowedError: httplib.FORBIDDEN,
+}
+
+
+class BatchVoteCastHandler(_BaseVoteCastHandler):
+  """Handler for casting votes on many blockables at once."""
+
+  def _GetVotes(self):
+    """Parses the (blockable_id, was_yes_vote) pairs to cast from the request.
+
+    The votes are expected as a JSON list of objects, each with an 'id' and a
+    boolean 'wasYesVote' field.
+    """
+    try:
+      vote_dicts = json.loads(self.request.get('votes'))
+      votes = []
+      for vote_dict in vote_dicts:
+        was_yes_vote = vote_dict['wasYesVote']
+        if not isinstance(was_yes_vote, bool):
+          raise TypeError('wasYesVote must be a boolean')
+        votes.append((vote_dict['id'], was_yes_vote))
+    except (ValueError, TypeError, KeyError):
+      self.abort(httplib.BAD_REQUEST, explanation='Invalid votes provided')
+
+    if not votes:
+      self.abort(httplib.BAD_REQUEST, explanation='No votes provided')
+    if len(votes) > voting_api.MAX_BATCH_VOTES:
+      self.abort(
+          httplib.REQUEST_ENTITY_TOO_LARGE,
+          explanation='At most %d votes may be cast at once' % (
+              voting_api.MAX_BATCH_VOTES))
+    return votes
+
+  @xsrf_utils.RequireToken
+  @handler_utils.RequirePermission(constants.PERMISSIONS.BATCH_VOTE)
+  def post(self):
+    """Casts a vote for each of the requested blockables."""
+    votes = self._GetVotes()
+    role = self.request.get('asRole', default_value=self.user.highest_role)
+    vote_weight = self._GetVoteWeight(role)
+
+    logging.info(
+        'User %s is using the %s role to cast %d vote(s) with weight %s',
+        self.user.nickname, role, len(votes), vote_weight)
+
+    try:
+      results = voting_api.BatchVote(self.user, votes, vote_weight)
+    except voting_api.InvalidVoteWeightError:
+      self.abort(httplib.BAD_REQUEST, explanation='Invalid voting weight')
+
+    if any(result.vote for result in results):
+      self.user.last_vote_dt = datetime.datetime.utcnow()
+      self.user.put()
+
+    result_dicts = []
+    for result in results:
+      result_dict = {'id': result.sha256, 'vote': result.vote}
+      if result.error is None:
+        result_dict['status'] = httplib.OK
+      else:
+        result_dict['status'] = _BATCH_VOTE_ERROR_STATUSES.get(
+            type(result.error), httplib.INTERNAL_SERVER_ERROR)
+        result_dict['explanation'] = result.error.message
+      result_dicts.append(result_dict)
+
+    self.respond_json(result_dicts)
+
+
 # The Webapp2 routes defined for these handlers.
 ROUTES = routes.PathPrefixRoute('/votes', [
+    webapp2.Route(
+        '/cast',
+        handler=BatchVoteCastHandler),
     webapp2.Route(
         '/cast/<blockable_id>',
         handler=VoteCastHandler),
@@ -15,6 +15,7 @@
 """Unit tests for Votes handlers."""
 
 import httplib
+import json
 import mock
 
 import webapp2
@@ -264,6 +265,34 @@ class VoteCastHandlerTest(VotesTest):
     self.assertEqual(True, output['vote']['wasYesVote'])
     self.assertIn('isVotingAllowed', output['blockable'])
     self.assertIn('votingProhibitedReason', output['blockable'])
+    self.assertFalse(output['isPending'])
+
+  def testPost_User_Queued(self):
+    self.PatchSetting('QUEUED_VOTING_ENABLED', True)
+    params = {'wasYesVote': 'true'}
+
+    with self.LoggedInUser(email_addr=self.user_2.email):
+      response = self.testapp.post(
+          self.ROUTE % self.santa_blockable.key.id(), params)
+
+    output = response.json
+
+    # The pending vote is reported the same way as an applied one.
+    expected_key = vote_models.Vote.GetKey(
+        self.santa_blockable.key, self.user_2.key)
+    self.assertTrue(output['isPending'])
+    self.assertEqual(expected_key.urlsafe(), output['vote']['key'])
+    self.assertEqual(
+        self.santa_blockable.key.urlsafe(), output['vote']['blockableKey'])
+    self.assertEqual(self.user_2.email, output['vote']['userEmail'])
+    self.assertEqual(True, output['vote']['wasYesVote'])
+    self.assertEqual(constants.RULE_TYPE.BINARY, output['vote']['candidateType'])
+    self.assertTrue(output['vote']['inEffect'])
+
+    self.assertEntityCount(
+        vote_models.Vote, 0, ancestor=datastore_utils.ConcatenateKeys(
+            self.santa_blockable.key, self.user_2.key))
+    self.assertTaskCount(constants.TASK_QUEUE.VOTE_APPLY, 1)
 
   def testPost_User_Duplicate(self):
     params = {'wasYesVote': 'true'}
@@ -393,5 +422,64 @@ class VoteCastHandlerTest(VotesTest):
     self.assertEqual(self.vote_2.key.urlsafe(), response.json['key'])
 
 
+class BatchVoteCastHandlerTest(VotesTest):
+
+  ROUTE = '/votes/cast'
+
+  def _Post(self, votes, **kwargs):
+    params = {'votes': json.dumps([
+        {'id': blockable_id, 'wasYesVote': was_yes_vote}
+        for blockable_id, was_yes_vote in votes])}
+    return self.testapp.post(self.ROUTE, params, **kwargs)
+
+  def testPost_Success(self):
+    unknown_sha256 = test_utils.RandomSHA256()
+
+    with self.LoggedInUser(admin=True):
+      response = self._Post([
+          (self.other_blockable.key.id(), False), (unknown_sha256, True)])
+
+    output = response.json
+    self.assertEqual(
+        [self.other_blockable.key.id(), unknown_sha256],
+        [result['id'] for result in output])
+    self.assertEqual(
+        [httplib.OK, httplib.NOT_FOUND],
+        [result['status'] for result in output])
+    self.assertFalse(output[0]['vote']['wasYesVote'])
+    self.assertIsNone(output[1]['vote'])
+    self.assertIn('explanation', output[1])
+
+  def testPost_InvalidVotes(self):
+    with self.LoggedInUser(admin=True):
+      self.testapp.post(
+          self.ROUTE, {'votes': 'notjson'}, status=httplib.BAD_REQUEST)
+      self.testapp.post(
+          self.ROUTE, {'votes': '[{"wasYesVote": true}]'},
+          status=httplib.BAD_REQUEST)
+      self._Post([], status=httplib.BAD_REQUEST)
+
+  def testPost_NonBooleanVotes(self):
+    with self.LoggedInUser(admin=True):
+      for was_yes_vote in ('true', 1, 0, None):
+        self._Post(
+            [(self.santa_blockable.key.id(), was_yes_vote)],
+            status=httplib.BAD_REQUEST)
+
+  def testPost_TooManyVotes(self):
+    self.Patch(voting_api, 'MAX_BATCH_VOTES', 1)
+
+    with self.LoggedInUser(admin=True):
+      self._Post(
+          [(self.santa_blockable.key.id(), True),
+           (self.other_blockable.key.id(), True)],
+          status=httplib.REQUEST_ENTITY_TOO_LARGE)
+
+  def testPost_User_NotAuthorized(self):
+    with self.LoggedInUser(email_addr=self.user_2.email):
+      self._Post(
+          [(self.santa_blockable.key.id(), True)], status=httplib.FORBIDDEN)
+
+
 if __name__ == '__main__':
   basetest.main()
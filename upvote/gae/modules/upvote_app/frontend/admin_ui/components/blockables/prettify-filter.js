@@ -39,6 +39,8 @@ upvote.admin.blockables.prettifyState = (inputString) => {
       return 'Banned without notification for security reasons.';
     case 'BANNED':
       return 'Banned as malware or for security reasons.';
+    case 'RESETTING':
+      return 'Votes and rules are being reset.';
     default:
       return inputString;
   }
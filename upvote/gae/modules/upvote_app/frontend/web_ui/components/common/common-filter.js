@@ -79,6 +79,8 @@ upvote.common.blockableStateText = (state) => {
       return 'Banned without notification for security reasons.';
     case 'BANNED':
       return 'Banned as malware or for security reasons.';
+    case 'RESETTING':
+      return 'Votes and rules are being reset.';
     default:
       return state;
   }
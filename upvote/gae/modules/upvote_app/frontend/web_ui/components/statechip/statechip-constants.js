@@ -37,6 +37,7 @@ StateDisplayMap[UiState['FLAGGED']] = 'Flagged';
 StateDisplayMap[UiState['BANNED']] = 'Banned';
 StateDisplayMap[UiState['CERT_BANNED']] = 'Banned Publisher';
 StateDisplayMap[UiState['CERT_WHITELISTED']] = 'Whitelisted Publisher';
+StateDisplayMap[UiState['RESETTING']] = 'Resetting';
 
 
 /**
@@ -53,4 +54,5 @@ StateClassMap[UiState['FLAGGED']] = 'flagged';
 StateClassMap[UiState['BANNED']] = 'banned';
 StateClassMap[UiState['CERT_BANNED']] = 'banned';
 StateClassMap[UiState['CERT_WHITELISTED']] = 'whitelisted';
+StateClassMap[UiState['RESETTING']] = 'awaiting-votes';
 });  // goog.scope
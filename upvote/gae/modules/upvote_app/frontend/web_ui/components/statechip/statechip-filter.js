@@ -49,6 +49,8 @@ upvote.statechip.ToUiState = function(blockableState, vote, cert) {
     case BlockableState['SILENT_BANNED']:
     case BlockableState['BANNED']:
       return UiState['BANNED'];
+    case BlockableState['RESETTING']:
+      return UiState['RESETTING'];
   }
   // If the binary has no blockable-specific rules but does have cert-specific
   // rules, display the cert's state.
@@ -32,6 +32,7 @@ upvote.shared.constants.BlockableState = {
   'SUSPECT': 'SUSPECT',
   'SILENT_BANNED': 'SILENT_BANNED',
   'BANNED': 'BANNED',
+  'RESETTING': 'RESETTING',
 };
 
 
@@ -49,6 +50,7 @@ upvote.shared.constants.UiBlockableState = {
   'BANNED': 'BANNED',
   'CERT_WHITELISTED': 'CERT_WHITELISTED',
   'CERT_BANNED': 'CERT_BANNED',
+  'RESETTING': 'RESETTING',
 };
 
 
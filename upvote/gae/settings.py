@@ -120,6 +120,18 @@ VOTING_WEIGHTS = {
     constants.USER_ROLE.ADMINISTRATOR: 25,
 }
 
+# Whether votes cast through the web UI are queued and applied to their
+# Blockables in the background, rather than within the voting request.
+#
+# This avoids transaction contention when many users vote on the same Blockable
+# at once, at the cost of votes taking a few seconds to be reflected. See
+# gae/lib/voting/ingestion.py.
+QUEUED_VOTING_ENABLED = False
+
+# The number of days after which disabled Rules are moved out of the Rule kind
+# and into the ArchivedRule kind. See gae/cron/rule_retention.py.
+DISABLED_RULE_RETENTION_DAYS = 90
+
 # Maps elevated-privilege roles to a list of user group names.
 #
 # These groups are expanded to users (See upvote/gae/shared/common/groups.py)
@@ -212,6 +224,13 @@ class ProdEnv(env_utils.DefaultEnv):
   # See docs for complete setup instructions.
   ENABLE_BIGQUERY_STREAMING = False
 
+  # Where to write the same rows as compressed, time-partitioned NDJSON files,
+  # which can be bulk loaded into BigQuery or analyzed offline. Either a
+  # gs://<bucket>/<prefix> Cloud Storage path or None to disable.
+  #
+  # This works whether or not BigQuery streaming is enabled.
+  ANALYTICS_FILE_PATH = None
+
 
 class LocalEnv(env_utils.DefaultEnv):
   """The Local environment namespace."""
@@ -222,3 +241,4 @@ class LocalEnv(env_utils.DefaultEnv):
   PROJECT_ID = 'auto'
 
   ENABLE_BIGQUERY_STREAMING = False
+  ANALYTICS_FILE_PATH = None
@@ -113,6 +113,12 @@ EXEMPTION = UpvoteNamespace('exemption/', [
     ('state_changes', 'State Changes')])
 
 
+VOTING = UpvoteNamespace('voting/', [
+    ('blockables_audited', 'Blockables Audited'),
+    ('blockables_repaired', 'Blockables Repaired'),
+    ('rules_archived', 'Rules Archived')])
+
+
 ROLES = UpvoteNamespace('roles/', [
     ('syncing_errors', 'Syncing Errors')])
 
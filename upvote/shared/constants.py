@@ -163,10 +163,11 @@ BLOCKABLE_TYPE = UppercaseNamespace(['santa_binary', 'santa_certificate'])
 
 
 PERMISSIONS = UppercaseNamespace([
-    'ADD_OVERRIDE', 'CHANGE_SETTINGS', 'EDIT_ALERTS', 'EDIT_HOSTS',
-    'FLAG', 'INSERT_BLOCKABLES', 'MANAGE_EXEMPTIONS', 'MARK_INSTALLER',
-    'MARK_MALWARE', 'REQUEST_EXEMPTION', 'RESET_BLOCKABLE_STATE',
-    'RUN_BATCH_JOB', 'UNFLAG', 'VIEW_CONSTANTS', 'VIEW_ADMIN_CONSOLE',
+    'ADD_OVERRIDE', 'BATCH_VOTE', 'CHANGE_SETTINGS', 'EDIT_ALERTS',
+    'EDIT_HOSTS', 'FLAG', 'INSERT_BLOCKABLES', 'MANAGE_EXEMPTIONS',
+    'MARK_INSTALLER', 'MARK_MALWARE', 'REQUEST_EXEMPTION',
+    'RESET_BLOCKABLE_STATE', 'RUN_BATCH_JOB', 'UNFLAG', 'VIEW_CONSTANTS',
+    'VIEW_ADMIN_CONSOLE',
     'VIEW_HOST_IP', 'VIEW_OTHER_BLOCKABLES', 'VIEW_OTHER_EVENTS',
     'VIEW_OTHER_HOSTS', 'VIEW_OTHER_USERS', 'VIEW_RULES', 'VIEW_VOTES', 'VOTE'
 ])
@@ -186,7 +187,8 @@ PERMISSIONS.DefineSet('SUPERUSER', PERMISSIONS.SET_TRUSTED_USER.union([
     PERMISSIONS.RESET_BLOCKABLE_STATE, PERMISSIONS.EDIT_HOSTS]))
 
 PERMISSIONS.DefineSet('SECURITY', PERMISSIONS.SET_SUPERUSER.union([
-    PERMISSIONS.INSERT_BLOCKABLES, PERMISSIONS.VIEW_RULES]))
+    PERMISSIONS.BATCH_VOTE, PERMISSIONS.INSERT_BLOCKABLES,
+    PERMISSIONS.VIEW_RULES]))
 
 PERMISSIONS.DefineSet('ADMINISTRATOR', PERMISSIONS.SET_SECURITY.union([
     PERMISSIONS.ADD_OVERRIDE, PERMISSIONS.CHANGE_SETTINGS,
@@ -259,7 +261,11 @@ STATE = UppercaseNamespace([
     'SILENT_BANNED',
 
     # Blockable is whitelisted but pending pick-up by syncing system.
-    'PENDING'])
+    'PENDING',
+
+    # All votes and rules for the Blockable are being reset.
+    # Voting is disabled.
+    'RESETTING'])
 
 # Certificates have a limited set of states
 STATE.DefineSet('CERTIFICATE', [
@@ -274,7 +280,7 @@ STATE.DefineSet('VOTING_ALLOWED', [
 STATE.DefineSet('VOTING_ALLOWED_ADMIN_ONLY', [STATE.SUSPECT])
 STATE.DefineSet('VOTING_PROHIBITED', [
     STATE.PENDING, STATE.LIMITED, STATE.BANNED, STATE.SILENT_BANNED,
-    STATE.GLOBALLY_WHITELISTED])
+    STATE.GLOBALLY_WHITELISTED, STATE.RESETTING])
 
 
 VOTING_PROHIBITED_REASONS = Namespace(tuples=[
@@ -462,5 +468,26 @@ TASK_QUEUE = Namespace(tuples=[
     # Used for processing exemption-related tasks.
     ('EXEMPTIONS', 'exemptions'),
 
-    # Used for performing BigQueryRow streaming inserts.
-    ('BIGQUERY_STREAMING', 'bigquery-streaming')])
+    # Used for flushing buffered rows to BigQuery.
+    ('BIGQUERY_STREAMING', 'bigquery-streaming'),
+
+    # Pull queue used for buffering rows until they're streamed to BigQuery.
+    ('BIGQUERY_ROWS', 'bigquery-rows'),
+
+    # Used for fleet-wide audits of blockable voting state.
+    ('VOTING_AUDIT', 'voting-audit'),
+
+    # Used for creating local whitelist rules for batches of voters.
+    ('LOCAL_WHITELISTING', 'local-whitelisting'),
+
+    # Used for applying queued votes to their blockables.
+    ('VOTE_APPLY', 'vote-apply'),
+
+    # Used for resetting blockables in batches.
+    ('BLOCKABLE_RESET', 'blockable-reset'),
+
+    # Used for archiving old disabled rules.
+    ('RULE_RETENTION', 'rule-retention'),
+
+    # Used for maintaining the per-host index of local rules.
+    ('HOST_RULE_INDEX', 'host-rule-index')])